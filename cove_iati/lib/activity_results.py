@@ -0,0 +1,161 @@
+'''
+Results of checking single activities, reused when a file is checked again with some activities edited.
+
+With settings.INCREMENTAL_CHECKS, files are checked one child of the root element at a time
+(see `stream_checks`), and `ActivityChecks` keeps the result for each child in an
+`ActivityResultStore`, keyed by a hash of the child's canonical (C14N) serialization and of
+what else the checks depend on. A child that is the same as one checked before isn't checked
+again: its schema, codelist and ruleset errors, org refs and identifiers are taken from the
+store. The totals for the file are then added up from every child's results as usual.
+
+Results are stored relative to the child, and moved to wherever it is in the new file: paths
+in the child start with `ACTIVITY_XPATH` or `ACTIVITY_PATH`, and line numbers count from its
+first line.
+'''
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import lxml.etree
+from django.conf import settings
+
+from .process_codelists import codelist_store
+
+# Bump when what is stored changes, so old results are no longer used
+ACTIVITY_RESULT_FORMAT = 2
+
+ACTIVITY_XPATH = '{activity_xpath}'
+ACTIVITY_PATH = '{activity_path}'
+
+
+def activity_result_config_key(schema_path, schema_version, rulesets):
+    '''Return a key for everything but the activity that the results of `ActivityChecks` depend on'''
+    return json.dumps({
+        'format': ACTIVITY_RESULT_FORMAT,
+        'schema': [os.path.basename(schema_path), schema_version],
+        'codelists': codelist_store.version(),
+        'rulesets': sorted(rulesets.items()),
+        # some rules check that dates are in the past
+        'date': datetime.date.today().isoformat(),
+    }, sort_keys=True)
+
+
+def activity_fingerprint(config_key, child):
+    '''Return the key of the results for child, which has the same errors wherever it is in a file'''
+    sha256 = hashlib.sha256(config_key.encode())
+    sha256.update(lxml.etree.tostring(child, method='c14n'))
+    # schema errors give line numbers, which C14N leaves out
+    sourceline = child.sourceline
+    sha256.update(' '.join(str(element.sourceline - sourceline) for element in child.iter()).encode())
+    return sha256.hexdigest()
+
+
+def _relative(path, prefix, placeholder):
+    if path == prefix or path.startswith(prefix + '/'):
+        return placeholder + path[len(prefix):]
+    return path
+
+
+def _moved(path, placeholder, prefix):
+    if path.startswith(placeholder):
+        return prefix + path[len(placeholder):]
+    return path
+
+
+def relative_result(result, document_xpath, activity_path, sourceline):
+    '''Return the result of `ActivityChecks.check` for a child, relative to the child'''
+    result = json.loads(json.dumps(result))
+    for error in result['schema_errors']:
+        error['path'] = _relative(error['path'], document_xpath, ACTIVITY_XPATH)
+        error['line'] -= sourceline
+    for invalid_values in result['invalid_codelist_values']:
+        for invalid_value in invalid_values:
+            invalid_value['xpath'] = _relative(invalid_value['xpath'], document_xpath, ACTIVITY_XPATH)
+            invalid_value['path'] = _relative(invalid_value['path'], activity_path, ACTIVITY_PATH)
+    for errors in result['rulesets'].values():
+        for error in errors:
+            error['path'] = ' & '.join(_relative(path, document_xpath, ACTIVITY_XPATH)
+                                       for path in error['path'].split(' & '))
+    return result
+
+
+def moved_result(result, document_xpath, activity_path, sourceline):
+    '''Return a result from `relative_result` for the child with document_xpath, activity_path and sourceline'''
+    for error in result['schema_errors']:
+        error['path'] = _moved(error['path'], ACTIVITY_XPATH, document_xpath)
+        error['line'] += sourceline
+    for invalid_values in result['invalid_codelist_values']:
+        for invalid_value in invalid_values:
+            invalid_value['xpath'] = _moved(invalid_value['xpath'], ACTIVITY_XPATH, document_xpath)
+            invalid_value['path'] = _moved(invalid_value['path'], ACTIVITY_PATH, activity_path)
+    for errors in result['rulesets'].values():
+        for error in errors:
+            error['path'] = ' & '.join(_moved(path, ACTIVITY_XPATH, document_xpath)
+                                       for path in error['path'].split(' & '))
+    return result
+
+
+class ActivityResultStore():
+    '''Results of `ActivityChecks.check`, keyed by `activity_fingerprint`, in an SQLite database.
+
+    The store is shared by every process. New results, and when results were last used, are
+    written by `flush`, which then removes the least recently used results beyond max_entries.
+    '''
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.pending = {}
+        self.used = set()
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS activity_results '
+                               '(key TEXT PRIMARY KEY, result TEXT NOT NULL, used REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS activity_results_used ON activity_results (used)')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        result = self.pending.get(key)
+        if result is None:
+            row = self.connection.execute('SELECT result FROM activity_results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            result = row[0]
+        self.used.add(key)
+        return json.loads(result)
+
+    def put(self, key, result):
+        self.pending[key] = json.dumps(result, separators=(',', ':'))
+
+    def flush(self):
+        if not self.pending and not self.used:
+            return
+        now = time.time()
+        with self.connection as connection:
+            connection.executemany('INSERT OR REPLACE INTO activity_results (key, result, used) VALUES (?, ?, ?)',
+                                   [(key, result, now) for key, result in self.pending.items()])
+            connection.executemany('UPDATE activity_results SET used = ? WHERE key = ?',
+                                   [(now, key) for key in self.used - set(self.pending)])
+            if self.pending:
+                count = connection.execute('SELECT COUNT(*) FROM activity_results').fetchone()[0]
+                if count > self.max_entries:
+                    connection.execute('DELETE FROM activity_results WHERE key IN '
+                                       '(SELECT key FROM activity_results ORDER BY used LIMIT ?)',
+                                       (count - self.max_entries,))
+        self.pending = {}
+        self.used = set()
+
+
+def activity_result_store():
+    return ActivityResultStore(settings.ACTIVITY_RESULT_STORE_PATH, settings.ACTIVITY_RESULT_STORE_MAX_ENTRIES)
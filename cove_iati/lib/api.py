@@ -3,7 +3,10 @@ import json
 import shutil
 
 from .iati import common_checks_context_iati, get_file_type, get_tree
+from .result_cache import cached_checks
 from .schema import SchemaIATI
+from .stream import use_streaming
+from .timing import record_timings, timed
 from libcove.lib.converters import convert_spreadsheet
 from libcove.config import LibCoveConfig
 from cove_iati.settings import COVE_CONFIG
@@ -30,7 +33,21 @@ def context_api_transform(context):
     return context
 
 
-def iati_json_output(output_dir, file, openag=False, orgids=False):
+def iati_json_output(output_dir, file, openag=False, orgids=False, timings=False, result_cache=True):
+    '''Run the checks for file and return the API/command line output.
+
+    With `timings=True` the output has a `timings` block, with the times of each stage of the
+    checks (see `cove_iati.lib.timing`). With `result_cache=False` the checks are run even if
+    the results for the same file are cached (see `cove_iati.lib.result_cache`).
+    '''
+    with record_timings() as stage_timings:
+        context = _iati_json_output(output_dir, file, openag=openag, orgids=orgids, result_cache=result_cache)
+    if timings:
+        context['timings'] = stage_timings
+    return context
+
+
+def _iati_json_output(output_dir, file, openag=False, orgids=False, result_cache=True):
     context = {}
     file_type = get_file_type(file)
     context = {"file_type": file_type}
@@ -41,21 +58,27 @@ def iati_json_output(output_dir, file, openag=False, orgids=False):
 
     if file_type != 'xml':
         schema_iati = SchemaIATI()
-        context.update(convert_spreadsheet(output_dir, '', file, file_type, lib_cove_config,
-            cache=False, xml=True, xml_schemas=[
-                schema_iati.activity_schema,
-                schema_iati.organisation_schema,
-                schema_iati.common_schema,
-            ]))
+        with timed('convert_spreadsheet'):
+            context.update(convert_spreadsheet(output_dir, '', file, file_type, lib_cove_config,
+                cache=False, xml=True, xml_schemas=[
+                    schema_iati.activity_schema,
+                    schema_iati.organisation_schema,
+                    schema_iati.common_schema,
+                ]))
         data_file = context['converted_path']
     else:
         data_file = file
 
-    tree = get_tree(data_file)
-    context = context_api_transform(
-        common_checks_context_iati(context, output_dir, data_file, file_type, tree,
-                                   api=True, openag=openag, orgids=orgids)
-    )
+    def check():
+        tree = None if use_streaming(data_file) else get_tree(data_file)
+        return common_checks_context_iati({}, output_dir, data_file, file_type, tree,
+                                          api=True, openag=openag, orgids=orgids)
+
+    if result_cache:
+        context.update(cached_checks(file, file_type, check, api=True, openag=openag, orgids=orgids))
+    else:
+        context.update(check())
+    context = context_api_transform(context)
 
     if file_type != 'xml':
         # Remove unwanted files in the output
@@ -66,12 +89,4 @@ def iati_json_output(output_dir, file, openag=False, orgids=False):
         if file_type == 'csv':
             shutil.rmtree(os.path.join(output_dir, 'csv_dir'))
 
-    ruleset_dirs = [os.path.join(output_dir, 'ruleset'),
-                    os.path.join(output_dir, 'ruleset_org_regex'),
-                    os.path.join(output_dir, 'ruleset_openag'),
-                    os.path.join(output_dir, 'ruleset_orgids')]
-    for directory in ruleset_dirs:
-        if os.path.exists(directory):
-            shutil.rmtree(directory)
-
     return context
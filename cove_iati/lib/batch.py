@@ -0,0 +1,198 @@
+'''
+Check many files in one command, in one process or a pool of them.
+
+Running `iati_cli` for each file sets up Django, compiles the schemas and rulesets and loads
+the codelists every time. `run_batch` does that once (`warm_up`) in each process that checks
+files, rather than for every file. Worker processes are spawned rather than forked, as
+`warm_up` starts threads (e.g. fetching schemas and codelists) whose locks and connections a
+fork could copy mid-use. Each file's output is written to its own directory, as `iati_cli`
+would write it, and `summary` adds up the results of every file.
+'''
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
+from django.conf import settings
+from libcove.lib.exceptions import CoveInputDataError
+from cove.management.commands.base_command import SetEncoder
+
+from .api import APIException, iati_json_output
+from .iati import IATI_RULESET, OPENAG_RULESET, ORG_REGEX_RULESET, ORGIDS_RULESET
+from .org_registry import org_registry_store, orgids_prefix_trie
+from .process_codelists import embedded_codelists, non_embedded_codelists
+from .schema import SchemaIATI, warm_schema_cache
+from cove_iati.rulesets.engine import compile_ruleset
+
+logger = logging.getLogger(__name__)
+
+# Settings that spawned worker processes are given, as they may have been changed since the
+# settings module was loaded
+WORKER_SETTINGS = (
+    'IATI_SCHEMA_VERSIONS', 'CODELIST_SNAPSHOT_DIR', 'RESULT_CACHE_DIR', 'RESULT_CACHE_MAX_BYTES',
+    'INCREMENTAL_CHECKS', 'ACTIVITY_RESULT_STORE_PATH', 'ACTIVITY_RESULT_STORE_MAX_ENTRIES', 'ERROR_EXAMPLES_LIMIT',
+)
+
+INPUT_EXTENSIONS = ('.xml', '.xlsx', '.ods', '.csv')
+
+
+def batch_inputs(paths=(), manifest=None):
+    '''Return the files to check, in order and without duplicates.
+
+    paths can be files or directories, which are searched (with their subdirectories) for
+    files with an `INPUT_EXTENSIONS` extension. manifest is a file listing a path on each line,
+    relative to the manifest, with blank lines and lines starting with `#` left out.
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                files += [os.path.join(dirpath, filename) for filename in sorted(filenames)
+                          if filename.lower().endswith(INPUT_EXTENSIONS)]
+        else:
+            files.append(path)
+    if manifest:
+        manifest_dir = os.path.dirname(manifest)
+        with open(manifest) as fp:
+            for line in fp:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    files.append(os.path.join(manifest_dir, line))
+    return list(dict.fromkeys(files))
+
+
+def output_dirs(files, output_dir):
+    '''Return a directory in output_dir for each file, named after the file and different for every file'''
+    names = set()
+    dirs = []
+    for file in files:
+        name = base_name = os.path.splitext(os.path.basename(file))[0]
+        suffix = 1
+        while name in names:
+            suffix += 1
+            name = '{}-{}'.format(base_name, suffix)
+        names.add(name)
+        dirs.append(os.path.join(output_dir, name))
+    return dirs
+
+
+def warm_up(openag=False, orgids=False):
+    '''Compile the schemas and rulesets and load the codelists and org registry, as checking a file would'''
+    warm_schema_cache()
+    schema_iati = SchemaIATI()
+    embedded_codelists(schema_iati.schema_directory)
+    non_embedded_codelists(schema_iati.schema_directory)
+    feature_dirs = [IATI_RULESET, ORG_REGEX_RULESET]
+    if openag:
+        feature_dirs.append(OPENAG_RULESET)
+    if orgids:
+        feature_dirs.append(ORGIDS_RULESET)
+        orgids_prefix_trie()
+    for feature_dir in feature_dirs:
+        compile_ruleset(feature_dir)
+    try:
+        org_registry_store.get()
+    except requests.RequestException:
+        # each file's org refs report the error
+        pass
+
+
+def check_file(file, output_dir, openag=False, orgids=False, timings=False, exclude_file=False):
+    '''Check file, writing its output to output_dir, and return a summary of the results
+
+    Files that can't be checked are reported in the summary rather than raising an exception,
+    so one bad file doesn't stop the rest being checked.
+    '''
+    start = time.perf_counter()
+    entry = {'file': file, 'output_dir': output_dir}
+    try:
+        os.makedirs(output_dir)
+        if not exclude_file:
+            shutil.copy2(file, output_dir)
+        result = iati_json_output(output_dir, file, openag=openag, orgids=orgids, timings=timings)
+        with open(os.path.join(output_dir, 'results.json'), 'w+') as result_file:
+            json.dump(result, result_file, indent=2, cls=SetEncoder)
+    except APIException as e:
+        entry.update({'status': 'error', 'error': str(e)})
+    except CoveInputDataError as e:
+        entry.update({'status': 'error', 'error': 'Not well formed XML: %s' % str(e.context['error'])})
+    except Exception as e:
+        logger.exception('Could not check %s', file)
+        entry.update({'status': 'error', 'error': '{}: {}'.format(type(e).__name__, e)})
+    else:
+        entry.update({'status': 'ok'})
+        entry.update(result_counts(result))
+    entry['wall_time'] = time.perf_counter() - start
+    return entry
+
+
+def result_counts(result):
+    '''Return the number of each kind of error in the output of `iati_json_output`
+
+    The numbers are from its `error_counts`, as the output only has the first errors of each kind.
+    '''
+    def total(counts):
+        if isinstance(counts, dict):
+            return sum(total(count) for count in counts.values())
+        return counts
+
+    error_counts = result['error_counts']
+    counts = {
+        'validation_errors': total(error_counts['validation_errors']),
+        'invalid_embedded_codelist_values': total(error_counts['invalid_embedded_codelist_values']),
+        'invalid_non_embedded_codelist_values': total(error_counts['invalid_non_embedded_codelist_values']),
+    }
+    for key in ('ruleset_errors', 'org_ruleset_errors', 'ruleset_errors_openag', 'ruleset_errors_orgids'):
+        if result.get(key) is not None:
+            counts[key] = total(error_counts.get(key, {}))
+    return counts
+
+
+def _init_worker(worker_settings, openag, orgids):
+    import django
+    django.setup()
+    for name, value in worker_settings.items():
+        setattr(settings, name, value)
+    # files are already checked in parallel
+    settings.PARALLEL_CHECKS_PROCESSES = 0
+    warm_up(openag=openag, orgids=orgids)
+
+
+def run_batch(files, output_dir, processes=1, **options):
+    '''Check each of files, yielding the summary of each in order as it is checked
+
+    With processes greater than 1, files are checked in that many spawned worker processes,
+    which each run `warm_up` when they start. options are passed to `check_file`.
+    '''
+    openag, orgids = options.get('openag', False), options.get('orgids', False)
+    dirs = output_dirs(files, output_dir)
+    if processes <= 1:
+        warm_up(openag=openag, orgids=orgids)
+        for file, file_output_dir in zip(files, dirs):
+            yield check_file(file, file_output_dir, **options)
+        return
+
+    worker_settings = {name: getattr(settings, name) for name in WORKER_SETTINGS}
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker,
+                             initargs=(worker_settings, openag, orgids)) as executor:
+        futures = [executor.submit(check_file, file, file_output_dir, **options)
+                   for file, file_output_dir in zip(files, dirs)]
+        for future in futures:
+            yield future.result()
+
+
+def summary(entries, wall_time):
+    '''Return the summary of a batch, with the entries from `run_batch`'''
+    totals = {'files': len(entries), 'ok': 0, 'error': 0}
+    for entry in entries:
+        totals[entry['status']] += 1
+        for key, value in entry.items():
+            if isinstance(value, int) and key != 'wall_time':
+                totals[key] = totals.get(key, 0) + value
+    totals['wall_time'] = wall_time
+    return {'totals': totals, 'files': entries}
@@ -0,0 +1,82 @@
+'''
+Keep only the first examples of each kind of error, and count them all.
+
+A mistake made in every activity of a file is reported once for each activity, so a big file
+can have hundreds of thousands of the same error. Every error is counted, but only the first
+settings.ERROR_EXAMPLES_LIMIT of each kind (each schema validation message, each codelist path
+and each ruleset rule) are kept, so the results stored and shown for a file stay the same size
+however often a mistake is repeated.
+'''
+from django.conf import settings
+
+
+def error_examples_limit():
+    '''Return the number of examples to keep of each kind of error, or None to keep them all'''
+    return settings.ERROR_EXAMPLES_LIMIT or None
+
+
+class ErrorExamples():
+    '''Count errors of each kind (any hashable key), keeping the first `limit` of each in `examples`.
+
+    Examples are kept in the order they were added.
+    '''
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.examples = []
+        self.counts = {}
+
+    def count(self, key):
+        '''Count an error of kind key, and return whether it should be kept'''
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        return self.limit is None or count < self.limit
+
+    def add(self, key, error):
+        if self.count(key):
+            self.examples.append(error)
+
+    def extend(self, errors, key):
+        '''Add errors, getting the kind of each with key(error)'''
+        for error in errors:
+            self.add(key(error), error)
+
+
+def ruleset_error_kind(error):
+    return error['ruleset'], error['rule']
+
+
+def codelist_error_kind(invalid_codelist_value):
+    return invalid_codelist_value['codelist_path']
+
+
+def ruleset_counts(counts):
+    '''Return {ruleset: {rule: count}} for counts by `ruleset_error_kind`'''
+    nested = {}
+    for (ruleset, rule), count in counts.items():
+        nested.setdefault(ruleset, {})[rule] = count
+    return nested
+
+
+def ruleset_error_examples(error_examples):
+    '''Return (examples, {ruleset: {rule: count}}) for the `ErrorExamples` of a ruleset run
+
+    The `return_on_error` value of a ruleset run that raised is returned unchanged, with no counts.
+    '''
+    if not isinstance(error_examples, ErrorExamples):
+        return error_examples, {}
+    return error_examples.examples, ruleset_counts(error_examples.counts)
+
+
+def is_truncated(error_counts, limit):
+    '''Return whether any kind of error in `error_counts` (as built by `common_checks_context_iati`) has more than limit'''
+    if limit is None:
+        return False
+
+    def counts(value):
+        if isinstance(value, dict):
+            for item in value.values():
+                yield from counts(item)
+        else:
+            yield value
+
+    return any(count > limit for count in counts(error_counts))
@@ -1,58 +1,91 @@
 import json
 import os
 import re
+import threading
+from collections import namedtuple
+from copy import deepcopy
 
 import defusedxml.lxml as etree
 import lxml.etree
 import requests
-from bdd_tester import bdd_tester
 from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 from libcove.lib.exceptions import CoveInputDataError
 from libcove.lib.tools import ignore_errors
 
 from cove_iati.lib.exceptions import UnrecognisedFileTypeXML
-from cove_iati.lib.process_codelists import invalid_embedded_codelist_values, invalid_non_embedded_codelist_values
-from .schema import SchemaIATI
+from cove_iati.lib.process_codelists import (
+    CodelistChecker, ElementPath, embedded_codelists, invalid_all_codelist_values, non_embedded_codelists
+)
+from cove_iati.rulesets.engine import apply_ruleset, check_activity, compile_ruleset
+from .activity_results import (
+    activity_fingerprint, activity_result_config_key, activity_result_store, moved_result, relative_result
+)
+from .error_examples import (
+    ErrorExamples, error_examples_limit, is_truncated, ruleset_counts, ruleset_error_examples, ruleset_error_kind
+)
+from .org_registry import org_registry_store
+from .schema import compiled_schema, schema_registry
+from .stream import DocumentPaths, get_root_start, iter_root_children, nodes_at_end, nodes_before
+from .timing import add_timings, timed
 from django.conf import settings
 
 
+def xml_input_data_error(err):
+    '''Return the error shown for a file that can't be parsed as XML'''
+    if isinstance(err, UnicodeDecodeError):
+        msg = _(format_html('We think you tried to upload a XML file, but the encoding is incorrect.'
+                '\n\n<span class="glyphicon glyphicon-exclamation-sign" aria-hidden="true">'
+                '</span> <strong>Error message:</strong> {}', err))
+    else:
+        msg = _(format_html('We think you tried to upload a XML file, but it is not well formed XML.'
+                '\n\n<span class="glyphicon glyphicon-exclamation-sign" aria-hidden="true">'
+                '</span> <strong>Error message:</strong> {}', err))
+    return CoveInputDataError(context={
+        'sub_title': _("Sorry, we can't process that data"),
+        'link': 'index',
+        'link_text': _('Try Again'),
+        'msg': msg,
+        'error': format(err)
+    })
+
+
 def get_tree(data_file):
-    with open(data_file, 'rb') as fp:
+    with timed('get_tree'), open(data_file, 'rb') as fp:
         try:
             tree = etree.parse(fp)
-        except lxml.etree.XMLSyntaxError as err:
-            raise CoveInputDataError(context={
-                'sub_title': _("Sorry, we can't process that data"),
-                'link': 'index',
-                'link_text': _('Try Again'),
-                'msg': _(format_html('We think you tried to upload a XML file, but it is not well formed XML.'
-                         '\n\n<span class="glyphicon glyphicon-exclamation-sign" aria-hidden="true">'
-                         '</span> <strong>Error message:</strong> {}', err)),
-                'error': format(err)
-            })
-        except UnicodeDecodeError as err:
-            raise CoveInputDataError(context={
-                'sub_title': _("Sorry, we can't process that data"),
-                'link': 'index',
-                'link_text': _('Try Again'),
-                'msg': _(format_html('We think you tried to upload a XML file, but the encoding is incorrect.'
-                         '\n\n<span class="glyphicon glyphicon-exclamation-sign" aria-hidden="true">'
-                         '</span> <strong>Error message:</strong> {}', err)),
-                'error': format(err)
-            })
+        except (lxml.etree.XMLSyntaxError, UnicodeDecodeError) as err:
+            raise xml_input_data_error(err)
         return tree
 
 
 def common_checks_context_iati(context, upload_dir, data_file, file_type, tree, api=False, openag=False, orgids=False):
     '''TODO: this function is trying to do too many things. Separate some
     of its logic into smaller functions doing one single thing each.
+
+    If tree is None, the checks, including schema validation, are streamed from
+    data_file (see `stream_checks`) rather than run over a tree held in memory.
+
+    The data is checked against the schema for its version (see `SchemaRegistry`).
+
+    Only the first settings.ERROR_EXAMPLES_LIMIT errors of each kind are kept, but every error
+    is counted in `error_counts` (see `cove_iati.lib.error_examples`).
     '''
-    schema_iati = SchemaIATI()
     cell_source_map = {}
-    validation_errors_path = os.path.join(upload_dir, 'validation_errors-3.json')
+    validation_errors_path = os.path.join(upload_dir, 'validation_errors-4.json')
+    limit = error_examples_limit()
+
+    streaming = tree is None
+    if streaming:
+        try:
+            root_tag, root_attrib = get_root_start(data_file)
+        except (lxml.etree.XMLSyntaxError, UnicodeDecodeError) as err:
+            raise xml_input_data_error(err)
+    else:
+        root_tag, root_attrib = tree.getroot().tag, tree.getroot().attrib
+    schema_iati = schema_registry.get(root_attrib.get('version'))
 
-    if tree.getroot().tag == 'iati-organisations':
+    if root_tag == 'iati-organisations':
         schema_path = schema_iati.organisation_schema
         schema_name = 'Organisation'
         # rulesets don't support orgnisation files properly yet
@@ -62,147 +95,600 @@ def common_checks_context_iati(context, upload_dir, data_file, file_type, tree,
         schema_path = schema_iati.activity_schema
         schema_name = 'Activity'
         ruleset_disabled = False
-    errors_all, invalid_data = validate_against_schema(schema_path, tree)
 
     return_on_error = [{'message': 'There was a problem running ruleset checks',
                         'exception': True}]
 
-    # Validation errors
     if file_type != 'xml':
         with open(os.path.join(upload_dir, 'cell_source_map.json')) as cell_source_map_fp:
             cell_source_map = json.load(cell_source_map_fp)
-    if os.path.exists(validation_errors_path):
-        with open(validation_errors_path) as validation_error_fp:
-            validation_errors = json.load(validation_error_fp)
-    else:
-        validation_errors = get_xml_validation_errors(errors_all, file_type, cell_source_map)
-        if not api:
-            with open(validation_errors_path, 'w+') as validation_error_fp:
-                validation_error_fp.write(json.dumps(validation_errors))
 
-    # Ruleset errors
-    if ruleset_disabled:
-        ruleset_errors = None
-        org_ruleset_errors = None
+    rulesets = {}
+    if not ruleset_disabled:
+        rulesets['ruleset_errors'] = IATI_RULESET
+        rulesets['org_ruleset_errors'] = ORG_REGEX_RULESET
+    if openag:
+        rulesets['ruleset_errors_openag'] = OPENAG_RULESET
+    if orgids:
+        rulesets['ruleset_errors_orgids'] = ORGIDS_RULESET
+
+    if streaming:
+        # Schema validation is streamed too, so whether the data is valid
+        # is only known once every other check has run
+        with timed('stream_checks'):
+            checks = stream_checks(
+                data_file,
+                schema_path,
+                schema_iati.version,
+                schema_iati.codelist_directory,
+                cell_source_map if file_type != 'xml' else None,
+                rulesets,
+                return_on_error=return_on_error
+            )
+        errors_all = checks['errors_all']
     else:
-        ruleset_errors = get_iati_ruleset_errors(
+        with timed('validate_against_schema'):
+            errors_all, invalid_data = validate_against_schema(schema_path, tree, schema_iati.version)
+        checks = tree_checks(
             tree,
-            os.path.join(upload_dir, 'ruleset'),
-            api=api,
+            upload_dir,
+            schema_iati.codelist_directory,
+            cell_source_map if file_type != 'xml' else None,
+            rulesets,
             ignore_errors=invalid_data,
             return_on_error=return_on_error
         )
-        org_ruleset_errors = get_iati_ruleset_errors(
-            tree,
-            os.path.join(upload_dir, 'ruleset_org_regex'),
-            api=api,
-            ignore_errors=invalid_data,
-            return_on_error=return_on_error,
-            feature_dir='cove_iati/rulesets/iati_org_regex_ruleset/'
-        )
 
+    # Validation errors
+    if os.path.exists(validation_errors_path):
+        with open(validation_errors_path) as validation_error_fp:
+            saved_validation_errors = json.load(validation_error_fp)
+        validation_errors = saved_validation_errors['validation_errors']
+        validation_error_counts = saved_validation_errors['counts']
+    else:
+        validation_errors, validation_error_counts = validation_error_examples(
+            errors_all, file_type, cell_source_map, limit)
+        if not api:
+            with open(validation_errors_path, 'w+') as validation_error_fp:
+                validation_error_fp.write(json.dumps({
+                    'validation_errors': validation_errors,
+                    'counts': validation_error_counts
+                }))
+
+    ruleset_errors = checks['rulesets'].get('ruleset_errors')
+    org_ruleset_errors = checks['rulesets'].get('org_ruleset_errors')
     if openag:
-        ruleset_errors_ag = get_openag_ruleset_errors(
-            tree,
-            os.path.join(upload_dir, 'ruleset_openang'),
-            ignore_errors=invalid_data,
-            return_on_error=return_on_error
-        )
-        context.update({'ruleset_errors_openag': ruleset_errors_ag})
+        context.update({'ruleset_errors_openag': checks['rulesets']['ruleset_errors_openag']})
     if orgids:
-        ruleset_errors_orgids = get_orgids_ruleset_errors(
-            tree,
-            os.path.join(upload_dir, 'ruleset_orgids'),
-            ignore_errors=invalid_data,
-            return_on_error=return_on_error
-        )
-        context.update({'ruleset_errors_orgids': ruleset_errors_orgids})
+        context.update({'ruleset_errors_orgids': checks['rulesets']['ruleset_errors_orgids']})
 
     # Org Ref analysis.
-    context['org_refs'] = {}
-    if tree.getroot().tag != 'iati-organisations':
-        context['org_refs'] = check_activity_org_refs(tree)
+    context['org_refs'] = checks['org_refs']
+
+    context['error_counts'] = {
+        'validation_errors': validation_error_counts,
+        'invalid_embedded_codelist_values': checks['embedded_codelist_counts'],
+        'invalid_non_embedded_codelist_values': checks['non_embedded_codelist_counts'],
+    }
+    context['error_counts'].update(checks['ruleset_counts'])
 
     context.update({
         'validation_errors': sorted(validation_errors.items()),
         'ruleset_errors': ruleset_errors,
         'org_ruleset_errors': org_ruleset_errors,
         'file_type': file_type,
-        'invalid_embedded_codelist_values': invalid_embedded_codelist_values(
-            schema_iati.schema_directory,
-            data_file,
-            os.path.join(upload_dir, 'cell_source_map.json') if file_type != 'xml' else None
-        ),
-        'invalid_non_embedded_codelist_values': invalid_non_embedded_codelist_values(
-            schema_iati.schema_directory,
-            data_file,
-            os.path.join(upload_dir, 'cell_source_map.json') if file_type != 'xml' else None
-        )
+        'invalid_embedded_codelist_values': checks['invalid_embedded_codelist_values'],
+        'invalid_non_embedded_codelist_values': checks['invalid_non_embedded_codelist_values']
     })
 
     if not api:
         context.update({
-            'validation_errors_count': sum(len(value) for value in validation_errors.values()),
+            'validation_errors_count': sum(validation_error_counts.values()),
+            'error_examples_limit': limit,
+            'error_examples_truncated': is_truncated(context['error_counts'], limit),
             'cell_source_map': cell_source_map,
             'first_render': False,
             'schema_name': schema_name,
-            'ruleset_disabled': ruleset_disabled
+            'ruleset_disabled': ruleset_disabled,
+            'iati_identifiers_count': checks['iati_identifiers_count'],
+            'organisation_identifier_count': checks['organisation_identifier_count'],
         })
-        if ruleset_errors:
-            ruleset_errors_by_activity = get_iati_ruleset_errors(
+        # Each ruleset runs once; both tables are grouped from the same flat errors
+        context['ruleset_errors'] = _group_ruleset_errors(ruleset_errors)
+        context['org_ruleset_errors'] = _group_ruleset_errors(org_ruleset_errors)
+        context['ruleset_errors_count'] = _count_ruleset_errors(
+            ruleset_errors, checks['ruleset_counts'].get('ruleset_errors'))
+        context['org_ruleset_errors_count'] = _count_ruleset_errors(
+            org_ruleset_errors, checks['ruleset_counts'].get('org_ruleset_errors'))
+
+        if context['org_refs']:
+            context['total_org_error_count'] = context['org_refs']['not_found_orgs_count'] + context['org_ruleset_errors_count']
+
+    return context
+
+
+RULESET_OUTPUT_DIRS = {
+    'ruleset_errors': 'ruleset',
+    'org_ruleset_errors': 'ruleset_org_regex',
+    'ruleset_errors_openag': 'ruleset_openang',
+    'ruleset_errors_orgids': 'ruleset_orgids',
+}
+
+
+def tree_checks(tree, upload_dir, schema_directory, cell_source_map, rulesets, ignore_errors=False,
+                return_on_error=None):
+    '''Run the rulesets (a dict of context key to feature directory), org ref, codelist and
+    identifier count checks over a tree
+
+    Only the first `error_examples_limit()` ruleset errors for each rule and invalid values for
+    each codelist path are kept, with the number of each in ruleset_counts and codelist_counts.
+    '''
+    root_tag = tree.getroot().tag
+    limit = error_examples_limit()
+    checks = {'rulesets': {}, 'ruleset_counts': {}}
+
+    for key, feature_dir in rulesets.items():
+        with timed('ruleset {}'.format(os.path.basename(feature_dir.rstrip('/')))):
+            error_examples = get_ruleset_error_examples(
                 tree,
-                os.path.join(upload_dir, 'ruleset'),
-                group_by='activity',
-                ignore_errors=invalid_data,
+                os.path.join(upload_dir, RULESET_OUTPUT_DIRS[key]),
+                feature_dir,
+                limit=limit,
+                ignore_errors=ignore_errors,
                 return_on_error=return_on_error
             )
-            context['ruleset_errors'] = [ruleset_errors, ruleset_errors_by_activity]
+        checks['rulesets'][key], checks['ruleset_counts'][key] = ruleset_error_examples(error_examples)
 
-        if org_ruleset_errors:
-            org_ruleset_errors_by_activity = get_iati_ruleset_errors(
-                tree,
-                os.path.join(upload_dir, 'ruleset_org_regex'),
-                group_by='activity',
-                ignore_errors=invalid_data,
-                return_on_error=return_on_error,
-                feature_dir='cove_iati/rulesets/iati_org_regex_ruleset/'
-            )
-            context['org_ruleset_errors'] = [org_ruleset_errors, org_ruleset_errors_by_activity]
+    with timed('collect_activity_refs'):
+        activity_refs = tree_activity_refs(tree)
 
-        count_ruleset_errors = 0
-        if isinstance(ruleset_errors, dict):
-            for rules in ruleset_errors.values():
-                for errors in rules.values():
-                    count_ruleset_errors += len(errors)
+    checks['org_refs'] = {}
+    if root_tag != 'iati-organisations':
+        with timed('check_activity_org_refs'):
+            checks['org_refs'] = check_activity_org_refs(tree, activity_refs)
 
-        context['ruleset_errors_count'] = count_ruleset_errors
+    with timed('codelists'):
+        embedded, non_embedded = invalid_all_codelist_values(schema_directory, tree, cell_source_map, limit)
+    checks['invalid_embedded_codelist_values'] = embedded.examples
+    checks['invalid_non_embedded_codelist_values'] = non_embedded.examples
+    checks['embedded_codelist_counts'] = embedded.counts
+    checks['non_embedded_codelist_counts'] = non_embedded.counts
 
-        count_org_ruleset_errors = 0
-        if isinstance(org_ruleset_errors, dict):
-            for rules in org_ruleset_errors.values():
-                for errors in rules.values():
-                    count_org_ruleset_errors += len(errors)
+    checks['iati_identifiers_count'] = iati_identifier_count(tree, activity_refs)
+    checks['organisation_identifier_count'] = organisation_identifier_count(tree)
+    return checks
 
-        context['org_ruleset_errors_count'] = count_org_ruleset_errors
 
-        if context['org_refs']:
-            context['total_org_error_count'] = context['org_refs']['not_found_orgs_count'] + context['org_ruleset_errors_count']
+class StreamedRuleset():
+    '''A ruleset checked one activity at a time.
 
-    return context
+    Errors are handled as `get_iati_ruleset_errors` does, except that whether the data is valid
+    (and so whether errors are ignored) is only known once the whole document has been read:
+    an error in a step stops the ruleset, and `result` raises it or returns return_on_error.
 
+    With a limit, only the first that many errors for each rule are kept, but all are counted.
+    '''
+    def __init__(self, limit=None):
+        self.error_examples = ErrorExamples(limit)
+        self.exception = None
+
+    def add(self, errors):
+        '''Add the errors in an activity, from `ActivityChecks`, or the exception raised checking it'''
+        if self.exception is not None:
+            return
+        if isinstance(errors, Exception):
+            self.exception = errors
+            return
+        self.error_examples.extend(errors, ruleset_error_kind)
+
+    def result(self, document_paths, ignore_errors=False, return_on_error=None):
+        if self.exception is not None:
+            if ignore_errors:
+                return return_on_error
+            raise self.exception
+        for error in self.error_examples.examples:
+            error['path'] = ' & '.join(document_paths.finalize(path) for path in error['path'].split(' & '))
+        return self.error_examples.examples
+
+    def counts(self):
+        '''Return {ruleset: {rule: count}}, as `ruleset_error_examples` does'''
+        if self.exception is not None:
+            return {}
+        return ruleset_counts(self.error_examples.counts)
+
+
+class ActivityChecks():
+    '''The checks in `stream_checks` that look at one child of the root element at a time.
+
+    They need nothing else from the document, so can run in other processes (see
+    `cove_iati.lib.parallel`), and everything they return can be pickled.
+
+    With a config_key (from `activity_result_config_key`), results are kept in an
+    `ActivityResultStore` and a child that has been checked before isn't checked again.
+    Results are written to the store, and the timings of the ruleset features added to the
+    timings of the checks, by `flush`.
+    '''
+    def __init__(self, root_tag, schema_path, schema_version, codelist_sets, cell_source_map, rulesets,
+                 config_key=None):
+        self.root_tag = root_tag
+        self.chunk_tag = ChunkedSchemaValidation.CHUNK_TAGS.get(root_tag)
+        self.schema = compiled_schema(schema_path, schema_version)
+        self.codelist_checker = CodelistChecker(codelist_sets, cell_source_map)
+        self.features = {key: compile_ruleset(feature_dir) for key, feature_dir in rulesets.items()}
+        self.failed_rulesets = set()
+        self.config_key = config_key
+        self.store = activity_result_store() if config_key else None
+        self.timings = {}
+
+    def check(self, child, document_paths, codelist_path):
+        '''Check a child of root, which is the current child of document_paths'''
+        if self.store is None:
+            return self._check(child, document_paths, codelist_path)
+
+        key = activity_fingerprint(self.config_key, child)
+        activity_path = codelist_path.attribute_path('')[:-len('/@')]
+        result = self.store.get(key)
+        if result is not None:
+            result = moved_result(result, document_paths.document_xpath, activity_path, child.sourceline)
+            # a ruleset stops at its first error, see `StreamedRuleset`
+            for ruleset_key in self.failed_rulesets:
+                result['rulesets'].pop(ruleset_key, None)
+            return result
+
+        result = self._check(child, document_paths, codelist_path)
+        # results without every ruleset can't be used again
+        if not self.failed_rulesets:
+            self.store.put(key, relative_result(result, document_paths.document_xpath, activity_path,
+                                                child.sourceline))
+        return result
+
+    def flush(self):
+        if self.store is not None:
+            self.store.flush()
+        add_timings(self.timings)
+        self.timings = {}
+
+    def _check(self, child, document_paths, codelist_path):
+        codelist_checker = self.codelist_checker
+        codelist_checker.reset()
+        codelist_checker.check_tree(child, document_paths.getpath, codelist_path)
+        result = {
+            'schema_errors': [],
+            'invalid_codelist_values': codelist_checker.invalid_codelist_values,
+            'rulesets': {},
+            'identifiers': [],
+            'org_refs': None,
+        }
 
-def validate_against_schema(schema_path, tree):
-    with open(schema_path) as schema_fp:
-        schema_tree = etree.parse(schema_fp)
+        if child.tag == 'iati-activity' and self.root_tag == 'iati-activities':
+            result['org_refs'] = collect_activity_refs(child)
+            result['identifiers'] = result['org_refs'].identifiers
+        elif child.tag == 'iati-organisation' and self.root_tag == 'iati-organisations':
+            result['identifiers'] = _organisation_identifiers(child)
 
-    schema = lxml.etree.XMLSchema(schema_tree)
-    schema.validate(tree)
-    lxml_errors = lxml_errors_generator(schema.error_log)
+        if child.tag == self.chunk_tag:
+            result['schema_errors'] = validate_child(self.schema, child, document_paths.document_xpath)
+
+        if child.tag == 'iati-activity':
+            for key, features in self.features.items():
+                # a ruleset stops at its first error, see `StreamedRuleset`
+                if key in self.failed_rulesets:
+                    continue
+                try:
+                    errors = check_activity(child, features, self.timings)
+                except (KeyError, TypeError, IndexError, AttributeError, ValueError) as err:
+                    self.failed_rulesets.add(key)
+                    result['rulesets'][key] = err
+                    continue
+                for error in errors:
+                    # some steps give the paths of two or more elements
+                    error['path'] = ' & '.join(document_paths.rewrite(path) for path in error['path'].split(' & '))
+                result['rulesets'][key] = errors
+
+        return result
+
+
+_organisation_identifiers = lxml.etree.XPath('organisation-identifier/text()', smart_strings=False)
+
+
+def stream_checks(data_file, schema_path, schema_version, schema_directory, cell_source_map, rulesets,
+                  return_on_error=None):
+    '''Validate data_file against a schema and run the same checks as `tree_checks`, streaming it one
+    child of its root element at a time.
+
+    Errors in rulesets are ignored if the data is invalid. The schema validation results are
+    returned as errors_all and invalid_data.
+
+    With settings.PARALLEL_CHECKS_PROCESSES, activities are checked in that many worker processes.
+    With settings.INCREMENTAL_CHECKS, activities checked before aren't checked again, except in
+    spreadsheets, whose errors refer to cells (see `cove_iati.lib.activity_results`).
+
+    Errors are limited and counted as in `tree_checks`, as the results for each activity are added.
+    '''
+    # parallel imports this module
+    from .parallel import ShardedActivityChecks
+
+    codelist_sets = [embedded_codelists(schema_directory), non_embedded_codelists(schema_directory)]
+    schema_validation = ChunkedSchemaValidation(schema_path, schema_version)
+    limit = error_examples_limit()
+    codelist_checker = CodelistChecker(codelist_sets, cell_source_map, limit)
+    streamed_rulesets = {key: StreamedRuleset(limit) for key in rulesets}
+    org_refs = None
+    identifiers = set()
+    activity_checks = None
+    sharded_activity_checks = None
+    config_key = None
+    if settings.INCREMENTAL_CHECKS and cell_source_map is None:
+        config_key = activity_result_config_key(schema_path, schema_version, rulesets)
+
+    def add_result(result):
+        # results are added in document order, however they were checked
+        schema_validation.add_errors(result['schema_errors'])
+        codelist_checker.add_invalid_values(result['invalid_codelist_values'])
+        for key, errors in result['rulesets'].items():
+            streamed_rulesets[key].add(errors)
+        identifiers.update(result['identifiers'])
+        if result['org_refs'] is not None:
+            org_refs.add_refs(result['org_refs'])
+
+    try:
+        for root, child in iter_root_children(data_file):
+            if child is None:
+                document_paths = DocumentPaths(root)
+                schema_validation.start(root)
+                root_path = ElementPath.root(root)
+                codelist_checker.check_element(root, root_path, None, document_paths.tree.getpath)
+                if root.tag != 'iati-organisations':
+                    org_refs = ActivityOrgRefs()
+                previous_tag, index = None, 0
+
+                activity_check_args = (root.tag, schema_path, schema_version, codelist_sets, cell_source_map, rulesets,
+                                       config_key)
+                if settings.PARALLEL_CHECKS_PROCESSES:
+                    sharded_activity_checks = ShardedActivityChecks(
+                        settings.PARALLEL_CHECKS_PROCESSES, settings.PARALLEL_CHECKS_SHARD_SIZE, activity_check_args,
+                        root)
+                else:
+                    activity_checks = ActivityChecks(*activity_check_args)
+                continue
+
+            # indexes in codelist paths count runs of siblings with the same tag
+            if child.tag == previous_tag:
+                index += 1
+            else:
+                previous_tag, index = child.tag, 0
+
+            document_paths.start_child(child)
+            schema_validation.add(child, document_paths, validate=False)
+            codelist_path = root_path.child(child.tag, index)
+            if sharded_activity_checks:
+                for result in sharded_activity_checks.add(child, document_paths.document_xpath, codelist_path):
+                    add_result(result)
+            else:
+                add_result(activity_checks.check(child, document_paths, codelist_path))
+
+        if sharded_activity_checks:
+            for result in sharded_activity_checks.finish():
+                add_result(result)
+        elif activity_checks:
+            activity_checks.flush()
+    except (lxml.etree.XMLSyntaxError, UnicodeDecodeError) as err:
+        raise xml_input_data_error(err)
+    finally:
+        if sharded_activity_checks:
+            sharded_activity_checks.close()
+
+    errors_all, invalid_data = schema_validation.result(document_paths)
+    invalid_embedded_codelist_values, invalid_non_embedded_codelist_values = codelist_checker.invalid_codelist_values
+    embedded_codelist_counts, non_embedded_codelist_counts = codelist_checker.codelist_counts
+    for invalid_codelist_value in invalid_embedded_codelist_values + invalid_non_embedded_codelist_values:
+        invalid_codelist_value['xpath'] = document_paths.finalize(invalid_codelist_value['xpath'])
+
+    return {
+        'errors_all': errors_all,
+        'invalid_data': invalid_data,
+        'rulesets': {key: streamed_ruleset.result(document_paths, invalid_data, return_on_error)
+                     for key, streamed_ruleset in streamed_rulesets.items()},
+        'ruleset_counts': {key: streamed_ruleset.counts() for key, streamed_ruleset in streamed_rulesets.items()},
+        'org_refs': org_refs.result() if org_refs else {},
+        'invalid_embedded_codelist_values': invalid_embedded_codelist_values,
+        'invalid_non_embedded_codelist_values': invalid_non_embedded_codelist_values,
+        'embedded_codelist_counts': embedded_codelist_counts,
+        'non_embedded_codelist_counts': non_embedded_codelist_counts,
+        'iati_identifiers_count': len(identifiers) if root.tag == 'iati-activities' else 0,
+        'organisation_identifier_count': len(identifiers) if root.tag == 'iati-organisations' else 0,
+    }
+
+
+# Compiled schemas are shared by every request in the process, but lxml keeps
+# the error log of the last validation on the schema object itself.
+_schema_validation_lock = threading.Lock()
+
+
+def validate_against_schema(schema_path, tree, version=None, chunked=False):
+    '''Validate a tree, returning (errors_all, invalid_data)
+
+    With chunked, the tree is validated one child of its root element at a time
+    (see `ChunkedSchemaValidation`), with the same result.
+    '''
+    if chunked:
+        root = tree.getroot()
+        document_paths = DocumentPaths(root)
+        validation = ChunkedSchemaValidation(schema_path, version)
+        validation.start(root)
+        for child in root.iterchildren(lxml.etree.Element):
+            document_paths.start_child(child)
+            validation.add(child, document_paths)
+        return validation.result(document_paths)
+
+    schema = compiled_schema(schema_path, version)
+    with _schema_validation_lock:
+        schema.validate(tree)
+        error_log = schema.error_log
+    lxml_errors = lxml_errors_generator(error_log)
     errors_all = format_lxml_errors(lxml_errors)
-    invalid_data = bool(schema.error_log)
+    invalid_data = bool(error_log)
     return errors_all, invalid_data
 
 
+class ChunkedSchemaValidation():
+    '''Validate a document against a schema one child of its root element at a time.
+
+    Each activity (or organisation) is validated on its own against the schema's global
+    declaration for it, as soon as it has been read. The root element is validated once, at
+    the end, with its attributes and other children but an empty stand-in for each activity,
+    which is enough to check which children it has and in what order.
+
+    Errors are rewritten to their paths in the whole document and put in the order that
+    validating the whole document reports them, so `result` matches `validate_against_schema`.
+    '''
+    CHUNK_TAGS = {
+        'iati-activities': 'iati-activity',
+        'iati-organisations': 'iati-organisation',
+    }
+
+    def __init__(self, schema_path, version=None):
+        self.schema = compiled_schema(schema_path, version)
+        self.root = None
+        self.wrapper = None
+        self.last_node = None
+        self.chunk_tag = None
+        self.child_lines = []
+        self.child_errors = []
+
+    def start(self, root):
+        self.root = root
+        self.chunk_tag = self.CHUNK_TAGS.get(root.tag)
+        self.wrapper = lxml.etree.Element(root.tag, dict(root.attrib), nsmap=root.nsmap)
+        self.wrapper.sourceline = min(root.sourceline, 65535)
+
+    def add(self, child, document_paths, validate=True):
+        '''Add a child of root, which is the current child of document_paths.
+
+        Without validate, the child's errors from `validate_child` are added with `add_errors`.
+        '''
+        self._append_nodes(*nodes_before(child))
+
+        # lxml can't set line numbers over 65535, so those in the wrapper are from the start of the child
+        self.child_lines.append(child.sourceline)
+        if child.tag == self.chunk_tag:
+            stand_in = lxml.etree.Element(child.tag)
+            stand_in.sourceline = 1
+            self._append(stand_in)
+            errors = validate_child(self.schema, child, document_paths.document_xpath)
+        else:
+            child_copy = deepcopy(child)
+            child_copy.tail = None
+            for element, element_copy in zip(child.iter(), child_copy.iter()):
+                element_copy.sourceline = min(element.sourceline - child.sourceline + 1, 65535)
+            self._append(child_copy)
+            errors = []
+        if validate:
+            self.child_errors.append(errors)
+
+    def add_errors(self, errors):
+        '''Add the errors in the next child of root, in the order they were added'''
+        self.child_errors.append(errors)
+
+    def result(self, document_paths):
+        '''Return (errors_all, invalid_data) as `validate_against_schema` does'''
+        self._append_nodes(*nodes_at_end(self.root))
+
+        # getpath counts siblings, so is only used once for each tag
+        wrapper_tree = self.wrapper.getroottree()
+        children = list(self.wrapper.iterchildren(lxml.etree.Element))
+        names = {}
+        counts = {}
+        child_indexes = {}
+        for index, child in enumerate(children):
+            if child.tag not in names:
+                names[child.tag] = wrapper_tree.getpath(child).rsplit('/', 1)[1].split('[', 1)[0]
+            name = names[child.tag]
+            counts[name] = counts.get(name, 0) + 1
+            child_indexes[name, counts[name]] = index
+        stand_ins = {index for index, child in enumerate(children) if child.tag == self.chunk_tag}
+
+        # text isn't allowed in root: each piece of it has an error, which goes with the child after it
+        texts = [(0, self.wrapper.text)]
+        index = 0
+        for node in self.wrapper:
+            if isinstance(node.tag, str):
+                index += 1
+            texts.append((index, node.tail))
+        text_indexes = iter([index for index, text in texts if text and text.strip()])
+
+        # errors from validating the wrapper, by child of root, the last being for the end of root
+        wrapper_child_errors = [[] for _ in range(len(children) + 1)]
+        root_errors_first, root_errors_last = [], []
+        for error in _validate(self.schema, self.wrapper):
+            index = self._child_index(child_indexes, error['path'])
+            if index is None:
+                # errors in the root's attributes come before its children's, others after them
+                if 'Character content' in error['message']:
+                    wrapper_child_errors[next(text_indexes, len(children))].append(error)
+                elif 'attribute' in error['message']:
+                    root_errors_first.append(error)
+                else:
+                    root_errors_last.append(error)
+            elif index not in stand_ins or 'This element is not expected' in error['message']:
+                error['line'] += self.child_lines[index] - 1
+                wrapper_child_errors[index].append(error)
+
+        lxml_errors = list(root_errors_first)
+        for wrapper_errors, errors in zip(wrapper_child_errors, self.child_errors + [[]]):
+            lxml_errors.extend(wrapper_errors)
+            if any('This element is not expected' in error['message'] for error in wrapper_errors):
+                # nothing after an unexpected child of root is validated
+                break
+            for error in errors:
+                error['path'] = document_paths.finalize(error['path'])
+                lxml_errors.append(error)
+        lxml_errors.extend(root_errors_last)
+        return format_lxml_errors(lxml_errors), bool(lxml_errors)
+
+    @staticmethod
+    def _child_index(child_indexes, path):
+        '''Return the index of the child of root that path is in, if any'''
+        segments = path.split('/', 3)
+        if len(segments) < 3:
+            return None
+        name, _, position = segments[2].partition('[')
+        return child_indexes.get((name, int(position[:-1]) if position else 1))
+
+    def _append(self, node):
+        self.wrapper.append(node)
+        self.last_node = node
+
+    def _append_nodes(self, text, nodes):
+        '''Copy the text, comments and processing instructions between children of root to the wrapper'''
+        if self.last_node is None:
+            self.wrapper.text = text
+        else:
+            self.last_node.tail = text
+        for node in nodes:
+            self._append(deepcopy(node))
+
+
+def _validate(schema, element):
+    with _schema_validation_lock:
+        schema.validate(element)
+        error_log = schema.error_log
+    return list(lxml_errors_generator(error_log))
+
+
+def validate_child(schema, child, document_xpath):
+    '''Validate a child of root as the root of a document of its own
+
+    This is what `ChunkedSchemaValidation` does for each activity. Error paths are
+    rewritten to start with document_xpath, the child's xpath in the whole document.
+    '''
+    prefix_length = len('/' + child.tag)
+    errors = _validate(schema, child)
+    for error in errors:
+        error['path'] = document_xpath + error['path'][prefix_length:]
+    return errors
+
+
 def lxml_errors_generator(schema_error_log):
     '''Yield dict with lxml error path and message
 
@@ -266,57 +752,49 @@ def format_lxml_errors(lxml_errors):
         }
 
 
-def get_zero_paths_list(cell_path):
-    '''Get all combinations of zeroes removed/not removed in a cell source path
+def remove_zero_indexes(path):
+    '''Remove every `0` index from a path, e.g. `a/0/b/1/c/0` becomes `a/b/1/c`'''
+    return '/'.join(segment for segment in path.split('/') if segment != '0')
 
-    Returns a list. The list doesn't include the original path.
 
-    e.g:
-        'path/0/to/1/cell/0/source' will produce:
+def is_path_with_zeros_removed(error_path, cell_path):
+    '''Check whether error_path is cell_path with some (or none) of its `0` indexes removed
 
-        ['path/1/to/1/cell/0/source',
-         'path/0/to/1/cell/1/source',
-         'path/to/1/cell/source']
+    lxml does not include path indexes for single item arrays, whereas cell source
+    paths do, so `path/to/cell` can be the error path for the cell `path/0/to/0/cell`.
     '''
-    cell_zero_indexes, cell_zero_combinations, zero_paths_list = [], [], []
-    cell_path_chars = cell_path.split('/')
-
-    for index, char in enumerate(cell_path_chars):
-        if char == '0':
-            cell_zero_indexes.append(index)
-
-    n_zeros = len(cell_zero_indexes)
-    for i in range(1, 2 ** n_zeros):
-        cell_zero_combinations.append(bin(i)[2:].zfill(n_zeros))
-
-    for bin_repr in cell_zero_combinations:
-        for index_bit in zip(cell_zero_indexes, bin_repr):
-            if index_bit[1] == '0':
-                cell_path_chars[index_bit[0]] = '0'
-            else:
-                cell_path_chars[index_bit[0]] = None
-        path = '/'.join(filter(bool, cell_path_chars))
-        zero_paths_list.append(path)
-
-    return zero_paths_list
-
-
-def error_path_source(error, cell_source_paths, cell_source_map, missing_zeros=False):
+    error_segments = error_path.split('/')
+    position = 0
+    for segment in cell_path.split('/'):
+        if position < len(error_segments) and segment == error_segments[position]:
+            position += 1
+        elif segment != '0':
+            return False
+    return position == len(error_segments)
+
+
+def get_cell_source_index(cell_source_map):
+    '''Index cell source paths by their path without `0` indexes, in cell_source_map order'''
+    cell_source_index = {}
+    for cell_path in cell_source_map:
+        cell_source_index.setdefault(remove_zero_indexes(cell_path), []).append(cell_path)
+    return cell_source_index
+
+
+def find_cell_path(error_path, cell_source_map, cell_source_index):
+    '''Return the cell source path for a validation error path, or None'''
+    if error_path in cell_source_map:
+        return error_path
+    for cell_path in cell_source_index.get(remove_zero_indexes(error_path), []):
+        if is_path_with_zeros_removed(error_path, cell_path):
+            return cell_path
+    return None
+
+
+def error_path_source(error, cell_path, cell_source_map):
     source = {}
-    found_path = None
 
-    if missing_zeros:
-        for cell_path in cell_source_paths:
-            if error['path'] in get_zero_paths_list(cell_path):
-                found_path = cell_path
-                break
-    else:
-        for cell_path in cell_source_paths:
-            if cell_path == error['path']:
-                found_path = cell_path
-                break
-
-    if found_path:
+    if cell_path:
         if len(cell_source_map[cell_path][0]) > 2:
             source = {
                 'sheet': cell_source_map[cell_path][0][0],
@@ -338,34 +816,36 @@ def error_path_source(error, cell_source_paths, cell_source_map, missing_zeros=F
 
 
 def get_xml_validation_errors(errors, file_type, cell_source_map):
+    return validation_error_examples(errors, file_type, cell_source_map)[0]
+
+
+def validation_error_examples(errors, file_type, cell_source_map, limit=None):
+    '''Return (validation errors grouped by message, {message: count})
+
+    With a limit, only the first that many errors with each message are kept.
+    '''
     validation_errors = {}
+    error_examples = ErrorExamples(limit)
     if file_type != 'xml':
-        cell_source_map_paths = {}
-        for cell_path in cell_source_map.keys():
-            generic_cell_path = re.sub(r'/\d+', '', cell_path)
-            if cell_source_map_paths.get(generic_cell_path):
-                cell_source_map_paths[generic_cell_path].append(cell_path)
-            else:
-                cell_source_map_paths[generic_cell_path] = [cell_path]
+        cell_source_index = get_cell_source_index(cell_source_map)
 
     for error in errors:
         validation_key = json.dumps({'message': error['message']}, sort_keys=True)
         if not validation_errors.get(validation_key):
             validation_errors[validation_key] = []
+        if not error_examples.count(error['message']):
+            continue
 
         if file_type != 'xml':
-            generic_error_path = re.sub(r'/\d+', '', error['path'])
-            cell_paths = cell_source_map_paths.get(generic_error_path, [])
-            source = error_path_source(error, cell_paths, cell_source_map)
-            if not source:
-                source = error_path_source(error, cell_paths, cell_source_map, missing_zeros=True)
+            cell_path = find_cell_path(error['path'], cell_source_map, cell_source_index)
+            source = error_path_source(error, cell_path, cell_source_map)
         else:
             source = {'path': error['path'], 'value': error['value']}
 
         source.update({'line': error['line']})
         validation_errors[validation_key].append(source)
 
-    return validation_errors
+    return validation_errors, error_examples.counts
 
 
 def format_ruleset_errors(output_dir):
@@ -392,6 +872,21 @@ def format_ruleset_errors(output_dir):
     return ruleset_errors
 
 
+def write_ruleset_errors(output_dir, ruleset_errors):
+    '''Write ruleset errors in the layout read by format_ruleset_errors'''
+    lines = {}
+    for error in ruleset_errors:
+        key = (error['rule'], error['id'], error['ruleset'])
+        lines.setdefault(key, []).append({'explanation': error['explanation'], 'path': error['path']})
+
+    if lines:
+        os.makedirs(output_dir, exist_ok=True)
+    for (rule, activity_id, ruleset), errors in lines.items():
+        output_file = '{}.output'.format(rule.replace('/', '.').replace(' ', '_'))
+        with open(os.path.join(output_dir, output_file), 'a') as fp:
+            fp.write(json.dumps({'errors': errors, 'id': activity_id, 'ruleset': ruleset}) + '\n')
+
+
 def _ruleset_errors_by_rule(flat_errors):
     ruleset_errors = {}
     for error in flat_errors:
@@ -418,43 +913,96 @@ def _ruleset_errors_by_activity(flat_errors):
     return ruleset_errors
 
 
+def _group_ruleset_errors(flat_errors):
+    '''Return [errors by rule, errors by activity] for a flat list of ruleset errors.
+
+    Empty results, and the `return_on_error` value of a ruleset run that raised,
+    are returned unchanged.
+    '''
+    if not flat_errors or flat_errors[0].get('exception'):
+        return flat_errors
+    return [_ruleset_errors_by_rule(flat_errors), _ruleset_errors_by_activity(flat_errors)]
+
+
+def _count_ruleset_errors(flat_errors, counts=None):
+    '''Return the number of ruleset errors, from counts ({ruleset: {rule: count}}) if given,
+    as flat_errors may only have the first errors for each rule'''
+    if not flat_errors or flat_errors[0].get('exception'):
+        return 0
+    if counts is None:
+        return len(flat_errors)
+    return sum(count for rule_counts in counts.values() for count in rule_counts.values())
+
+
+def run_ruleset(lxml_etree, output_dir, feature_dir, write_output=False, error_examples=None):
+    '''Run the ruleset in feature_dir over the data and return a flat list of errors.
+
+    With `write_output=True` the errors are also written into output_dir as one
+    JSON lines file per rule.
+
+    With error_examples, an `ErrorExamples`, the errors of each activity are added to it
+    as it's checked, and it's returned instead, so only the examples kept are held in memory.
+    '''
+    ruleset_errors = []
+
+    def add_errors(errors):
+        if error_examples is None:
+            ruleset_errors.extend(errors)
+        else:
+            error_examples.extend(errors, ruleset_error_kind)
+        if write_output:
+            write_ruleset_errors(output_dir, errors)
+
+    apply_ruleset(lxml_etree, feature_dir, add_errors)
+    if error_examples is None:
+        return ruleset_errors
+    return error_examples
+
+
+IATI_RULESET = 'cove_iati/rulesets/iati_standard_v2_ruleset/'
+ORG_REGEX_RULESET = 'cove_iati/rulesets/iati_org_regex_ruleset/'
+OPENAG_RULESET = 'cove_iati/rulesets/iati_openag_ruleset/'
+ORGIDS_RULESET = 'cove_iati/rulesets/iati_orgids_ruleset/'
+
+
 @ignore_errors
 def get_iati_ruleset_errors(lxml_etree, output_dir, group_by='rule', api=False,
-                            feature_dir='cove_iati/rulesets/iati_standard_v2_ruleset/'):
-    if group_by not in ['rule', 'activity']:
-        raise ValueError('Only `rule` or `activity` are valid values for group_by argument')
+                            feature_dir=IATI_RULESET, write_output=False):
+    '''Run a ruleset over the data and return its errors.
+
+    With `api=True` or `group_by=None` the errors are returned as a flat list,
+    otherwise they are grouped by `rule` or by `activity`.
+    '''
+    if group_by not in ['rule', 'activity', None]:
+        raise ValueError('Only `rule`, `activity` or None are valid values for group_by argument')
 
-    bdd_tester(etree=lxml_etree, features=[feature_dir],
-               output_path=output_dir)
+    ruleset_errors = run_ruleset(lxml_etree, output_dir, feature_dir, write_output=write_output)
 
-    if not os.path.isdir(output_dir):
-        return []
-    if api:
-        return format_ruleset_errors(output_dir)
+    if api or group_by is None:
+        return ruleset_errors
     if group_by == 'rule':
-        return _ruleset_errors_by_rule(format_ruleset_errors(output_dir))
+        return _ruleset_errors_by_rule(ruleset_errors)
     else:
-        return _ruleset_errors_by_activity(format_ruleset_errors(output_dir))
+        return _ruleset_errors_by_activity(ruleset_errors)
 
 
 @ignore_errors
-def get_openag_ruleset_errors(lxml_etree, output_dir):
-    bdd_tester(etree=lxml_etree, features=['cove_iati/rulesets/iati_openag_ruleset/'],
-               output_path=output_dir)
-
-    if not os.path.isdir(output_dir):
-        return []
-    return format_ruleset_errors(output_dir)
+def get_ruleset_error_examples(lxml_etree, output_dir, feature_dir, limit=None, write_output=False):
+    '''Run a ruleset over the data and return an `ErrorExamples` with the first limit of its errors for each rule'''
+    return run_ruleset(lxml_etree, output_dir, feature_dir, write_output=write_output,
+                       error_examples=ErrorExamples(limit))
 
 
 @ignore_errors
-def get_orgids_ruleset_errors(lxml_etree, output_dir):
-    bdd_tester(etree=lxml_etree, features=['cove_iati/rulesets/iati_orgids_ruleset/'],
-               output_path=output_dir)
+def get_openag_ruleset_errors(lxml_etree, output_dir, write_output=False):
+    return run_ruleset(lxml_etree, output_dir, OPENAG_RULESET,
+                       write_output=write_output)
 
-    if not os.path.isdir(output_dir):
-        return []
-    return format_ruleset_errors(output_dir)
+
+@ignore_errors
+def get_orgids_ruleset_errors(lxml_etree, output_dir, write_output=False):
+    return run_ruleset(lxml_etree, output_dir, ORGIDS_RULESET,
+                       write_output=write_output)
 
 
 def get_file_type(file):
@@ -474,12 +1022,11 @@ def get_file_type(file):
         raise UnrecognisedFileTypeXML
 
 
-def iati_identifier_count(tree):
-    root = tree.getroot()
-    identifiers = root.xpath('/iati-activities/iati-activity/iati-identifier/text()')
-    unique_identifiers = list(set(identifiers))
-
-    return len(unique_identifiers)
+def iati_identifier_count(tree, activity_refs=None):
+    '''Count the different iati-identifiers in tree, from `tree_activity_refs` if they've been collected'''
+    if activity_refs is None:
+        activity_refs = tree_activity_refs(tree)
+    return len(set(identifier for refs in activity_refs for identifier in refs.identifiers))
 
 
 def organisation_identifier_count(tree):
@@ -490,42 +1037,100 @@ def organisation_identifier_count(tree):
     return len(unique_identifiers)
 
 
-ACTIVITY_PREFIX = '/iati-activities/iati-activity'
+# The iati-identifiers and org refs of an activity, each a list in document order
+ActivityRefs = namedtuple('ActivityRefs', [
+    'identifiers', 'reporting_org_refs', 'participating_org_refs', 'provider_org_refs', 'receiver_org_refs'
+])
 
 
-def check_activity_org_refs(tree):
-    root = tree.getroot()
+# defusedxml's elements leave comments and processing instructions out when iterating
+# over their children, but not their tails
+_text_nodes = lxml.etree.XPath('text()', smart_strings=False)
 
-    try:
-        publisher_request = settings.REQUESTS_SESSION_WITH_CACHING.get("https://codelists.codeforiati.org/api/json/en/ReportingOrganisation.json")
-        publisher_request.raise_for_status()
-        registration_agency_request = settings.REQUESTS_SESSION_WITH_CACHING.get("https://codelists.codeforiati.org/api/json/en/OrganisationRegistrationAgency.json")
-        registration_agency_request.raise_for_status()
-    except requests.RequestException:
-        return {"error": "Unable to fetch data to do organisation checks", 'not_found_orgs_count': 0}
 
-    publishers = publisher_request.json()
-    registration_agency = registration_agency_request.json()
+def collect_activity_refs(activity):
+    '''Return the `ActivityRefs` of an activity, collected in one walk over its children
 
-    publisher_codes = {publisher['code']: publisher for publisher in publishers['data']}
+    Each list is what the xpaths `iati-identifier/text()`, `reporting-org/@ref`,
+    `participating-org/@ref`, `transaction/provider-org/@ref` and
+    `transaction/receiver-org/@ref` would select.
+    '''
+    refs = ActivityRefs([], [], [], [], [])
+    for element in activity.iterchildren(lxml.etree.Element):
+        tag = element.tag
+        if tag == 'iati-identifier':
+            refs.identifiers.extend(_text_nodes(element))
+        elif tag == 'reporting-org':
+            ref = element.get('ref')
+            if ref is not None:
+                refs.reporting_org_refs.append(ref)
+        elif tag == 'participating-org':
+            ref = element.get('ref')
+            if ref is not None:
+                refs.participating_org_refs.append(ref)
+        elif tag == 'transaction':
+            # defusedxml's elements only take one tag in iterchildren
+            for transaction_element in element.iterchildren(lxml.etree.Element):
+                ref = transaction_element.get('ref')
+                if ref is None:
+                    continue
+                if transaction_element.tag == 'provider-org':
+                    refs.provider_org_refs.append(ref)
+                elif transaction_element.tag == 'receiver-org':
+                    refs.receiver_org_refs.append(ref)
+    return refs
 
-    org_prefixes = {prefix['code']: prefix for prefix in registration_agency['data']}
 
-    found_publisher_orgs = {}
-    found_org_prefix = {}
-    not_found_orgs = {}
+def tree_activity_refs(tree):
+    '''Return the `ActivityRefs` of every activity in tree, in one walk over the document'''
+    root = tree.getroot()
+    if root.tag != 'iati-activities':
+        return []
+    return [collect_activity_refs(activity) for activity in root.iterchildren('iati-activity')]
 
-    regex = re.compile('^[^\/\&\|\?]+$')
 
-    for activity in root.xpath(ACTIVITY_PREFIX):
-        reporting_org = activity.xpath('reporting-org/@ref')
-        iati_identifiers = activity.xpath('iati-identifier/text()')
-        iati_identifier = iati_identifiers[0] if len(iati_identifiers) else None
+class ActivityOrgRefs():
+    '''Org refs used in activities, matched against publishers and registration agency prefixes.
 
+    Activities are added one at a time with `add` (or their `ActivityRefs` with `add_refs`),
+    and `result` returns the org ref stats.
+    The publishers and prefixes are shared by every request (see `cove_iati.lib.org_registry`),
+    so the counts for this file are kept apart from them until `result`.
+    '''
+    regex = re.compile('^[^\/\&\|\?]+$')
+
+    def __init__(self):
+        self.error = None
+        try:
+            self.registry = org_registry_store.get()
+        except requests.RequestException:
+            self.error = "Unable to fetch data to do organisation checks"
+            return
+
+        self.found_publisher_orgs = {}
+        self.found_org_prefix = {}
+        self.not_found_orgs = {}
+
+    def add(self, activity):
+        self.add_refs(collect_activity_refs(activity))
+
+    def add_refs(self, activity_refs):
+        if self.error:
+            return
+
+        registry = self.registry
+        publisher_codes = registry.publisher_codes
+        found_publisher_orgs = self.found_publisher_orgs
+        found_org_prefix = self.found_org_prefix
+        not_found_orgs = self.not_found_orgs
+
+        # from the activity result store (see `ActivityChecks`), refs are a list
+        identifiers, reporting_org, participating_orgs, provider_orgs, receiver_orgs = activity_refs
+        iati_identifier = identifiers[0] if identifiers else None
         orgs_in_data = {
-            "Participating Org": activity.xpath('participating-org/@ref'),
-            "Transaction Provider": activity.xpath('transaction/provider-org/@ref'),
-            "Transaction Receiver": activity.xpath('transaction/receiver-org/@ref')
+            "Participating Org": participating_orgs,
+            "Transaction Provider": provider_orgs,
+            "Transaction Receiver": receiver_orgs
         }
         org_type_template = {key: 0 for key in orgs_in_data}
 
@@ -536,31 +1141,26 @@ def check_activity_org_refs(tree):
 
                 if org in publisher_codes:
                     if org not in found_publisher_orgs:
-                        found_publisher_orgs[org] = publisher_codes[org]
-                        found_publisher_orgs[org]["count"] = 0
-                        found_publisher_orgs[org]["type_count"] = org_type_template.copy()
-                        found_publisher_orgs[org]["activity_ids"] = set()
+                        found_publisher_orgs[org] = {
+                            "count": 0,
+                            "type_count": org_type_template.copy(),
+                            "activity_ids": set(),
+                        }
                     found_publisher_orgs[org]["count"] += 1
                     found_publisher_orgs[org]["type_count"][org_type] += 1
                     if iati_identifier:
                         found_publisher_orgs[org]["activity_ids"].add(iati_identifier)
                     continue
 
-                # get possible prefixes by initial substrings of ref. This is faster than checking ref
-                # against all prefixes in registry.
-                found_prefix = None
-                for possible_prefix in set(org[0:n] for n in range(4, len(org)+1)):  # no prefix shorter than 4
-                    if possible_prefix in org_prefixes:
-                        found_prefix = possible_prefix
-                        break
-
+                found_prefix = registry.org_prefix(org)
                 if found_prefix:
                     if found_prefix not in found_org_prefix:
-                        found_org_prefix[found_prefix] = org_prefixes[found_prefix]
-                        found_org_prefix[found_prefix]["orgs"] = set()
-                        found_org_prefix[found_prefix]["count"] = 0
-                        found_org_prefix[found_prefix]["type_count"] = org_type_template.copy()
-                        found_org_prefix[found_prefix]["activity_ids"] = set()
+                        found_org_prefix[found_prefix] = {
+                            "orgs": set(),
+                            "count": 0,
+                            "type_count": org_type_template.copy(),
+                            "activity_ids": set(),
+                        }
                     found_org_prefix[found_prefix]["count"] += 1
                     found_org_prefix[found_prefix]["type_count"][org_type] += 1
                     found_org_prefix[found_prefix]["orgs"].add(org)
@@ -569,7 +1169,7 @@ def check_activity_org_refs(tree):
                     continue
 
                 # We already catch non matching orgs in the ruleset tests.
-                if regex.match(org):
+                if self.regex.match(org):
                     if org not in not_found_orgs:
                         not_found_orgs[org] = {}
                         not_found_orgs[org]["count"] = 0
@@ -580,22 +1180,44 @@ def check_activity_org_refs(tree):
                     if iati_identifier:
                         not_found_orgs[org]["activity_ids"].add(iati_identifier)
 
-    for org in found_publisher_orgs.values():
-        org["activity_ids"] = sorted(list(org["activity_ids"]))
+    def result(self):
+        if self.error:
+            return {"error": self.error, 'not_found_orgs_count': 0}
 
-    for prefix in not_found_orgs.values():
-        prefix["activity_ids"] = sorted(list(prefix["activity_ids"]))
+        publisher_codes = self.registry.publisher_codes
+        org_prefixes = self.registry.org_prefixes
 
-    for prefix in found_org_prefix.values():
-        prefix["activity_ids"] = sorted(list(prefix["activity_ids"]))
-        prefix["orgs"] = sorted(list(prefix["orgs"]))
-
-    organisation_ref_stats = {"error": False,
-                              "publisher_count": len(found_publisher_orgs),
-                              "publisher_org_list": sorted([list(item) for item in found_publisher_orgs.items()], key=lambda x: x[1]["count"], reverse=True),
-                              "org_prefix_count": len(found_org_prefix),
-                              "org_prefix_list": sorted([list(item) for item in found_org_prefix.items()], key=lambda x: x[1]["count"], reverse=True),
-                              "not_found_orgs_count": len(not_found_orgs),
-                              "not_found_orgs_list": sorted([list(item) for item in not_found_orgs.items()], key=lambda x: x[1]["count"], reverse=True)}
+        # each entry from the registry, with the counts for this file
+        found_publisher_orgs = {
+            org: {**publisher_codes[org], **counts, "activity_ids": sorted(counts["activity_ids"])}
+            for org, counts in self.found_publisher_orgs.items()
+        }
+        found_org_prefix = {
+            prefix: {**org_prefixes[prefix], **counts, "orgs": sorted(counts["orgs"]),
+                     "activity_ids": sorted(counts["activity_ids"])}
+            for prefix, counts in self.found_org_prefix.items()
+        }
+        not_found_orgs = {
+            org: dict(counts, activity_ids=sorted(counts["activity_ids"]))
+            for org, counts in self.not_found_orgs.items()
+        }
 
-    return organisation_ref_stats
+        organisation_ref_stats = {"error": False,
+                                  "publisher_count": len(found_publisher_orgs),
+                                  "publisher_org_list": sorted([list(item) for item in found_publisher_orgs.items()], key=lambda x: x[1]["count"], reverse=True),
+                                  "org_prefix_count": len(found_org_prefix),
+                                  "org_prefix_list": sorted([list(item) for item in found_org_prefix.items()], key=lambda x: x[1]["count"], reverse=True),
+                                  "not_found_orgs_count": len(not_found_orgs),
+                                  "not_found_orgs_list": sorted([list(item) for item in not_found_orgs.items()], key=lambda x: x[1]["count"], reverse=True)}
+
+        return organisation_ref_stats
+
+
+def check_activity_org_refs(tree, activity_refs=None):
+    '''Return the org ref stats for tree, from `tree_activity_refs` if they've been collected'''
+    if activity_refs is None:
+        activity_refs = tree_activity_refs(tree)
+    org_refs = ActivityOrgRefs()
+    for refs in activity_refs:
+        org_refs.add_refs(refs)
+    return org_refs.result()
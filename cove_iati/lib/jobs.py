@@ -0,0 +1,199 @@
+'''
+Run the checks for supplied data as a job in the background, so a large file neither holds
+a web worker for the whole of its checks nor runs into the request timeout.
+
+A job belongs to a `SuppliedData` and its state is kept in `job.json` in its upload
+directory, next to the `cached_context.json` that the job writes once it's done, so every
+web worker process can show the progress of a job, whichever process is running it.
+
+Jobs run in a pool of settings.EXPLORE_JOB_WORKERS threads in the process that queued them
+or, if that is 0, straight away in the request. If the process running a job goes away
+(e.g. a web worker is restarted) the job is queued again the next time it's asked for.
+A job that failed other than because of the data (e.g. a codelist couldn't be fetched) is
+queued again when it's asked for settings.EXPLORE_JOB_RETRY_SECONDS after it failed.
+'''
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.utils import translation
+from django.utils.safestring import SafeData, mark_safe
+from django.utils.translation import ugettext_lazy as _
+from libcove.lib.exceptions import CoveInputDataError
+
+logger = logging.getLogger(__name__)
+
+STAGE_NAMES = {
+    'queued': _('Waiting for other checks to finish'),
+    'converting': _('Converting the spreadsheet to XML'),
+    'checking': _('Checking the data'),
+    'flattening': _('Converting the XML to a spreadsheet'),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.EXPLORE_JOB_WORKERS, thread_name_prefix='explore-job')
+        return _executor
+
+
+def write_json(path, data):
+    '''Write data to a temporary file and move it into place, so readers never see part of it'''
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), suffix='.tmp', delete=False) as fp:
+        json.dump(data, fp)
+    os.replace(fp.name, path)
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def error_context(err):
+    '''Return the context of the error page for a CoveInputDataError, as `cove_web_input_error` would
+    render it, with its text as plain strings so it can be saved as JSON'''
+    if hasattr(err, 'wrapped_err'):
+        context = {
+            'sub_title': _("Sorry, we can't process that data"),
+            'link': 'index',
+            'link_text': _('Try Again'),
+            'msg': _('We think you tried to supply a spreadsheet, but we failed to convert it.'
+                     '\n\nError message: {}').format(repr(err.wrapped_err)),
+        }
+    else:
+        context = err.context
+    context = {key: str(value) for key, value in context.items()}
+    context['safe'] = [key for key, value in context.items() if isinstance(value, SafeData)]
+    return context
+
+
+class Job():
+    '''The checks for the data in upload_dir.
+
+    `state` is None if the checks have never been queued, or a dict with:
+
+    * status: 'queued', 'running', 'done' or 'failed'
+    * stages: the stages the job goes through (keys of STAGE_NAMES), in order
+    * stage: the current stage, while the job is queued or running
+    * started: when each stage so far started, as a Unix timestamp
+    * error: for a failed job, the context of the error page if the data was at fault
+      (see `error_context`), otherwise None
+    * failed: when a failed job failed, as a Unix timestamp
+    * pid: the process running the job
+    '''
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        self.path = os.path.join(upload_dir, 'job.json')
+        self.cached_context_path = os.path.join(upload_dir, 'cached_context.json')
+        self.state = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (json.decoder.JSONDecodeError, FileNotFoundError):
+            return None
+
+    def is_active(self):
+        '''Whether the job is queued or running in a process that still exists'''
+        return (self.state is not None and self.state['status'] in ('queued', 'running') and
+                process_exists(self.state['pid']))
+
+    def can_retry(self):
+        '''Whether a failed job failed other than because of the data, long enough ago to try again'''
+        return (self.state['status'] == 'failed' and not self.state['error'] and
+                time.time() - self.state.get('failed', 0) >= settings.EXPLORE_JOB_RETRY_SECONDS)
+
+    def error_context(self):
+        '''Return the context of the error page for a failed job, or None if the data was not at fault'''
+        context = dict(self.state['error'] or {})
+        for key in context.pop('safe', ()):
+            context[key] = mark_safe(context[key])
+        return context or None
+
+    def stage_progress(self):
+        '''Return a list of {'name', 'status'} for the stages of the job, where status is
+        'done', 'current' or 'pending' '''
+        current = self.state['stages'].index(self.state['stage']) if self.state['stage'] else len(self.state['stages'])
+        return [{
+            'name': STAGE_NAMES[stage],
+            'status': 'done' if index < current else 'current' if index == current else 'pending',
+        } for index, stage in enumerate(self.state['stages'])]
+
+    def claim(self, stages):
+        '''Create a new, queued, job with the given stages, replacing a finished one.
+
+        Returns False, leaving things alone, if there is already an active job.
+        '''
+        if self.is_active():
+            return False
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+        state = {'status': 'queued', 'stages': ['queued'] + list(stages), 'stage': 'queued',
+                 'started': {'queued': time.time()}, 'error': None, 'pid': os.getpid()}
+        try:
+            # another process may have claimed the job since we looked
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            self.state = self.load()
+            return False
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(state, fp)
+        self.state = state
+        return True
+
+    def enqueue(self, check, stages):
+        '''Run check in the background, unless the job is already active, and return whether it was queued.
+
+        check is called with a `progress` keyword argument, a callable to report the start
+        of each stage, and returns the context for the results page. Without a pool of workers,
+        an exception other than a CoveInputDataError is raised once the job has been marked as failed.
+        '''
+        if not self.claim(stages):
+            return False
+        language = translation.get_language()
+        if settings.EXPLORE_JOB_WORKERS:
+            get_executor().submit(self.run, check, language)
+        else:
+            self.run(check, language, raise_errors=True)
+        return True
+
+    def progress(self, stage):
+        self.save(status='running', stage=stage, started=dict(self.state['started'], **{stage: time.time()}))
+
+    def run(self, check, language, raise_errors=False):
+        with translation.override(language):
+            try:
+                context = check(progress=self.progress)
+            except CoveInputDataError as err:
+                self.save(status='failed', error=error_context(err), failed=time.time())
+            except Exception:
+                self.save(status='failed', failed=time.time())
+                if raise_errors:
+                    raise
+                logger.exception('Checks failed for %s', self.upload_dir)
+            else:
+                write_json(self.cached_context_path, context)
+                self.save(status='done', stage=None)
+
+    def save(self, **state):
+        self.state = dict(self.state, **state)
+        write_json(self.path, self.state)
@@ -0,0 +1,271 @@
+'''
+The IATI publisher and organisation registration agency lists, used by `ActivityOrgRefs`,
+and the org-ids prefixes, used by the org-ids ruleset.
+
+Both IATI lists are fetched by `OrgRegistryStore` and indexed once per process, then shared
+by every request and refreshed in the background once they are older than
+settings.ORG_REGISTRY_MAX_AGE. An `OrgRegistry` is never changed after it's built, so the
+counts for each file are kept by `ActivityOrgRefs` itself.
+
+The org-ids prefixes are read from a snapshot in settings.CODELIST_SNAPSHOT_DIR the first
+time they are needed, and only fetched if there isn't one. `refresh_orgids_prefixes` (run by
+the `refresh_orgids_prefixes` command) fetches them again.
+
+The registry and the prefixes can be pinned in a thread, so a check uses the same ones
+throughout as the result cache key it's stored under (see `cove_iati.lib.result_cache`).
+'''
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from types import MappingProxyType
+
+import requests
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PUBLISHERS_URL = 'https://codelists.codeforiati.org/api/json/en/ReportingOrganisation.json'
+REGISTRATION_AGENCIES_URL = 'https://codelists.codeforiati.org/api/json/en/OrganisationRegistrationAgency.json'
+ORGIDS_URL = 'http://org-id.guide/download.json'
+
+
+class PrefixTrie():
+    '''Find the longest of a set of strings that starts another string, in time proportional to its length'''
+    _END = object()
+
+    def __init__(self, strings=()):
+        self.root = {}
+        for string in strings:
+            self.add(string)
+
+    def add(self, string):
+        node = self.root
+        for character in string:
+            node = node.setdefault(character, {})
+        node[self._END] = string
+
+    def __iter__(self):
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            for character, child in node.items():
+                if character is self._END:
+                    yield child
+                else:
+                    nodes.append(child)
+
+    def __reduce__(self):
+        # the end marker is only the same object in this process, so tries are pickled as their strings
+        return PrefixTrie, (sorted(self),)
+
+    def longest_prefix(self, string, min_length=0):
+        '''Return the longest string added that string starts with, and is at least min_length long, or None'''
+        node = self.root
+        found = None
+        for length, character in enumerate(string, 1):
+            node = node.get(character)
+            if node is None:
+                break
+            if self._END in node and length >= min_length:
+                found = node[self._END]
+        return found
+
+
+def data_version(data):
+    '''Return a hash of JSON data, the same in every process with the same data'''
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+class OrgRegistry():
+    '''Publishers by code and registration agencies by prefix, read only'''
+    def __init__(self, publishers, registration_agencies):
+        self.version = data_version([publishers, registration_agencies])
+        self.publisher_codes = MappingProxyType(
+            {publisher['code']: MappingProxyType(publisher) for publisher in publishers['data']})
+        self.org_prefixes = MappingProxyType(
+            {prefix['code']: MappingProxyType(prefix) for prefix in registration_agencies['data']})
+        self.prefix_trie = PrefixTrie(self.org_prefixes)
+
+    def org_prefix(self, org):
+        # no prefix is shorter than 4
+        return self.prefix_trie.longest_prefix(org, min_length=4)
+
+
+def fetch_json(url):
+    request = settings.REQUESTS_SESSION_WITH_CACHING.get(url)
+    request.raise_for_status()
+    return request.json()
+
+
+class OrgRegistryStore():
+    '''The `OrgRegistry` shared by every request in a process.
+
+    The first `get` fetches the registry in the foreground (unless `fetch_in_background` was
+    called first, e.g. when a web worker starts). After that, `get` returns the registry it
+    has and refreshes it in the background once it's stale, keeping it if a refresh fails.
+    `loaded` returns the registry without ever waiting, and `pin` makes `get` return the same
+    one in a thread until a check is done.
+    '''
+    def __init__(self):
+        self.registry = None
+        self.fetched_at = None
+        self._lock = threading.Lock()
+        self._fetch_thread = None
+        self._pinned = threading.local()
+
+    def is_stale(self):
+        return (self.fetched_at is None or
+                time.time() - self.fetched_at > settings.ORG_REGISTRY_MAX_AGE.total_seconds())
+
+    def fetch(self, raise_errors=True):
+        try:
+            registry = OrgRegistry(fetch_json(PUBLISHERS_URL), fetch_json(REGISTRATION_AGENCIES_URL))
+        except (requests.RequestException, ValueError, KeyError):
+            if raise_errors:
+                raise
+            logger.exception('Could not fetch the organisation registry')
+            return None
+        with self._lock:
+            self.registry = registry
+            self.fetched_at = time.time()
+        return registry
+
+    def fetch_in_background(self):
+        '''Start a fetch in a background thread, unless one is already running'''
+        with self._lock:
+            if self._fetch_thread is not None and self._fetch_thread.is_alive():
+                return self._fetch_thread
+            self._fetch_thread = threading.Thread(
+                target=self.fetch, kwargs={'raise_errors': False}, name='org-registry-fetch', daemon=True
+            )
+            self._fetch_thread.start()
+            return self._fetch_thread
+
+    def loaded(self):
+        '''Return the `OrgRegistry` if it has been fetched, without waiting, or None.
+
+        A fetch is started in the background if it hasn't been fetched yet, or is stale.
+        '''
+        registry = self.registry
+        if registry is None or self.is_stale():
+            self.fetch_in_background()
+        return registry
+
+    @contextmanager
+    def pin(self, registry):
+        '''Make `get` return registry in this thread while the block runs'''
+        previous = getattr(self._pinned, 'registry', None)
+        self._pinned.registry = registry
+        try:
+            yield
+        finally:
+            self._pinned.registry = previous
+
+    def get(self):
+        '''Return the `OrgRegistry`, raising requests.RequestException if it has never been fetched'''
+        pinned = getattr(self._pinned, 'registry', None)
+        if pinned is not None:
+            return pinned
+        fetch_thread = self._fetch_thread
+        if self.registry is None and fetch_thread is not None:
+            fetch_thread.join()
+        if self.registry is None:
+            return self.fetch()
+        if self.is_stale():
+            self.fetch_in_background()
+        return self.registry
+
+
+org_registry_store = OrgRegistryStore()
+
+
+# The org-ids prefixes, and a hash of them
+OrgidsPrefixes = namedtuple('OrgidsPrefixes', ['version', 'prefix_trie'])
+
+_orgids_lock = threading.Lock()
+_orgids_prefixes = None
+_pinned_orgids = threading.local()
+
+
+def orgids_snapshot_path():
+    return os.path.join(settings.CODELIST_SNAPSHOT_DIR, 'org-ids.json')
+
+
+def read_orgids_snapshot():
+    '''Return the prefixes in the org-ids snapshot, or None if there isn't one'''
+    try:
+        with open(orgids_snapshot_path()) as fp:
+            return json.load(fp)['prefixes']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def fetch_orgids_prefixes():
+    '''Fetch the org-ids prefixes and write them to the snapshot, returning them'''
+    prefixes = sorted(org_list['code'] for org_list in fetch_json(ORGIDS_URL)['lists'])
+    snapshot_path = orgids_snapshot_path()
+    snapshot_dir = os.path.dirname(snapshot_path)
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=snapshot_dir, suffix='.tmp', delete=False) as fp:
+            json.dump({'source': ORGIDS_URL, 'saved_at': time.time(), 'prefixes': prefixes}, fp)
+        os.replace(fp.name, snapshot_path)
+    except OSError:
+        logger.exception('Could not write org-ids snapshot %s', snapshot_path)
+    return prefixes
+
+
+def refresh_orgids_prefixes():
+    '''Fetch the org-ids prefixes, and use them from now on in this process'''
+    global _orgids_prefixes
+    prefixes = fetch_orgids_prefixes()
+    orgids_prefixes = OrgidsPrefixes(data_version(prefixes), PrefixTrie(prefixes))
+    with _orgids_lock:
+        _orgids_prefixes = orgids_prefixes
+    return prefixes
+
+
+def _load_orgids_prefixes(fetch=True):
+    global _orgids_prefixes
+    with _orgids_lock:
+        if _orgids_prefixes is None:
+            prefixes = read_orgids_snapshot()
+            if prefixes is None:
+                if not fetch:
+                    return None
+                prefixes = fetch_orgids_prefixes()
+            _orgids_prefixes = OrgidsPrefixes(data_version(prefixes), PrefixTrie(prefixes))
+        return _orgids_prefixes
+
+
+def loaded_orgids_prefixes():
+    '''Return the `OrgidsPrefixes`, from the snapshot if they aren't loaded yet, or None if there isn't one'''
+    return _load_orgids_prefixes(fetch=False)
+
+
+def pinned_orgids_prefixes():
+    '''Return the `OrgidsPrefixes` pinned in this thread by `pin_orgids_prefixes`, or None'''
+    return getattr(_pinned_orgids, 'orgids_prefixes', None)
+
+
+@contextmanager
+def pin_orgids_prefixes(orgids_prefixes):
+    '''Make `orgids_prefix_trie` use orgids_prefixes (if not None) in this thread while the block runs'''
+    previous = pinned_orgids_prefixes()
+    _pinned_orgids.orgids_prefixes = orgids_prefixes
+    try:
+        yield
+    finally:
+        _pinned_orgids.orgids_prefixes = previous
+
+
+def orgids_prefix_trie():
+    '''Return a `PrefixTrie` of the org-ids prefixes, from the snapshot if there is one'''
+    orgids_prefixes = pinned_orgids_prefixes() or _load_orgids_prefixes()
+    return orgids_prefixes.prefix_trie
@@ -0,0 +1,201 @@
+'''
+Check the activities in a streamed file in a pool of worker processes.
+
+`stream_checks` still reads the file, validates the root element and adds up identifiers and
+org refs, which need the whole document. The checks that look at one activity at a time
+(`ActivityChecks`: schema validation, codelists and rulesets) are the slow part, so activities
+are serialized and sent to workers in shards. Results come back one per child of root, and
+are added in document order, so they are the same as checking every activity in one process.
+The timings recorded by workers (see `cove_iati.lib.timing`) are added to the parent's.
+
+Every file is checked by the same pool, started the first time it's needed. Web workers run
+threads (checks, and codelist, schema and org registry fetches), so its processes are spawned
+rather than forked, which could copy a lock held by another thread. What a worker needs to
+check a file is written to a temporary file once, and read by each worker the first time it
+checks a shard of that file. That includes the org-ids prefixes pinned for the file's checks
+(see `cove_iati.lib.result_cache`), which the org-ids ruleset uses in the worker.
+'''
+import collections
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import lxml.etree
+from django.conf import settings
+
+from .iati import ActivityChecks
+from .org_registry import pin_orgids_prefixes, pinned_orgids_prefixes
+from .stream import DocumentPaths
+from .timing import add_timings, record_timings
+
+# Settings used by `ActivityChecks`, which are passed on to workers with each file, as they
+# may have been changed in the parent since the worker started
+WORKER_SETTINGS = ('ACTIVITY_RESULT_STORE_PATH', 'ACTIVITY_RESULT_STORE_MAX_ENTRIES', 'CODELIST_SNAPSHOT_DIR')
+
+# Each worker process's checks for the last few files it has checked, by the path of their
+# check file, set up by the first shard of the file it checks, so that errors setting them
+# up are raised by `ShardedActivityChecks` rather than breaking the pool
+_activity_checks = collections.OrderedDict()
+_MAX_FILES = 4
+
+# Children are serialized by lxml, so there is nothing to resolve or fetch
+_parser = lxml.etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+
+_pool = None
+_pool_processes = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(processes):
+    '''Return the pool of worker processes, starting it if needed (or if processes has changed)'''
+    global _pool, _pool_processes
+    with _pool_lock:
+        if _pool is None or _pool_processes != processes:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker)
+            _pool_processes = processes
+        return _pool
+
+
+def reset_pool(pool):
+    '''Stop using pool, e.g. after one of its processes died, so the next file starts a new one'''
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+def _load_checks(check_path):
+    checks = _activity_checks.get(check_path)
+    if checks is not None:
+        _activity_checks.move_to_end(check_path)
+        return checks
+
+    with open(check_path, 'rb') as fp:
+        activity_check_args, root_data, orgids_prefixes, worker_settings = pickle.load(fp)
+    for name, value in worker_settings.items():
+        setattr(settings, name, value)
+    # an empty copy of the root element, which children are checked in
+    checks = _activity_checks[check_path] = (ActivityChecks(*activity_check_args), root_data, orgids_prefixes)
+    while len(_activity_checks) > _MAX_FILES:
+        _activity_checks.popitem(last=False)
+    return checks
+
+
+def _check_shard(check_path, shard):
+    with record_timings() as timings:
+        results = _check_shard_activities(check_path, shard)
+    return results, timings
+
+
+def _check_shard_activities(check_path, shard):
+    activity_checks, root_data, orgids_prefixes = _load_checks(check_path)
+    with pin_orgids_prefixes(orgids_prefixes):
+        return _check_activities(activity_checks, root_data, shard)
+
+
+def _check_activities(activity_checks, root_data, shard):
+    # some ruleset steps look at the namespaces declared by root
+    root = lxml.etree.fromstring(root_data, _parser)
+    results = []
+    for data, document_xpath, codelist_path, sourcelines in shard:
+        child = lxml.etree.fromstring(data, _parser)
+        root.append(child)
+        result = activity_checks.check(child, DocumentPaths.only_child(child, document_xpath), codelist_path)
+        root.remove(child)
+
+        # map line numbers back to the original file, which serializing may have changed
+        lines = {}
+        for element, sourceline in zip(child.iter(), sourcelines):
+            lines.setdefault(element.sourceline, sourceline)
+        for error in result['schema_errors']:
+            error['line'] = lines.get(error['line'], error['line'])
+
+        results.append(result)
+    activity_checks.flush()
+    return results
+
+
+class ShardedActivityChecks():
+    '''Check children of root in worker processes, shard_size at a time.
+
+    `add` and `finish` return the results of `ActivityChecks.check` for every child added,
+    in the order they were added, as they become available. No more than two shards for each
+    process are waiting to be checked or merged at a time, which bounds memory use.
+    '''
+    def __init__(self, processes, shard_size, activity_check_args, root):
+        root_data = lxml.etree.tostring(lxml.etree.Element(root.tag, dict(root.attrib), nsmap=root.nsmap))
+        worker_settings = {name: getattr(settings, name) for name in WORKER_SETTINGS}
+        with tempfile.NamedTemporaryFile(prefix='activity-checks-', suffix='.pickle', delete=False) as fp:
+            pickle.dump((activity_check_args, root_data, pinned_orgids_prefixes(), worker_settings), fp)
+        self.check_path = fp.name
+        self.executor = get_pool(processes)
+        self.shard_size = shard_size
+        self.max_pending = processes * 2
+        self.shard = []
+        self.pending = collections.deque()
+
+    def add(self, child, document_xpath, codelist_path):
+        '''Add a child of root, whose xpath in the whole document is document_xpath'''
+        self.shard.append((
+            lxml.etree.tostring(child, with_tail=False),
+            document_xpath,
+            codelist_path,
+            [element.sourceline for element in child.iter()],
+        ))
+        if len(self.shard) < self.shard_size:
+            return []
+        self._submit()
+
+        results = []
+        while self.pending and (len(self.pending) > self.max_pending or self.pending[0].done()):
+            results.extend(self._pop_result())
+        return results
+
+    def finish(self):
+        '''Return the results for every child not returned yet'''
+        if self.shard:
+            self._submit()
+        results = []
+        while self.pending:
+            results.extend(self._pop_result())
+        return results
+
+    def close(self):
+        '''Cancel the shards not checked yet, leaving the pool for other files'''
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        try:
+            os.remove(self.check_path)
+        except FileNotFoundError:
+            pass
+
+    def _pop_result(self):
+        try:
+            results, timings = self.pending.popleft().result()
+        except BrokenProcessPool:
+            reset_pool(self.executor)
+            raise
+        add_timings(timings)
+        return results
+
+    def _submit(self):
+        try:
+            self.pending.append(self.executor.submit(_check_shard, self.check_path, self.shard))
+        except BrokenProcessPool:
+            reset_pool(self.executor)
+            raise
+        self.shard = []
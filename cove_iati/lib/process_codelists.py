@@ -1,5 +1,12 @@
 import os
 import glob
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import lru_cache
 from collections import defaultdict
 import json
@@ -8,8 +15,15 @@ from lxml import etree as ET
 from lxml.etree import Element
 from django.conf import settings
 
+from .error_examples import ErrorExamples, codelist_error_kind
+
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+logger = logging.getLogger(__name__)
+
+# Bump when the layout of codelist snapshots changes, so old snapshots are rebuilt
+CODELIST_SNAPSHOT_FORMAT = 1
+
 
 def process_mapping(schema_directory):
     mappings = ET.parse(os.path.join(schema_directory, 'mapping.xml'))
@@ -64,132 +78,515 @@ def _parse_codelist_etree(codelist_root):
     return codelist_data
 
 
+def compact_codelist(codelist_data):
+    '''Keep only what codelist checks use: the set of codes, the codelist name, conditions etc.'''
+    compact = {key: value for key, value in codelist_data.items() if key not in ('values', 'description')}
+    compact['values'] = frozenset(codelist_data['values'])
+    return compact
+
+
+def codelist_snapshot_path(snapshot_name):
+    return os.path.join(settings.CODELIST_SNAPSHOT_DIR, snapshot_name + '.json')
+
+
+def read_codelist_snapshot(snapshot_path, source=None):
+    '''Return (saved_at, codelists) from a snapshot, or (None, None) if there isn't a usable one
+
+    A snapshot is only usable if it was written in the current format from the same source.
+    '''
+    try:
+        with open(snapshot_path) as fp:
+            snapshot = json.load(fp)
+    except (OSError, ValueError):
+        return None, None
+    if snapshot.get('format') != CODELIST_SNAPSHOT_FORMAT or snapshot.get('source') != source:
+        return None, None
+
+    codelists = snapshot['codelists']
+    for codelist_data in codelists.values():
+        codelist_data['values'] = frozenset(codelist_data['values'])
+    return snapshot['saved_at'], codelists
+
+
+def write_codelist_snapshot(snapshot_path, codelists, source=None):
+    '''Write a snapshot to a temporary file and move it into place, so readers never see part of one'''
+    snapshot = {
+        'format': CODELIST_SNAPSHOT_FORMAT,
+        'source': source,
+        'saved_at': time.time(),
+        'codelists': {key: dict(codelist_data, values=sorted(codelist_data['values']))
+                      for key, codelist_data in codelists.items()},
+    }
+    snapshot_dir = os.path.dirname(snapshot_path)
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=snapshot_dir, suffix='.tmp', delete=False) as fp:
+            json.dump(snapshot, fp, separators=(',', ':'))
+        os.replace(fp.name, snapshot_path)
+    except OSError:
+        logger.exception('Could not write codelist snapshot %s', snapshot_path)
+
+
+def embedded_codelists_source(schema_directory):
+    '''Identify the codelist files of a schema directory, so a snapshot is rebuilt when any change'''
+    filenames = [os.path.join(schema_directory, 'mapping.xml')]
+    filenames += sorted(glob.glob(os.path.join(schema_directory, 'codelists') + '/' + '*.xml'))
+    return [schema_directory] + [
+        [os.path.basename(filename), os.stat(filename).st_mtime_ns, os.stat(filename).st_size]
+        for filename in filenames
+    ]
+
+
 @lru_cache()
 def embedded_codelists(schema_directory):
+    source = embedded_codelists_source(schema_directory)
+    snapshot_path = codelist_snapshot_path('embedded-' + os.path.basename(os.path.normpath(schema_directory)))
+    saved_at, embedded_codelists = read_codelist_snapshot(snapshot_path, source)
+    if embedded_codelists is not None:
+        return embedded_codelists
+
     mappings = process_mapping(schema_directory)
     embedded_codelists = {}
     for filename in glob.glob(os.path.join(schema_directory, 'codelists') + '/' + '*.xml'):
         codelist_name = filename.split('/')[-1].split('.')[0]
         for path, mapping in mappings.items():
             if codelist_name == mapping['codelist_name']:
-                embedded_codelists[path] = mappings[path]
-                embedded_codelists[path].update(parse_codelist_filename(filename))
-                embedded_codelists[path]["filename"] = filename
+                embedded_codelists[path] = compact_codelist(
+                    dict(mapping, filename=filename, **parse_codelist_filename(filename))
+                )
 
+    write_codelist_snapshot(snapshot_path, embedded_codelists, source)
     return embedded_codelists
 
 
-@lru_cache()
-def non_embedded_codelists(schema_directory):
-    mappings = process_mapping(schema_directory)
-    non_embedded_codelists = {}
-    for path, mapping in mappings.items():
-        if mapping['codelist_name'] in settings.NON_EMBEDDED_CODELISTS_URLS:
-            url = settings.NON_EMBEDDED_CODELISTS_URLS[mapping['codelist_name']]
-            request = settings.REQUESTS_SESSION_WITH_CACHING.get(url)
-            request.raise_for_status()
-            non_embedded_codelists[path] = mappings[path]
-            non_embedded_codelists[path].update(parse_codelist_content(request.content))
-
-    return non_embedded_codelists
-
+def fetch_codelist(url):
+    request = settings.REQUESTS_SESSION_WITH_CACHING.get(url)
+    request.raise_for_status()
+    return compact_codelist(parse_codelist_content(request.content))
+
+
+class CodelistStore():
+    '''Parsed non-embedded codelists, keyed by codelist name, shared by every request in a process.
+
+    `fetch` downloads every codelist in settings.NON_EMBEDDED_CODELISTS_URLS in parallel,
+    and, if the store has a snapshot_name, saves them to a snapshot on disk that later
+    processes start from. Once codelists have been fetched or loaded from a snapshot, `get`
+    never waits on the network: it returns the codelists it has and refreshes them in the
+    background once they are older than settings.NON_EMBEDDED_CODELISTS_MAX_AGE. Before that,
+    `get` waits for a fetch already started (e.g. by `prefetch_non_embedded_codelists` when a
+    worker starts), and if there are still no codelists fetches them in the foreground, raising
+    if they can't be fetched, so the codelists are never silently left unchecked.
+
+    `loaded` returns the codelists without ever waiting, and `pin` makes `get` return the same
+    ones in a thread until a check is done, so its results match the codelists it's cached under.
+    '''
+    def __init__(self, snapshot_name=None):
+        self.snapshot_name = snapshot_name
+        self.codelists = {}
+        self.fetched_at = None
+        self.generation = 0
+        self._version = (None, None)
+        self._lock = threading.Lock()
+        self._fetch_thread = None
+        self._snapshot_checked = False
+        self._pinned = threading.local()
+
+    def load_snapshot(self):
+        '''Load the codelists saved by the last fetch in any process, once'''
+        with self._lock:
+            if self._snapshot_checked or self.snapshot_name is None:
+                return
+            self._snapshot_checked = True
+            saved_at, codelists = read_codelist_snapshot(
+                codelist_snapshot_path(self.snapshot_name), settings.NON_EMBEDDED_CODELISTS_URLS
+            )
+            if codelists is not None and self.fetched_at is None:
+                self.codelists = codelists
+                self.fetched_at = saved_at
+                self.generation += 1
+
+    def is_stale(self):
+        return (self.fetched_at is None or
+                time.time() - self.fetched_at > settings.NON_EMBEDDED_CODELISTS_MAX_AGE.total_seconds())
+
+    def fetch(self, raise_errors=True):
+        urls = settings.NON_EMBEDDED_CODELISTS_URLS
+        with ThreadPoolExecutor(max_workers=settings.NON_EMBEDDED_CODELISTS_FETCH_WORKERS) as executor:
+            futures = {codelist_name: executor.submit(fetch_codelist, url) for codelist_name, url in urls.items()}
+
+        codelists = {}
+        for codelist_name, future in futures.items():
+            try:
+                codelists[codelist_name] = future.result()
+            except Exception:
+                if raise_errors:
+                    raise
+                logger.exception('Could not fetch codelist %s from %s', codelist_name, urls[codelist_name])
+
+        if urls and not codelists:
+            # keep the codelists there are, stale, rather than marking nothing as fresh
+            return codelists
+
+        with self._lock:
+            # keep the previous copy of any codelist that could not be fetched this time
+            self.codelists = dict(self.codelists, **codelists)
+            self.fetched_at = time.time()
+            self.generation += 1
+            if self.snapshot_name is not None:
+                write_codelist_snapshot(codelist_snapshot_path(self.snapshot_name), self.codelists, urls)
+        return codelists
+
+    def fetch_in_background(self):
+        '''Start a fetch in a background thread, unless one is already running'''
+        with self._lock:
+            if self._fetch_thread is not None and self._fetch_thread.is_alive():
+                return self._fetch_thread
+            self._fetch_thread = threading.Thread(
+                target=self.fetch, kwargs={'raise_errors': False}, name='codelist-fetch', daemon=True
+            )
+            self._fetch_thread.start()
+            return self._fetch_thread
+
+    def version(self, loaded=None):
+        '''Return a hash of the codes in every codelist (in loaded, the (generation, codelists) of `loaded`,
+        or those `get` returns), the same in every process with the same codelists'''
+        generation, codelists = loaded or self.get()
+        version_generation, version = self._version
+        if version_generation != generation:
+            version = codelists_version(codelists)
+            self._version = (generation, version)
+        return version
+
+    def loaded(self):
+        '''Return (generation, codelists) if there are any, without waiting on the network, or None.
+
+        A fetch is started in the background if there are none yet, or they are stale.
+        '''
+        self.load_snapshot()
+        if self.is_stale():
+            self.fetch_in_background()
+        with self._lock:
+            if self.fetched_at is None:
+                return None
+            return self.generation, self.codelists
+
+    @contextmanager
+    def pin(self, loaded):
+        '''Make `get` return loaded, from `loaded`, in this thread while the block runs'''
+        previous = getattr(self._pinned, 'loaded', None)
+        self._pinned.loaded = loaded
+        try:
+            yield
+        finally:
+            self._pinned.loaded = previous
+
+    def get(self):
+        '''Return (generation, codelists)'''
+        pinned = getattr(self._pinned, 'loaded', None)
+        if pinned is not None:
+            return pinned
+        self.load_snapshot()
+        if self.fetched_at is None:
+            fetch_thread = self._fetch_thread
+            if fetch_thread is not None:
+                fetch_thread.join()
+            if self.fetched_at is None:
+                self.fetch()
+        elif self.is_stale():
+            self.fetch_in_background()
+        with self._lock:
+            return self.generation, self.codelists
+
+
+def codelists_version(codelists):
+    '''Return a hash of the codes in every codelist'''
+    codes = {codelist_name: sorted(codelist_data['values']) for codelist_name, codelist_data in codelists.items()}
+    return hashlib.sha256(json.dumps(codes, sort_keys=True).encode()).hexdigest()
+
+
+codelist_store = CodelistStore(snapshot_name='non-embedded')
+
+
+def prefetch_non_embedded_codelists(wait=False):
+    '''Load the codelist snapshot and, if it is missing or stale, fetch the non-embedded codelists
+    in the background, so requests never wait on the network'''
+    codelist_store.load_snapshot()
+    if codelist_store.is_stale():
+        fetch_thread = codelist_store.fetch_in_background()
+        if wait:
+            fetch_thread.join()
+
+
+# The non-embedded codelists for each schema directory, keyed by (schema directory,
+# `CodelistStore` generation), built from the codelists of that generation
+_non_embedded_codelists = {}
+_non_embedded_codelists_lock = threading.Lock()
 
-def traverse_element(current_path, element, index, current_identifier=None):
-    tag_name = None
-    count = 0
 
+def non_embedded_codelists(schema_directory):
+    '''Return the codelists in codelist_store, keyed by the paths the schema's mapping uses them for'''
+    generation, codelists = codelist_store.get()
+    key = (schema_directory, generation)
+    with _non_embedded_codelists_lock:
+        path_codelists = _non_embedded_codelists.get(key)
+        if path_codelists is not None:
+            return path_codelists
+
+    path_codelists = {}
+    for path, mapping in process_mapping(schema_directory).items():
+        if mapping['codelist_name'] in codelists:
+            path_codelists[path] = dict(mapping, **codelists[mapping['codelist_name']])
+
+    with _non_embedded_codelists_lock:
+        # codelists of earlier generations are no longer used
+        for cached_key in list(_non_embedded_codelists):
+            if cached_key[0] == schema_directory and cached_key[1] < generation:
+                del _non_embedded_codelists[cached_key]
+        if not any(cached_key[0] == schema_directory for cached_key in _non_embedded_codelists):
+            _non_embedded_codelists[key] = path_codelists
+    return path_codelists
+
+
+# Root elements whose tag and index are left out of the paths of their descendants
+ROOT_TAGS = ('iati-activities', 'iati-organisations')
+
+
+@lru_cache(maxsize=1024)
+def non_index_name(name):
+    '''Return a tag or attribute name as it appears in a path with its numeric segments removed
+
+    Only namespaced names, such as xml:lang, contain `/` and so can contain numeric segments.
+    '''
+    if '/' not in name:
+        return name
+    return '/'.join(item for item in name.split('/') if not item.isdigit())
+
+
+class ElementPath():
+    '''The position of an element in a tree, linked to the position of its parent.
+
+    `non_index_path` (the element's path without indexes, ending in `/`) is all that is
+    needed to find a codelist for an attribute. The full path, with indexes, is only
+    built by `attribute_path` for the attributes that are reported.
+    '''
+    __slots__ = ('parent', 'tag', 'index', 'non_index_path')
+
+    def __init__(self, parent, tag, index, non_index_path):
+        self.parent = parent
+        self.tag = tag
+        self.index = index
+        self.non_index_path = non_index_path
+
+    @classmethod
+    def root(cls, root):
+        root_tag = str(root.tag)
+        if root_tag in ROOT_TAGS:
+            return cls(None, None, 0, '')
+        return cls(None, root_tag, 0, '/' + non_index_name(root_tag) + '/')
+
+    def child(self, tag, index):
+        return ElementPath(self, tag, index, self.non_index_path + non_index_name(tag) + '/')
+
+    def attribute_path(self, attr_name):
+        segments = ['@' + attr_name]
+        element_path = self
+        while element_path is not None and element_path.tag is not None:
+            segments.append('{}/{}'.format(element_path.tag, element_path.index))
+            element_path = element_path.parent
+        if element_path is None:
+            # the root element is part of the path, which then starts with /
+            segments.append('')
+        return '/'.join(reversed(segments))
+
+
+def _current_identifier(element, current_identifier):
     if element.tag == 'iati-activity':
         identfier_element = element.find('iati-identifier')
         if identfier_element is not None:
             current_identifier = identfier_element.text
-    if element.tag == 'iati-organisation':
+    elif element.tag == 'iati-organisation':
         identfier_element = element.find('organisation-identifier')
         if identfier_element is not None:
-            current_identifier = element.find('organisation-identifier').text
-
-    new_path = current_path + '/' + element.tag + '/' + str(index)
-    for attr_name, value in element.attrib.items():
-        yield new_path + '/@' + attr_name, element, attr_name, value, current_identifier
+            current_identifier = identfier_element.text
+    return current_identifier
+
+
+def traverse_element(root, root_path=None, current_identifier=None):
+    '''Yield (element, element_path, current_identifier) for root and every element below it
+
+    Elements are visited depth first, in document order, using an explicit stack
+    rather than recursion. An element's index counts the run of immediately preceding
+    siblings with the same tag. root_path defaults to root being the root of its tree.
+    '''
+    if root_path is None:
+        root_path = ElementPath.root(root)
+    current_identifier = _current_identifier(root, current_identifier)
+    yield root, root_path, current_identifier
+
+    # each frame is [children, parent path, current identifier, previous tag, index]
+    stack = [[root.iterchildren(Element), root_path, current_identifier, None, 0]]
+    while stack:
+        frame = stack[-1]
+        child = next(frame[0], None)
+        if child is None:
+            stack.pop()
+            continue
 
-    for child in element.iterchildren(Element):
-        if str(child.tag) == tag_name:
-            count += 1
+        tag = child.tag
+        if tag == frame[3]:
+            frame[4] += 1
         else:
-            count = 0
-            tag_name = str(child.tag)
-        yield from traverse_element(new_path, child, count, current_identifier)
-
-
-def is_int(value):
-    try:
-        int(value)
-        return True
-    except ValueError:
-        return False
+            frame[3] = tag
+            frame[4] = 0
+
+        element_path = frame[1].child(tag, frame[4])
+        current_identifier = _current_identifier(child, frame[2])
+        yield child, element_path, current_identifier
+
+        if len(child):
+            stack.append([child.iterchildren(Element), element_path, current_identifier, None, 0])
+
+
+class CodelistPaths():
+    '''Find the codelist that applies to an attribute path (with its indexes removed).
+
+    A path matches the first codelist path, in order, that it ends with. Codelist
+    paths are grouped by their final segment (the attribute) so only those that can
+    match are checked, and the result for each distinct path is remembered, so
+    attributes after the first with a given path cost a single dict lookup.
+    '''
+    def __init__(self, codelist_values):
+        self.codelist_values = codelist_values
+        self._by_attribute = {}
+        self._matches = {}
+
+    def _candidates(self, attribute):
+        candidates = self._by_attribute.get(attribute)
+        if candidates is None:
+            candidates = []
+            for codelist_path in self.codelist_values:
+                if '/' in codelist_path:
+                    could_match = codelist_path.rsplit('/', 1)[1] == attribute
+                else:
+                    could_match = attribute.endswith(codelist_path)
+                if could_match:
+                    candidates.append(codelist_path)
+            self._by_attribute[attribute] = candidates
+        return candidates
+
+    def match(self, non_number_path):
+        '''Return (codelist_path, codelist_data) for a path, or (None, None)'''
+        match = self._matches.get(non_number_path)
+        if match is None:
+            match = (None, None)
+            for codelist_path in self._candidates(non_number_path.rsplit('/', 1)[-1]):
+                # all codelists start with //
+                if non_number_path.endswith(codelist_path):
+                    match = (codelist_path, self.codelist_values[codelist_path])
+                    break
+            self._matches[non_number_path] = match
+        return match
+
+
+class CodelistChecker():
+    '''Check attributes against several sets of codelists at once.
+
+    Invalid values are collected in `invalid_codelist_values`, a list for each set in
+    codelist_sets. `getpath` is called for the xpath of an element with an invalid value.
+
+    Every invalid value is counted in `codelist_counts` (by codelist path, for each set), but
+    with a limit only the first that many for each codelist path are kept (see `ErrorExamples`).
+    '''
+    def __init__(self, codelist_sets, cell_source_map=None, limit=None):
+        self.limit = limit
+        self.error_examples = [ErrorExamples(limit) for codelist_values in codelist_sets]
+        self.codelist_paths = [CodelistPaths(codelist_values) for codelist_values in codelist_sets]
+        self.source_map_data = None
+        if cell_source_map:
+            self.source_map_data = dict(cell_source_map)
+            for key, value in list(self.source_map_data.items()):
+                self.source_map_data[key.replace('/0/', '/')] = value
+
+    @property
+    def invalid_codelist_values(self):
+        return [error_examples.examples for error_examples in self.error_examples]
+
+    @property
+    def codelist_counts(self):
+        return [error_examples.counts for error_examples in self.error_examples]
+
+    def reset(self):
+        self.error_examples = [ErrorExamples(self.limit) for error_examples in self.error_examples]
+
+    def add_invalid_values(self, invalid_codelist_values):
+        '''Add invalid values found by another checker, a list for each set'''
+        for error_examples, invalid_values in zip(self.error_examples, invalid_codelist_values):
+            error_examples.extend(invalid_values, codelist_error_kind)
+
+    def check_tree(self, root, getpath, root_path=None, current_identifier=None):
+        '''Check root and every element below it'''
+        for element, element_path, current_identifier in traverse_element(root, root_path, current_identifier):
+            self.check_element(element, element_path, current_identifier, getpath)
+
+    def check_element(self, element, element_path, current_identifier, getpath):
+        for attr_name, value in element.attrib.items():
+            non_number_path = element_path.non_index_path + non_index_name('@' + attr_name)
+
+            for codelist_matcher, error_examples in zip(self.codelist_paths, self.error_examples):
+                codelist_selected_path, codelist_data = codelist_matcher.match(non_number_path)
+
+                if not codelist_data:
+                    continue
+
+                if str(value) in codelist_data['values']:
+                    continue
+
+                condition = codelist_data.get('condition')
+                if condition:
+                    vocabulary = element.attrib.get('vocabulary')
+                    allow_empty_vocabulary = 'not(@vocabulary)' in condition
+                    if not vocabulary and not allow_empty_vocabulary:
+                        continue
+                    if vocabulary and vocabulary != '1':
+                        continue
+
+                if not error_examples.count(codelist_selected_path):
+                    continue
+
+                path = element_path.attribute_path(attr_name)
+                invalid_codelist_value = {
+                    "path": path,
+                    "xpath": getpath(element) + '/' + attr_name,
+                    "value": value,
+                    "current_identifier": current_identifier,
+                    "codelist_name": codelist_data['name'],
+                    "filename": codelist_data.get('filename'),
+                    "codelist_path": codelist_selected_path
+                }
+
+                if self.source_map_data is not None:
+                    non_zero_path = path.replace('/0/', '/')
+                    invalid_codelist_value['source_map_data'] = self.source_map_data[non_zero_path][0]
+
+                error_examples.examples.append(invalid_codelist_value)
+
+
+def check_codelists(codelist_sets, tree, cell_source_map=None):
+    '''Check every attribute in tree against several sets of codelists in a single traversal
+
+    Returns a list of invalid codelist values for each set in codelist_sets.
+    '''
+    codelist_checker = CodelistChecker(codelist_sets, cell_source_map)
+    codelist_checker.check_tree(tree.getroot(), tree.getpath)
+    return codelist_checker.invalid_codelist_values
 
 
 def invalid_codelist_values(codelist_values, filename, source_map=None):
-
-    parsed = ET.parse(filename)
-    root = parsed.getroot()
-
-    invalid_codelist_values = []
-
+    cell_source_map = None
     if source_map:
         with open(source_map) as f:
-            source_map_data = json.load(f)
-        for key, value in list(source_map_data.items()):
-            source_map_data[key.replace('/0/', '/')] = value
-
-    for path, element, attr_name, value, current_identifier in traverse_element('', root, 0):
-        if path.startswith('/iati-activities'):
-            path = path[len('/iati-activities/0/'):]
-        if path.startswith('/iati-organisations'):
-            path = path[len('/iati-organisations/0/'):]
-
-        non_number_path = '/'.join([item for item in path.split('/') if not is_int(item)])
-
-        codelist_data = None
-        codelist_selected_path = None
-        for codelist_path, codelist_obj in codelist_values.items():
-            # all codelists start with //
-            if non_number_path.endswith(codelist_path):
-                codelist_data = codelist_obj
-                codelist_selected_path = codelist_path
-                break
-
-        if not codelist_data:
-            continue
-
-        if str(value) in codelist_data['values']:
-            continue
-
-        condition = codelist_data.get('condition')
-        if condition:
-            vocabulary = element.attrib.get('vocabulary')
-            allow_empty_vocabulary = 'not(@vocabulary)' in condition
-            if not vocabulary and not allow_empty_vocabulary:
-                continue
-            if vocabulary and vocabulary != '1':
-                continue
-
-        invalid_codelist_value = {
-            "path": path,
-            "xpath": parsed.getpath(element) + '/' + attr_name,
-            "value": value,
-            "current_identifier": current_identifier,
-            "codelist_name": codelist_data['name'],
-            "filename": codelist_data.get('filename'),
-            "codelist_path": codelist_selected_path
-        }
-
-        if source_map:
-            non_zero_path = path.replace('/0/', '/')
-            invalid_codelist_value['source_map_data'] = source_map_data[non_zero_path][0]
-
-        invalid_codelist_values.append(invalid_codelist_value)
-
-    return invalid_codelist_values
+            cell_source_map = json.load(f)
+    return check_codelists([codelist_values], ET.parse(filename), cell_source_map)[0]
 
 
 def invalid_embedded_codelist_values(schema_directory, filename, source_map=None):
@@ -200,7 +597,27 @@ def invalid_non_embedded_codelist_values(schema_directory, filename, source_map=
     return invalid_codelist_values(non_embedded_codelists(schema_directory), filename, source_map)
 
 
-def aggregate_results(codelist_values):
+def invalid_all_codelist_values(schema_directory, tree, cell_source_map=None, limit=None):
+    '''Return `ErrorExamples` of (invalid embedded, invalid non-embedded) codelist values for an already parsed tree
+
+    With a limit, only the first that many invalid values for each codelist path are kept.
+    '''
+    codelist_checker = CodelistChecker(
+        [embedded_codelists(schema_directory), non_embedded_codelists(schema_directory)],
+        cell_source_map,
+        limit
+    )
+    codelist_checker.check_tree(tree.getroot(), tree.getpath)
+    return tuple(codelist_checker.error_examples)
+
+
+def aggregate_results(codelist_values, codelist_counts=None):
+    '''Group invalid codelist values by codelist path
+
+    `count` is the number of invalid values for the path in codelist_counts, which can be more
+    than are in `invalid_list` (see `CodelistChecker`).
+    '''
+    codelist_counts = codelist_counts or {}
     codelist_aggregate = defaultdict(list)
 
     for codelist_value in codelist_values:
@@ -211,6 +628,7 @@ def aggregate_results(codelist_values):
     for codelist_path, invalid_list in codelist_aggregate.items():
         codelist_aggregate_list.append({
             "invalid_list": invalid_list,
+            "count": codelist_counts.get(codelist_path, len(invalid_list)),
             "filename": invalid_list[0]["filename"],
             "codelist_name": invalid_list[0]["codelist_name"],
             "codelist_path": codelist_path,
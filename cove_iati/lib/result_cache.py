@@ -0,0 +1,178 @@
+'''
+Results of the checks, shared by every upload of the same file.
+
+Publishers often upload the same file again, and monitors check the same URLs every day. The
+context returned by `common_checks_context_iati` only depends on the bytes of the file, its
+type, the schema versions, the codelists, the org registry (and org-ids prefixes), which
+rulesets are run and the date (some rules check that dates are in the past), so it's kept in
+settings.RESULT_CACHE_DIR, in a JSON file named after a SHA-256 hash of those. A file whose
+results are there isn't parsed or checked again.
+
+The codelists, org registry and org-ids prefixes are read once, without waiting for a fetch,
+and pinned (see `CodelistStore.pin`) while the file is checked, so the results are those of
+the data they are cached under. Until they have been loaded in a process, files are checked
+without the cache.
+
+The cache is shared by every process. Each entry's modification time is when it was last
+used, and once the entries add up to more than settings.RESULT_CACHE_MAX_BYTES the least
+recently used are removed.
+'''
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .org_registry import loaded_orgids_prefixes, org_registry_store, pin_orgids_prefixes
+from .process_codelists import codelist_store
+from .schema import schema_registry
+from .timing import timed
+
+logger = logging.getLogger(__name__)
+
+# Bump when what is cached changes, so old entries are no longer used
+RESULT_CACHE_FORMAT = 2
+
+_eviction_lock = threading.Lock()
+
+# The data from other services the results depend on: (generation, codelists) from
+# `CodelistStore.loaded`, an `OrgRegistry` and `OrgidsPrefixes` (None if not used)
+ReferenceData = namedtuple('ReferenceData', ['codelists', 'org_registry', 'orgids_prefixes'])
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def loaded_reference_data(orgids=False):
+    '''Return the `ReferenceData` loaded in this process, without waiting on the network, or None if any isn't loaded yet'''
+    codelists = codelist_store.loaded()
+    org_registry = org_registry_store.loaded()
+    orgids_prefixes = loaded_orgids_prefixes() if orgids else None
+    if codelists is None or org_registry is None or (orgids and orgids_prefixes is None):
+        return None
+    return ReferenceData(codelists, org_registry, orgids_prefixes)
+
+
+@contextmanager
+def pin_reference_data(reference_data):
+    '''Check with reference_data, in this thread, while the block runs'''
+    with codelist_store.pin(reference_data.codelists), org_registry_store.pin(reference_data.org_registry), \
+            pin_orgids_prefixes(reference_data.orgids_prefixes):
+        yield
+
+
+def result_cache_key(path, file_type, reference_data, api=False, openag=False, orgids=False):
+    '''Return the key of the results for the file at path, checked with the current schema and reference_data'''
+    key = {
+        'format': RESULT_CACHE_FORMAT,
+        'file': file_hash(path),
+        'file_type': file_type,
+        'schema_versions': schema_registry.cache_key(),
+        'codelists': codelist_store.version(reference_data.codelists),
+        'org_registry': reference_data.org_registry.version,
+        'orgids_prefixes': reference_data.orgids_prefixes.version if orgids else None,
+        # some rules check that dates are in the past
+        'date': datetime.date.today().isoformat(),
+        'error_examples_limit': settings.ERROR_EXAMPLES_LIMIT,
+        'api': api,
+        'openag': openag,
+        'orgids': orgids,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def result_cache_path(key):
+    return os.path.join(settings.RESULT_CACHE_DIR, key + '.json')
+
+
+def get_cached_result(key):
+    '''Return the cached results for key, or None'''
+    path = result_cache_path(key)
+    try:
+        with open(path) as fp:
+            result = json.load(fp)
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return result
+
+
+def set_cached_result(key, result):
+    '''Write results to a temporary file and move them into place, so readers never see part of them'''
+    cache_dir = settings.RESULT_CACHE_DIR
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp', delete=False) as fp:
+            json.dump(result, fp, separators=(',', ':'))
+        os.replace(fp.name, result_cache_path(key))
+    except (OSError, TypeError, ValueError):
+        logger.exception('Could not cache results %s', key)
+        return
+    evict_cached_results()
+
+
+def evict_cached_results():
+    '''Remove the least recently used results until the rest fit in settings.RESULT_CACHE_MAX_BYTES'''
+    with _eviction_lock:
+        entries = []
+        total_size = 0
+        for entry in os.scandir(settings.RESULT_CACHE_DIR):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= settings.RESULT_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # another process removed it first
+                pass
+            total_size -= size
+
+
+def cached_checks(path, file_type, check, api=False, openag=False, orgids=False):
+    '''Return check(), the context of the checks for the file at path, from the cache if it's been checked before.
+
+    The file at path is the one supplied, before any conversion. Results that depend on a
+    service that couldn't be reached (the org ref checks) aren't cached, and nor are those
+    checked before the codelists, org registry or org-ids prefixes were loaded.
+    '''
+    if not settings.RESULT_CACHE_MAX_BYTES:
+        return check()
+
+    reference_data = loaded_reference_data(orgids=orgids)
+    if reference_data is None:
+        logger.info('Not using the result cache for %s until the codelists and org registry are loaded', path)
+        return check()
+
+    with timed('result_cache_key'):
+        key = result_cache_key(path, file_type, reference_data, api=api, openag=openag, orgids=orgids)
+    result = get_cached_result(key)
+    if result is not None:
+        logger.info('Using cached results %s for %s', key, path)
+        return result
+
+    with pin_reference_data(reference_data):
+        result = check()
+    if not (result.get('org_refs') or {}).get('error'):
+        set_cached_result(key, result)
+    return result
@@ -1,37 +1,254 @@
+import logging
 import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
 from urllib.parse import urljoin
 
+import defusedxml.lxml as etree
+import lxml.etree
 import requests
 from django.conf import settings
 
 config = settings.COVE_CONFIG
 
+logger = logging.getLogger(__name__)
+
 current_dir = os.path.dirname(os.path.realpath(__file__))
 
+SchemaCacheInfo = namedtuple('SchemaCacheInfo', ['hits', 'misses', 'currsize'])
+
+XSD_NAMESPACE = 'http://www.w3.org/2001/XMLSchema'
+
+# (paths of the schema's files, their modification times, compiled schema) by (schema path, version)
+_compiled_schemas = {}
+_compiled_schemas_lock = threading.Lock()
+_compiled_schemas_stats = {'hits': 0, 'misses': 0}
+
 
 class SchemaIATI():
+    '''The paths of the schema files for a version of the IATI standard, in the local store'''
     default_schema_host = config['schema_host']
     default_version = config['schema_version']
+    default_schema_root = os.path.normpath(
+        os.path.join(current_dir, '../../', config['app_name'], config['schema_directory']))
     activity_schema_name = config['core_schema']['activity']
     organisation_schema_name = config['core_schema']['organisation']
     common_schema_name = config['supplementary_schema']['common']
     xml_schema_name = config['supplementary_schema']['xml']
+    schema_names = [activity_schema_name, organisation_schema_name, common_schema_name, xml_schema_name]
 
-    def __init__(self, select_version=None):
+    def __init__(self, select_version=None, schema_root=None):
         self.version = select_version or self.default_version
+        self.schema_root = schema_root or self.default_schema_root
         self.schema_host = '{}/version-{}/'.format(self.default_schema_host, self.version)
-        self.schema_directory = os.path.join(current_dir, '../../', config['app_name'], config['schema_directory'], self.version)
-
-        if not os.path.isdir(self.schema_directory):
-            os.makedirs(self.schema_directory)
-
-            for filename in [self.activity_schema_name, self.organisation_schema_name,
-                             self.common_schema_name, self.xml_schema_name]:
-                with open(os.path.join(self.schema_directory, filename), 'w') as schema_file:
-                    schema_file_url = urljoin(self.schema_host, filename)
-                    xml_text = requests.get(schema_file_url).text
-                    schema_file.write(xml_text)
+        self.schema_directory = os.path.join(self.schema_root, self.version)
 
         self.activity_schema = os.path.join(self.schema_directory, self.activity_schema_name)
         self.organisation_schema = os.path.join(self.schema_directory, self.organisation_schema_name)
         self.common_schema = os.path.join(self.schema_directory, self.common_schema_name)
+
+        # The codelists and their mapping aren't published with the schemas, so versions
+        # fetched by `SchemaRegistry` only have the schema files. Their data is checked against
+        # the codelists (and mapping) of the default version, which can differ from those of
+        # their own version, e.g. in codes added or withdrawn since.
+        if os.path.exists(os.path.join(self.schema_directory, 'mapping.xml')):
+            self.codelist_version = self.version
+        else:
+            self.codelist_version = self.default_version
+        self.codelist_directory = os.path.join(self.schema_root, self.codelist_version)
+
+
+VERSION_RE = re.compile(r'^\d+\.\d+$')
+
+
+def fetch_schema_version(version, schema_root=None):
+    '''Download the schema files for version into the local store
+
+    They are downloaded into a temporary directory that is then moved into place, so a
+    version's directory only exists once it has every file.
+    '''
+    schema_iati = SchemaIATI(version, schema_root)
+    fetch_dir = tempfile.mkdtemp(dir=schema_iati.schema_root, prefix='.fetch-{}-'.format(version))
+    try:
+        for filename in schema_iati.schema_names:
+            request = settings.REQUESTS_SESSION_WITH_CACHING.get(urljoin(schema_iati.schema_host, filename))
+            request.raise_for_status()
+            # check it's XML before it's used
+            etree.fromstring(request.content)
+            with open(os.path.join(fetch_dir, filename), 'wb') as schema_file:
+                schema_file.write(request.content)
+        os.rename(fetch_dir, schema_iati.schema_directory)
+    finally:
+        shutil.rmtree(fetch_dir, ignore_errors=True)
+    return schema_iati
+
+
+class SchemaRegistry():
+    '''A `SchemaIATI` for each version of the IATI standard in the local store (`iati_schemas`).
+
+    `load` compiles the schemas of every version in the store, e.g. when a web worker starts,
+    and starts fetching any in settings.IATI_SCHEMA_VERSIONS that aren't there. `get` returns
+    the schema for the version of a file (its root element's @version), or for the default
+    version if that version isn't in the store. A supported version that isn't in the store is
+    fetched in the background, once per process, for the files checked after it has been
+    fetched, so the checks never wait on the network.
+
+    The versions in the store are listed once, and again by `load` and after each fetch, so
+    checking a file of any version doesn't look at the store.
+    '''
+    def __init__(self, schema_root=None):
+        self.schema_root = schema_root or SchemaIATI.default_schema_root
+        self._schemas = {}
+        self._versions = None
+        self._lock = threading.Lock()
+        self._fetch_threads = {}
+
+    def versions(self, refresh=False):
+        '''Return the versions in the local store'''
+        versions = self._versions
+        if versions is None or refresh:
+            versions = self._versions = sorted(
+                version for version in os.listdir(self.schema_root)
+                if VERSION_RE.match(version) and all(
+                    os.path.exists(os.path.join(self.schema_root, version, filename))
+                    for filename in SchemaIATI.schema_names)
+            )
+        return versions
+
+    def load(self):
+        versions = self.versions(refresh=True)
+        for version in versions:
+            schema_iati = self.get(version)
+            for schema_path in [schema_iati.activity_schema, schema_iati.organisation_schema]:
+                compiled_schema(schema_path, schema_iati.version)
+        with self._lock:
+            for version in settings.IATI_SCHEMA_VERSIONS:
+                if version not in versions:
+                    self.fetch_in_background(version)
+
+    def get(self, version=None):
+        '''Return the `SchemaIATI` for version, or the default version if it isn't in the store yet'''
+        version = (version or '').strip() or SchemaIATI.default_version
+        schema_iati = self._schemas.get(version)
+        if schema_iati is not None:
+            return schema_iati
+
+        with self._lock:
+            if version == SchemaIATI.default_version or version in self.versions():
+                schema_iati = self._schemas[version] = SchemaIATI(version, self.schema_root)
+                return schema_iati
+            if version in settings.IATI_SCHEMA_VERSIONS:
+                self.fetch_in_background(version)
+        return self.get(SchemaIATI.default_version)
+
+    def fetch_in_background(self, version):
+        if version in self._fetch_threads:
+            return self._fetch_threads[version]
+        fetch_thread = threading.Thread(target=self._fetch, args=(version,), name='schema-fetch-' + version,
+                                        daemon=True)
+        self._fetch_threads[version] = fetch_thread
+        fetch_thread.start()
+        return fetch_thread
+
+    def _fetch(self, version):
+        try:
+            schema_iati = fetch_schema_version(version, self.schema_root)
+            for schema_path in [schema_iati.activity_schema, schema_iati.organisation_schema]:
+                compiled_schema(schema_path, version)
+            self.versions(refresh=True)
+        except OSError:
+            # e.g. another process fetched it first
+            if version not in self.versions(refresh=True):
+                logger.exception('Could not fetch version %s of the IATI schemas', version)
+        except (requests.RequestException, lxml.etree.LxmlError, ValueError):
+            logger.exception('Could not fetch version %s of the IATI schemas', version)
+
+    def cache_key(self):
+        '''Return what the results of checking a file depend on, for `cove_iati.lib.result_cache`'''
+        return [SchemaIATI.default_version] + self.versions()
+
+
+schema_registry = SchemaRegistry()
+
+
+def schema_files(schema_tree, schema_path):
+    '''Return the paths of the XSD at schema_path, parsed as schema_tree, and of every local XSD
+    it includes or imports, and they include or import, in turn'''
+    paths = [schema_path]
+    pending = [(schema_tree, schema_path)]
+    while pending:
+        tree, path = pending.pop()
+        for location in tree.xpath('/xsd:schema/xsd:include/@schemaLocation | /xsd:schema/xsd:import/@schemaLocation',
+                                   namespaces={'xsd': XSD_NAMESPACE}):
+            if '://' in location:
+                continue
+            location = os.path.realpath(os.path.join(os.path.dirname(path), location))
+            if location not in paths and os.path.exists(location):
+                paths.append(location)
+                with open(location) as schema_fp:
+                    pending.append((etree.parse(schema_fp), location))
+    return paths
+
+
+def _mtimes(paths):
+    return tuple(os.path.getmtime(path) for path in paths)
+
+
+def compiled_schema(schema_path, version=None):
+    '''Return a compiled lxml XMLSchema for the XSD at schema_path.
+
+    Compiled schemas are kept for the lifetime of the process, keyed by schema
+    path and version. A schema is compiled again, replacing the one kept, when
+    the modification time of its file, or of any file it includes or imports
+    (iati-common.xsd and xml.xsd), changes.
+    '''
+    schema_path = os.path.realpath(schema_path)
+    key = (schema_path, version)
+
+    with _compiled_schemas_lock:
+        cached = _compiled_schemas.get(key)
+        if cached is not None:
+            paths, mtimes, schema = cached
+            try:
+                if _mtimes(paths) == mtimes:
+                    _compiled_schemas_stats['hits'] += 1
+                    return schema
+            except OSError:
+                pass
+
+        _compiled_schemas_stats['misses'] += 1
+        with open(schema_path) as schema_fp:
+            schema_tree = etree.parse(schema_fp)
+        paths = schema_files(schema_tree, schema_path)
+        mtimes = _mtimes(paths)
+        schema = lxml.etree.XMLSchema(schema_tree)
+        _compiled_schemas[key] = (paths, mtimes, schema)
+
+    return schema
+
+
+def compiled_schema_cache_info():
+    '''Return hit/miss counters and size of the compiled schema cache'''
+    with _compiled_schemas_lock:
+        return SchemaCacheInfo(_compiled_schemas_stats['hits'], _compiled_schemas_stats['misses'],
+                               len(_compiled_schemas))
+
+
+def compiled_schema_cache_clear():
+    with _compiled_schemas_lock:
+        _compiled_schemas.clear()
+        _compiled_schemas_stats['hits'] = 0
+        _compiled_schemas_stats['misses'] = 0
+
+
+def warm_schema_cache(select_version=None):
+    '''Compile the activity and organisation schemas ahead of the first request, for every version in the store'''
+    if select_version is None:
+        schema_registry.load()
+        return
+    schema_iati = schema_registry.get(select_version)
+    for schema_path in [schema_iati.activity_schema, schema_iati.organisation_schema]:
+        compiled_schema(schema_path, schema_iati.version)
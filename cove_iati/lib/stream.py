@@ -0,0 +1,146 @@
+'''
+Streaming support for IATI XML files too large to hold in memory as one tree.
+
+`iter_root_children` reads a file with `lxml.etree.iterparse` and hands over each
+child of the root element (an `iati-activity` or `iati-organisation`) as soon as it
+has been parsed, clearing it once the next one is requested, so memory is bounded
+by the largest activity rather than the whole file.
+
+Because earlier activities have been removed from the tree (and later ones may not
+have been parsed yet), `tree.getpath` no longer gives an element's xpath in the whole
+document; `DocumentPaths` rewrites xpaths to what they would be.
+'''
+import os
+
+import defusedxml.lxml
+import lxml.etree
+from django.conf import settings
+
+
+def use_streaming(data_file):
+    '''Whether a file is large enough to be checked in streaming mode, or activity results are reused'''
+    if settings.INCREMENTAL_CHECKS:
+        return True
+    min_file_size = settings.STREAMING_MIN_FILE_SIZE
+    return min_file_size is not None and os.path.getsize(data_file) >= min_file_size
+
+
+def get_root_tag(data_file):
+    '''Return the tag of the root element of data_file, reading no further than its start tag'''
+    return get_root_start(data_file)[0]
+
+
+def get_root_start(data_file):
+    '''Return the tag and attributes of the root element of data_file, reading no further than its start tag'''
+    with open(data_file, 'rb') as fp:
+        for _, root in lxml.etree.iterparse(fp, events=('start',), resolve_entities=False, no_network=True):
+            return root.tag, dict(root.attrib)
+
+
+def iter_root_children(data_file):
+    '''Yield (root, None) once the root element has started, then (root, child) for each child of root
+
+    Each child has been parsed completely, with all its descendants, and is the first element in
+    root: everything before it has been removed, except the text, comments and processing
+    instructions since the previous element. It is cleared when the next child is requested.
+    As with `get_tree`, entities are not resolved and documents declaring entities are rejected.
+    '''
+    with open(data_file, 'rb') as fp:
+        root = None
+        depth = 0
+        events = lxml.etree.iterparse(fp, events=('start', 'end'), resolve_entities=False, no_network=True)
+        for event, element in events:
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = element
+                    defusedxml.lxml.check_docinfo(root.getroottree())
+                    yield root, None
+                continue
+
+            depth -= 1
+            if depth == 1:
+                previous = element.getprevious()
+                while previous is not None and not isinstance(previous.tag, str):
+                    previous = previous.getprevious()
+                if previous is not None:
+                    # keep what's between the previous element and this one, which schema validation checks
+                    root.text = previous.tail
+                    while root[0] is not previous:
+                        del root[0]
+                    del root[0]
+                yield root, element
+                element.clear(keep_tail=True)
+
+
+def nodes_before(element):
+    '''Return the text, and the comments and processing instructions, between element and the
+    previous element (or the start of its parent)'''
+    nodes = []
+    previous = element.getprevious()
+    while previous is not None and not isinstance(previous.tag, str):
+        nodes.append(previous)
+        previous = previous.getprevious()
+    text = element.getparent().text if previous is None else previous.tail
+    return text, nodes[::-1]
+
+
+def nodes_at_end(parent):
+    '''Return the text, and the comments and processing instructions, after the last element in parent'''
+    nodes = []
+    for node in reversed(parent):
+        if isinstance(node.tag, str):
+            return node.tail, nodes[::-1]
+        nodes.append(node)
+    return parent.text, nodes[::-1]
+
+
+class DocumentPaths():
+    '''Rewrite the xpaths of elements in the child of root being checked to their xpaths in the whole document.
+
+    Call `start_child` for every child of root, in document order. Paths returned while
+    streaming always index the child (e.g. `/iati-activities/iati-activity[1]/...`); once the
+    whole document has been read, `finalize` drops the index where the whole document has only
+    one child with that name, as `getpath` does.
+    '''
+    def __init__(self, root):
+        self.tree = root.getroottree()
+        self.root_xpath = self.tree.getpath(root)
+        self.counts = {}
+        self.current_xpath = None
+        self.document_xpath = None
+
+    @classmethod
+    def only_child(cls, child, document_xpath):
+        '''Return the paths for a child of root that is on its own, in a copy of the document
+        with no other children, rather than in the whole document where its xpath is document_xpath'''
+        document_paths = cls(child.getparent())
+        document_paths.current_xpath = document_paths.tree.getpath(child)
+        document_paths.document_xpath = document_xpath
+        return document_paths
+
+    def start_child(self, child):
+        self.current_xpath = self.tree.getpath(child)
+        name = self.current_xpath[len(self.root_xpath) + 1:].split('[', 1)[0]
+        count = self.counts.get(name, 0) + 1
+        self.counts[name] = count
+        self.document_xpath = '{}/{}[{}]'.format(self.root_xpath, name, count)
+
+    def getpath(self, element):
+        return self.rewrite(self.tree.getpath(element))
+
+    def rewrite(self, xpath):
+        '''Rewrite an xpath in the current child of root, leaving others alone'''
+        current_xpath = self.current_xpath
+        if xpath == current_xpath or xpath.startswith(current_xpath + '/'):
+            return self.document_xpath + xpath[len(current_xpath):]
+        return xpath
+
+    def finalize(self, xpath):
+        prefix = self.root_xpath + '/'
+        if not xpath.startswith(prefix):
+            return xpath
+        segment, separator, rest = xpath[len(prefix):].partition('/')
+        if segment.endswith('[1]') and self.counts.get(segment[:-len('[1]')]) == 1:
+            return prefix + segment[:-len('[1]')] + separator + rest
+        return xpath
@@ -0,0 +1,177 @@
+'''
+Synthetic IATI activity and organisation files, for benchmarking the checks at scale.
+
+Each activity or organisation is made as one row of a flat spreadsheet, with flatten-tool
+style headings (e.g. `recipient-country/0/@code`), then written as XML, XLSX or CSV. A
+given share of them, chosen at random but the same for the same seed, have one error of
+each kind:
+
+* schema: a missing title (or name, for organisations), which the schema requires;
+* ruleset: an activity end date before its start date (rulesets don't check organisations);
+* codelist: a code that isn't in an embedded codelist.
+
+Files are written one row at a time, so that files of 100k activities don't need to be held
+in memory.
+'''
+import csv
+import random
+
+import lxml.etree
+
+FILE_TYPES = ['xml', 'xlsx', 'csv']
+
+ROOTS = {
+    'activities': ('iati-activities', 'iati-activity', 'iati-identifier'),
+    'organisations': ('iati-organisations', 'iati-organisation', 'organisation-identifier'),
+}
+
+SCHEMA_VERSION = '2.03'
+REPORTING_ORG_REF = 'AA-AAA-123456789'
+
+
+def activity_row(index, schema_error=False, ruleset_error=False, codelist_error=False):
+    '''Return the flat row for an activity, with headings in the order of the activity schema'''
+    return {
+        'iati-identifier': '{}-{:06d}'.format(REPORTING_ORG_REF, index),
+        'reporting-org/@ref': REPORTING_ORG_REF,
+        'reporting-org/@type': '40',
+        'reporting-org/narrative': 'Reporting organisation',
+        'title/narrative': '' if schema_error else 'Activity {}'.format(index),
+        'description/narrative': 'A description of activity {}'.format(index),
+        'participating-org/@role': '1',
+        'participating-org/@ref': REPORTING_ORG_REF,
+        'activity-status/@code': '99' if codelist_error else '2',
+        'activity-date/0/@type': '1',
+        'activity-date/0/@iso-date': '2012-01-01' if ruleset_error else '2010-01-01',
+        'activity-date/1/@type': '3',
+        'activity-date/1/@iso-date': '2011-01-01',
+        'recipient-country/0/@code': 'AF',
+        'recipient-country/0/@percentage': '60',
+        'recipient-country/1/@code': 'XK',
+        'recipient-country/1/@percentage': '40',
+        'sector/@vocabulary': '1',
+        'sector/@code': '11110',
+        'transaction/0/transaction-type/@code': '2',
+        'transaction/0/transaction-date/@iso-date': '2010-06-01',
+        'transaction/0/value': '1000',
+        'transaction/0/value/@value-date': '2010-06-01',
+    }
+
+
+def organisation_row(index, schema_error=False, ruleset_error=False, codelist_error=False):
+    '''Return the flat row for an organisation, with headings in the order of the organisation schema'''
+    return {
+        '@last-updated-datetime': '2014-09-10T07:15:37Z',
+        '@default-currency': 'USD',
+        'organisation-identifier': 'AA-AAA-{:09d}'.format(index),
+        'name/narrative': '' if schema_error else 'Organisation {}'.format(index),
+        'reporting-org/@ref': 'AA-AAA-{:09d}'.format(index),
+        'reporting-org/@type': '40',
+        'reporting-org/narrative': 'Organisation {}'.format(index),
+        'total-budget/@status': '9' if codelist_error else '2',
+        'total-budget/period-start/@iso-date': '2014-01-01',
+        'total-budget/period-end/@iso-date': '2014-12-31',
+        'total-budget/value': '250000',
+        'total-budget/value/@currency': 'USD',
+        'total-budget/value/@value-date': '2014-01-01',
+    }
+
+
+ROW_FUNCTIONS = {
+    'activities': activity_row,
+    'organisations': organisation_row,
+}
+
+
+def synthetic_rows(count, root='activities', schema_error_rate=0, ruleset_error_rate=0, codelist_error_rate=0,
+                   seed=0):
+    '''Yield count flat rows, with errors at the given rates (between 0 and 1)'''
+    rng = random.Random(seed)
+    row_function = ROW_FUNCTIONS[root]
+    for index in range(count):
+        yield row_function(
+            index,
+            schema_error=rng.random() < schema_error_rate,
+            ruleset_error=rng.random() < ruleset_error_rate,
+            codelist_error=rng.random() < codelist_error_rate,
+        )
+
+
+def _headings(root):
+    return list(ROW_FUNCTIONS[root](0))
+
+
+def row_to_element(row, tag):
+    '''Unflatten a row into an element, creating children in the order of the headings'''
+    element = lxml.etree.Element(tag)
+    for heading, value in row.items():
+        # empty cells don't make elements, as in flatten-tool
+        if value in (None, ''):
+            continue
+        parent = element
+        parts = heading.split('/')
+        for position, part in enumerate(parts):
+            if part.isdigit():
+                continue
+            if part.startswith('@'):
+                parent.set(part[1:], value)
+                break
+            index = int(parts[position + 1]) if position + 1 < len(parts) and parts[position + 1].isdigit() else 0
+            children = [child for child in parent if child.tag == part]
+            while len(children) <= index:
+                children.append(lxml.etree.SubElement(parent, part))
+            parent = children[index]
+        else:
+            parent.text = value
+    return element
+
+
+def write_xml(path, rows, root='activities'):
+    root_tag, child_tag, _ = ROOTS[root]
+    with lxml.etree.xmlfile(path, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element(root_tag, version=SCHEMA_VERSION):
+            for row in rows:
+                xf.write(row_to_element(row, child_tag), pretty_print=True)
+
+
+def write_csv(path, rows, root='activities'):
+    # flatten-tool reads a single CSV file as activities, there is nowhere to say otherwise
+    if root != 'activities':
+        raise ValueError('Only activities can be written as CSV')
+    with open(path, 'w', newline='', encoding='utf-8') as fp:
+        writer = csv.DictWriter(fp, _headings(root))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_xlsx(path, rows, root='activities'):
+    import openpyxl
+
+    root_tag, child_tag, id_name = ROOTS[root]
+    headings = _headings(root)
+    workbook = openpyxl.Workbook(write_only=True)
+    # the Meta sheet that flatten-tool reads the root element and version from, as in the fixtures
+    meta = workbook.create_sheet('Meta')
+    meta.append(['#', 'XMLRootTag {}'.format(root_tag), 'RootListPath {}'.format(child_tag),
+                 'IDName {}'.format(id_name)])
+    meta.append(['@version', SCHEMA_VERSION])
+    sheet = workbook.create_sheet('Sheet1')
+    sheet.append(headings)
+    for row in rows:
+        sheet.append([row.get(heading) for heading in headings])
+    workbook.save(path)
+
+
+WRITERS = {
+    'xml': write_xml,
+    'xlsx': write_xlsx,
+    'csv': write_csv,
+}
+
+
+def write_synthetic_file(path, file_type, count, root='activities', schema_error_rate=0, ruleset_error_rate=0,
+                         codelist_error_rate=0, seed=0):
+    '''Write a synthetic file of count activities or organisations to path'''
+    rows = synthetic_rows(count, root, schema_error_rate, ruleset_error_rate, codelist_error_rate, seed)
+    WRITERS[file_type](path, rows, root)
@@ -0,0 +1,135 @@
+'''
+Timing and memory instrumentation for the stages of the checks.
+
+A stage wrapped in `timed(name)` is logged with its wall time, CPU time and how much it
+raised the peak resident set size (RSS) of the process. These numbers are added to:
+
+* the timings being recorded by `record_timings` in the same thread, e.g. for the
+  `timings` block of the API and command line output;
+* this process's running totals, which `prometheus_metrics` formats for scraping.
+
+Stages that run many times per file (each ruleset feature file, once per activity)
+are counted in a dict of their own with `count_timing`, without logging or locking for each
+run, and added to the timings once with `add_timings`.
+'''
+import logging
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_recorder = threading.local()
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+def peak_rss():
+    '''Return the peak RSS of this process so far, in bytes'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _add(timings, name, count, wall_time, cpu_time, peak_rss_delta):
+    timing = timings.get(name)
+    if timing is None:
+        timing = timings[name] = {'count': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss_delta': 0}
+    timing['count'] += count
+    timing['wall_time'] += wall_time
+    timing['cpu_time'] += cpu_time
+    timing['peak_rss_delta'] += peak_rss_delta
+
+
+@contextmanager
+def record_timings():
+    '''Record the timings of the stages that run in this thread while the block runs.
+
+    The yielded dict maps stage names to their count, wall_time and cpu_time (in seconds)
+    and peak_rss_delta (in bytes), summed over every time the stage ran.
+    '''
+    previous = getattr(_recorder, 'timings', None)
+    _recorder.timings = {}
+    try:
+        yield _recorder.timings
+    finally:
+        _recorder.timings = previous
+
+
+def count_timing(timings, name, wall_time, cpu_time):
+    '''Count a run of a stage in timings, a dict of timings to be added later with `add_timings`'''
+    _add(timings, name, 1, wall_time, cpu_time, 0)
+
+
+def add_timing(name, wall_time, cpu_time, peak_rss_delta=0, count=1):
+    '''Add a run of a stage (or count runs, with their total times) to the timings'''
+    timings = getattr(_recorder, 'timings', None)
+    if timings is not None:
+        _add(timings, name, count, wall_time, cpu_time, peak_rss_delta)
+    with _totals_lock:
+        _add(_totals, name, count, wall_time, cpu_time, peak_rss_delta)
+
+
+def add_timings(timings):
+    '''Add timings recorded elsewhere, e.g. in another process or by `count_timing`, to the timings'''
+    recorded = getattr(_recorder, 'timings', None)
+    with _totals_lock:
+        for name, timing in timings.items():
+            args = (name, timing['count'], timing['wall_time'], timing['cpu_time'], timing['peak_rss_delta'])
+            if recorded is not None:
+                _add(recorded, *args)
+            _add(_totals, *args)
+
+
+@contextmanager
+def timed(name):
+    '''Time the block as a run of the stage called name.
+
+    CPU time is that of the current thread, so doesn't include other threads or
+    processes doing work for the stage.
+    '''
+    peak_rss_before = peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.thread_time() - cpu_start
+        peak_rss_delta = peak_rss() - peak_rss_before
+        logger.info('%s took %.3fs (%.3fs CPU, peak RSS +%d bytes)', name, wall_time, cpu_time, peak_rss_delta,
+                    extra={'stage': name, 'wall_time': wall_time, 'cpu_time': cpu_time,
+                           'peak_rss_delta': peak_rss_delta})
+        add_timing(name, wall_time, cpu_time, peak_rss_delta)
+
+
+def _label_value(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+METRICS = (
+    ('count', 'cove_iati_stage_runs_total', 'Number of times each stage of the checks has run'),
+    ('wall_time', 'cove_iati_stage_wall_seconds_total', 'Wall time spent in each stage of the checks'),
+    ('cpu_time', 'cove_iati_stage_cpu_seconds_total', 'CPU time spent in each stage of the checks'),
+    ('peak_rss_delta', 'cove_iati_stage_peak_rss_increase_bytes_total',
+     'Increase in the peak resident set size of the process during each stage of the checks'),
+)
+
+
+def prometheus_metrics():
+    '''Return this process's totals in the Prometheus text exposition format'''
+    with _totals_lock:
+        totals = {name: dict(timing) for name, timing in _totals.items()}
+
+    lines = []
+    for key, metric, help_text in METRICS:
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} counter'.format(metric))
+        for name, timing in sorted(totals.items()):
+            lines.append('{}{{stage="{}"}} {}'.format(metric, _label_value(name), timing[key]))
+    lines.append('# HELP cove_iati_peak_rss_bytes Peak resident set size of the process')
+    lines.append('# TYPE cove_iati_peak_rss_bytes gauge')
+    lines.append('cove_iati_peak_rss_bytes {}'.format(peak_rss()))
+    return '\n'.join(lines) + '\n'
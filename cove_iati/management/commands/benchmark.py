@@ -0,0 +1,187 @@
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from cove_iati.lib.api import iati_json_output
+from cove_iati.lib.iati import (
+    check_activity_org_refs, common_checks_context_iati, get_tree, get_xml_validation_errors,
+    validate_against_schema
+)
+from cove_iati.lib.process_codelists import embedded_codelists, invalid_codelist_values
+from cove_iati.lib.schema import SchemaIATI
+from cove_iati.lib.stream import use_streaming
+from cove_iati.lib.synthetic import FILE_TYPES, ROOTS, write_synthetic_file
+from cove_iati.lib.timing import peak_rss
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def entry_points(file_type, root):
+    '''Return (name, setup, function) for each entry point to benchmark with a file.
+
+    Each function takes the path of the file, a fresh output directory and what setup (if
+    not None) returns for the file, e.g. its tree, which isn't included in the time.
+    '''
+    schema_iati = SchemaIATI()
+
+    points = [('iati_json_output', None,
+               lambda data_file, output_dir, setup: iati_json_output(
+                   output_dir, data_file, timings=True, result_cache=False))]
+    if file_type != 'xml':
+        return points
+
+    schema_path = schema_iati.activity_schema if root == 'activities' else schema_iati.organisation_schema
+
+    def parse(data_file):
+        return None if use_streaming(data_file) else get_tree(data_file)
+
+    def validate(data_file):
+        return validate_against_schema(schema_path, get_tree(data_file), schema_iati.version)[0]
+
+    points += [
+        ('common_checks_context_iati', parse,
+         lambda data_file, output_dir, tree: common_checks_context_iati(
+             {'file_type': 'xml'}, output_dir, data_file, 'xml', tree, api=True)),
+        ('invalid_codelist_values', None,
+         lambda data_file, output_dir, setup: invalid_codelist_values(
+             embedded_codelists(schema_iati.schema_directory), data_file)),
+        ('get_xml_validation_errors', validate,
+         lambda data_file, output_dir, errors: get_xml_validation_errors(errors, 'xml', {})),
+    ]
+    if root == 'activities':
+        points.append(('check_activity_org_refs', get_tree,
+                       lambda data_file, output_dir, tree: check_activity_org_refs(tree)))
+    return points
+
+
+def summary(values):
+    return {'min': min(values), 'median': statistics.median(values), 'max': max(values)}
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the checks with synthetic IATI files, writing the results as JSON '
+            'so they can be compared across commits')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--activities', '-n', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000],
+                            help='Numbers of activities (or organisations) in the files to check')
+        parser.add_argument('--file-types', '-f', nargs='+', choices=FILE_TYPES, default=FILE_TYPES)
+        parser.add_argument('--roots', nargs='+', choices=list(ROOTS), default=list(ROOTS),
+                            help='Whether to check activity files, organisation files or both. Organisations '
+                            "can't be written as CSV, so aren't checked as CSV")
+        parser.add_argument('--schema-error-rate', type=float, default=0.1,
+                            help='Share of activities with a schema error, between 0 and 1')
+        parser.add_argument('--ruleset-error-rate', type=float, default=0.1,
+                            help='Share of activities with a ruleset error, between 0 and 1')
+        parser.add_argument('--codelist-error-rate', type=float, default=0.1,
+                            help='Share of activities with a codelist error, between 0 and 1')
+        parser.add_argument('--repeat', '-r', type=int, default=3,
+                            help='Number of timed runs of each entry point, after one untimed run')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for choosing which activities have errors')
+        parser.add_argument('--output', '-o', help='File to write the results to (default stdout)')
+        parser.add_argument('--compare', '-c', help='Results of an earlier run, to compare median times with')
+
+    def handle(self, *args, **options):
+        results = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': {key: options[key] for key in [
+                'activities', 'file_types', 'roots', 'schema_error_rate', 'ruleset_error_rate',
+                'codelist_error_rate', 'repeat', 'seed',
+            ]},
+            'benchmarks': [],
+        }
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            for root in options['roots']:
+                for file_type in options['file_types']:
+                    if root == 'organisations' and file_type == 'csv':
+                        continue
+                    for count in options['activities']:
+                        data_file = os.path.join(tmpdirname, '{}-{}.{}'.format(root, count, file_type))
+                        write_synthetic_file(data_file, file_type, count, root,
+                                             schema_error_rate=options['schema_error_rate'],
+                                             ruleset_error_rate=options['ruleset_error_rate'],
+                                             codelist_error_rate=options['codelist_error_rate'],
+                                             seed=options['seed'])
+                        for name, setup, function in entry_points(file_type, root):
+                            benchmark = self.run_benchmark(data_file, setup, function, options['repeat'])
+                            benchmark.update({
+                                'entry_point': name,
+                                'root': root,
+                                'file_type': file_type,
+                                'activities': count,
+                                'file_size': os.path.getsize(data_file),
+                            })
+                            results['benchmarks'].append(benchmark)
+                            self.stderr.write('{entry_point} {root} {file_type} {activities}: '
+                                              '{median:.3f}s'.format(median=benchmark['wall_time']['median'],
+                                                                     **benchmark))
+                        os.remove(data_file)
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fp:
+                fp.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as fp:
+                self.compare(json.load(fp), results)
+
+    def run_benchmark(self, data_file, setup, function, repeat):
+        wall_times = []
+        cpu_times = []
+        peak_rss_before = peak_rss()
+        # the first run compiles schemas and rulesets and loads codelists, as a new process would
+        for run in range(repeat + 1):
+            with tempfile.TemporaryDirectory() as output_dir:
+                argument = setup(data_file) if setup else None
+                wall_start = time.perf_counter()
+                cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+                result = function(data_file, output_dir, argument)
+                cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+                wall_time = time.perf_counter() - wall_start
+            if run:
+                wall_times.append(wall_time)
+                cpu_times.append(cpu_end.ru_utime + cpu_end.ru_stime - cpu_start.ru_utime - cpu_start.ru_stime)
+        benchmark = {
+            'wall_time': summary(wall_times),
+            'cpu_time': summary(cpu_times),
+            'peak_rss_delta': peak_rss() - peak_rss_before,
+        }
+        if isinstance(result, dict) and 'timings' in result:
+            # the stages of the last run, see cove_iati.lib.timing
+            benchmark['timings'] = result['timings']
+        return benchmark
+
+    def compare(self, previous, results):
+        previous_medians = {
+            (benchmark['entry_point'], benchmark['root'], benchmark['file_type'], benchmark['activities']):
+                benchmark['wall_time']['median']
+            for benchmark in previous['benchmarks']
+        }
+        self.stderr.write('Compared with {}:'.format(previous.get('revision') or 'earlier results'))
+        for benchmark in results['benchmarks']:
+            key = (benchmark['entry_point'], benchmark['root'], benchmark['file_type'], benchmark['activities'])
+            if key not in previous_medians:
+                continue
+            median = benchmark['wall_time']['median']
+            self.stderr.write('{} {} {} {}: {:.3f}s -> {:.3f}s ({:+.1%})'.format(
+                *key, previous_medians[key], median,
+                median / previous_medians[key] - 1 if previous_medians[key] else 0))
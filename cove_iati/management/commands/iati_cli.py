@@ -15,15 +15,18 @@ class Command(CoveBaseCommand):
         parser.add_argument('--openag', '-a', action='store_true', help='Run ruleset checks for IATI OpenAg')
         parser.add_argument('--orgids', '-i', action='store_true', help='Check IATI identifier prefixes against '
                             'Org-ids prefixes')
+        parser.add_argument('--timings', '-t', action='store_true', help='Add the time taken by each stage of the '
+                            'checks to the output')
         super(Command, self).add_arguments(parser)
 
     def handle(self, file, *args, **options):
         super(Command, self).handle(file, *args, **options)
         openag = options.get('openag')
         orgids = options.get('orgids')
+        timings = options.get('timings')
 
         try:
-            result = iati_json_output(self.output_dir, file, openag=openag, orgids=orgids)
+            result = iati_json_output(self.output_dir, file, openag=openag, orgids=orgids, timings=timings)
         except APIException as e:
             self.stdout.write(str(e))
             sys.exit(1)
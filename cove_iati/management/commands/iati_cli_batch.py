@@ -0,0 +1,62 @@
+import json
+import os
+import shutil
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from cove_iati.lib.batch import batch_inputs, run_batch, summary
+
+
+class Command(BaseCommand):
+    help = 'Run Command Line version of Cove IATI for many files, writing the output for each and a summary'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help='Files to be processed by Cove, or directories of them')
+        parser.add_argument('--manifest', '-m', help='File listing the files to be processed, one on each line')
+        parser.add_argument('--output-dir', '-o', default='iati_cli_batch',
+                            help='Directory where the output for each file and summary.json are created')
+        parser.add_argument('--processes', '-p', type=int, default=1,
+                            help='Number of files to check at a time, in worker processes (0 for one per CPU)')
+        parser.add_argument('--delete', '-d', action='store_true', help='Delete the output directory if it '
+                            'already exists')
+        parser.add_argument('--exclude-file', '-e', action='store_true', help='Do not include the files in the '
+                            'output directory')
+        parser.add_argument('--openag', '-a', action='store_true', help='Run ruleset checks for IATI OpenAg')
+        parser.add_argument('--orgids', '-i', action='store_true', help='Check IATI identifier prefixes against '
+                            'Org-ids prefixes')
+        parser.add_argument('--timings', '-t', action='store_true', help='Add the time taken by each stage of the '
+                            'checks to the output')
+
+    def handle(self, *args, **options):
+        files = batch_inputs(options['files'], options['manifest'])
+        if not files:
+            self.stdout.write('No files to process')
+            sys.exit(1)
+
+        output_dir = options['output_dir']
+        if os.path.exists(output_dir):
+            if options['delete']:
+                shutil.rmtree(output_dir)
+            else:
+                self.stdout.write('Directory {} already exists'.format(output_dir))
+                sys.exit(1)
+        os.makedirs(output_dir)
+
+        start = time.perf_counter()
+        entries = []
+        for entry in run_batch(files, output_dir, processes=options['processes'] or os.cpu_count(),
+                               openag=options['openag'], orgids=options['orgids'], timings=options['timings'],
+                               exclude_file=options['exclude_file']):
+            entries.append(entry)
+            self.stderr.write('{file}: {status} ({wall_time:.2f}s)'.format(**entry))
+
+        batch_summary = summary(entries, time.perf_counter() - start)
+        with open(os.path.join(output_dir, 'summary.json'), 'w') as summary_file:
+            json.dump(batch_summary, summary_file, indent=2)
+
+        totals = batch_summary['totals']
+        self.stdout.write('Processed {files} files: {ok} ok, {error} could not be checked'.format(**totals))
+        if totals['error']:
+            sys.exit(1)
@@ -0,0 +1,19 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from cove_iati.lib.process_codelists import codelist_store
+
+
+class Command(BaseCommand):
+    help = 'Fetch and parse the non-embedded codelists in parallel, refreshing the shared requests cache'
+
+    def handle(self, *args, **options):
+        codelists = codelist_store.fetch(raise_errors=False)
+        missing = sorted(set(settings.NON_EMBEDDED_CODELISTS_URLS) - set(codelists))
+
+        self.stdout.write('Fetched {} codelists'.format(len(codelists)))
+        if missing:
+            self.stdout.write('Could not fetch: {}'.format(', '.join(missing)))
+            sys.exit(1)
@@ -0,0 +1,19 @@
+import sys
+
+import requests
+from django.core.management.base import BaseCommand
+
+from cove_iati.lib.org_registry import refresh_orgids_prefixes
+
+
+class Command(BaseCommand):
+    help = 'Fetch the org-ids prefixes, saving them to the snapshot the org-ids ruleset reads them from'
+
+    def handle(self, *args, **options):
+        try:
+            prefixes = refresh_orgids_prefixes()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.stdout.write('Could not fetch the org-ids prefixes: {}'.format(e))
+            sys.exit(1)
+
+        self.stdout.write('Fetched {} org-ids prefixes'.format(len(prefixes)))
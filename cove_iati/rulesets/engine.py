@@ -0,0 +1,191 @@
+'''
+Ruleset engine for the Gherkin feature files in cove_iati/rulesets.
+
+Each feature directory is compiled once per process into a list of rules, one
+per scenario, whose steps are already matched to their step definitions. The
+rules are then evaluated for one `iati-activity` element at a time, with errors
+collected in memory by `register_ruleset_errors`, and handed on after each activity.
+
+Step definitions are registered with the `given` and `then` decorators below,
+which accept the same `{name}` placeholder patterns as behave.
+'''
+import glob
+import importlib
+import os
+import re
+import time
+from functools import lru_cache
+
+from cove_iati.lib.timing import add_timings, count_timing
+from cove_iati.rulesets.utils import collect_ruleset_errors
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+STEP_KEYWORDS = ('Given', 'When', 'Then', 'And', 'But')
+
+# The standard ruleset's steps, including the `Given` steps that select
+# elements, are available to every feature directory.
+SHARED_STEP_DEFINITIONS = 'cove_iati.rulesets.iati_standard_v2_ruleset.steps.standard_ruleset_step_definitions'
+
+step_registry = []
+
+
+class UnknownStepError(Exception):
+    pass
+
+
+def _step_regex(pattern):
+    '''Turn a step pattern like "`{xpath}` must be today" into a compiled regex'''
+    parts = re.split(r'{(\w+)}', pattern)
+    regex = ''
+    for index, part in enumerate(parts):
+        if index % 2:
+            regex += '(?P<{}>.+?)'.format(part)
+        else:
+            regex += re.escape(part)
+    return re.compile('^{}$'.format(regex))
+
+
+def _step_decorator(step_type):
+    def register(pattern):
+        def decorator(func):
+            step_registry.append((step_type, _step_regex(pattern), func))
+            return func
+        return decorator
+    return register
+
+
+given = _step_decorator('given')
+then = _step_decorator('then')
+
+
+class Step():
+    def __init__(self, step_type, text):
+        self.step_type = step_type
+        self.text = text
+        for registered_type, regex, func in step_registry:
+            if registered_type != step_type:
+                continue
+            match = regex.match(text)
+            if match:
+                self.func = func
+                self.kwargs = match.groupdict()
+                break
+        else:
+            raise UnknownStepError('No step definition for "{} {}"'.format(step_type.title(), text))
+
+    def __call__(self, context):
+        return self.func(context, **self.kwargs)
+
+
+class Rule():
+    '''A scenario: `given` steps select what to check, `then` steps check it'''
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+
+
+class Feature():
+    def __init__(self, name, rules, stage=None):
+        self.name = name
+        self.rules = rules
+        # the name its timings are recorded under, see `cove_iati.lib.timing`
+        self.stage = stage or 'ruleset feature {}'.format(name)
+
+
+class RuleContext():
+    '''The context object passed to step definitions (behave's `context`)'''
+    def __init__(self, xml, feature, scenario):
+        self.xml = xml
+        self.feature = feature
+        self.scenario = scenario
+        self.xpath_expression = None
+
+
+def parse_feature(feature_path):
+    '''Parse the subset of Gherkin used by the feature files into a Feature'''
+    feature_name = None
+    rules = []
+    step_type = None
+
+    with open(feature_path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith('@'):
+                continue
+            keyword, _, text = line.partition(' ')
+            if line.startswith('Feature:'):
+                feature_name = line[len('Feature:'):].strip()
+            elif line.startswith('Scenario Outline:') or line.startswith('Scenario:'):
+                rules.append(Rule(line.split(':', 1)[1].strip()))
+                step_type = None
+            elif keyword in STEP_KEYWORDS and rules:
+                if keyword == 'Given':
+                    step_type = 'given'
+                elif keyword in ('When', 'Then'):
+                    step_type = 'then'
+                rules[-1].steps.append(Step(step_type, text.strip()))
+
+    stage = 'ruleset feature {}'.format(os.path.join(*feature_path.split(os.sep)[-2:]))
+    return Feature(feature_name, rules, stage)
+
+
+def load_step_definitions(feature_dir):
+    '''Import the step definition modules in the `steps` directory of a feature directory'''
+    importlib.import_module(SHARED_STEP_DEFINITIONS)
+    for path in sorted(glob.glob(os.path.join(feature_dir, 'steps', '*.py'))):
+        module_name = os.path.relpath(os.path.realpath(path), BASE_DIR)[:-len('.py')].replace(os.sep, '.')
+        if module_name.endswith('.__init__'):
+            module_name = module_name[:-len('.__init__')]
+        importlib.import_module(module_name)
+
+
+@lru_cache()
+def compile_ruleset(feature_dir):
+    '''Return the Features for every .feature file in feature_dir, compiled once per process'''
+    feature_dir = os.path.join(BASE_DIR, feature_dir)
+    load_step_definitions(feature_dir)
+    return [parse_feature(feature_path)
+            for feature_path in sorted(glob.glob(os.path.join(feature_dir, '*.feature')))]
+
+
+def check_activity(activity, features, timings=None):
+    '''Check one iati-activity against compiled features and return a flat list of errors
+
+    With timings, a dict, the time taken by each feature is counted in it (see `count_timing`).
+    '''
+    with collect_ruleset_errors() as ruleset_errors:
+        for feature in features:
+            if timings is not None:
+                wall_start = time.perf_counter()
+                cpu_start = time.thread_time()
+            for rule in feature.rules:
+                context = RuleContext(activity, feature, rule)
+                for step in rule.steps:
+                    errors_before = len(ruleset_errors)
+                    step(context)
+                    # Like behave, stop checking a scenario at its first failing step
+                    if len(ruleset_errors) > errors_before:
+                        break
+            if timings is not None:
+                count_timing(timings, feature.stage, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+    return ruleset_errors
+
+
+def apply_ruleset(lxml_etree, feature_dir, add_errors=None):
+    '''Check every iati-activity in the data against a ruleset and return a flat list of errors
+
+    With add_errors, it is called with the errors of each activity as soon as it has been
+    checked, and nothing is returned, so the errors for the whole file needn't be kept.
+    '''
+    features = compile_ruleset(feature_dir)
+    ruleset_errors = None
+    if add_errors is None:
+        ruleset_errors = []
+        add_errors = ruleset_errors.extend
+    timings = {}
+    for activity in lxml_etree.getroot().iterchildren('iati-activity'):
+        add_errors(check_activity(activity, features, timings))
+    add_timings(timings)
+    return ruleset_errors
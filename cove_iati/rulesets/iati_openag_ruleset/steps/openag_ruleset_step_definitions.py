@@ -3,7 +3,7 @@ Adapted from https://github.com/pwyf/bdd-tester/blob/master/steps/standard_rules
 Released under MIT License
 License: https://github.com/pwyf/bdd-tester/blob/master/LICENSE
 '''
-from behave import then
+from cove_iati.rulesets.engine import then
 
 from cove_iati.rulesets.utils import get_child_full_xpath, get_xobjects, register_ruleset_errors
 
@@ -7,7 +7,7 @@ from decimal import Decimal, InvalidOperation
 import datetime
 import re
 
-from behave import given, then
+from cove_iati.rulesets.engine import given, then
 
 from cove_iati.rulesets.utils import invalid_date_format, get_child_full_xpath, get_xobjects, register_ruleset_errors
 
@@ -1,5 +1,9 @@
 import datetime
-from functools import wraps
+import threading
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+
+import lxml.etree
 
 from cove_iati.lib.exceptions import RuleSetStepException
 
@@ -23,15 +27,78 @@ def get_child_full_xpath(parent_xobj, child_xobj):
         return tree.getpath(child_xobj)
 
 
+@lru_cache(maxsize=1024)
+def _compiled_xpath(xpath_expression, namespaces):
+    return lxml.etree.XPath(xpath_expression, namespaces=dict(namespaces))
+
+
+def compiled_xpath(xpath_expression, namespaces=None):
+    '''Return a compiled lxml XPath for an expression and namespace map.
+
+    Compiled expressions are kept in a bounded LRU cache shared by all the
+    ruleset steps; `compiled_xpath_cache_info()` counts compiles (misses) and
+    reuses (hits).
+    '''
+    return _compiled_xpath(xpath_expression, frozenset((namespaces or {}).items()))
+
+
+compiled_xpath_cache_info = _compiled_xpath.cache_info
+compiled_xpath_cache_clear = _compiled_xpath.cache_clear
+
+
 def get_xobjects(xobj, xpath_expression):
     '''Given a xpath, return a list of xml objects out of a parent xml object'''
     nsmap = xobj.getparent().nsmap
-    xobjects = xobj.xpath(xpath_expression, namespaces=nsmap)
+    xobjects = compiled_xpath(xpath_expression, nsmap)(xobj)
     return xobjects
 
 
+_collector = threading.local()
+
+
+@contextmanager
+def collect_ruleset_errors():
+    '''Collect ruleset errors in memory while the block runs.
+
+    Inside the block, steps decorated with `register_ruleset_errors` append
+    their errors to the yielded list as flat error dicts (id, path, rule,
+    explanation, ruleset) instead of raising a RuleSetStepException.
+    '''
+    previous = getattr(_collector, 'errors', None)
+    _collector.errors = []
+    try:
+        yield _collector.errors
+    finally:
+        _collector.errors = previous
+
+
+def ruleset_rule_name(scenario_name):
+    '''Return the rule name shown to users for a scenario name'''
+    return scenario_name.lower().replace('.', '/')
+
+
+def _register_errors(context, errors):
+    collected = getattr(_collector, 'errors', None)
+    if collected is None:
+        raise RuleSetStepException(context, errors)
+
+    activity_ids = compiled_xpath('iati-identifier/text()')(context.xml)
+    rule = ruleset_rule_name(context.scenario.name)
+    for error in errors:
+        collected.append({
+            'id': str(activity_ids[0]) if activity_ids else '',
+            'path': error['path'],
+            'rule': rule,
+            'explanation': error['explanation'],
+            'ruleset': context.feature.name
+        })
+
+
 def register_ruleset_errors(namespaces=None):
-    '''Raise a RuleSetStepException to register errors (bdd-tester/behave).
+    '''Register the errors returned by a ruleset step definition.
+
+    Inside `collect_ruleset_errors`, as used by the ruleset engine, errors are
+    collected in memory; otherwise a RuleSetStepException is raised.
 
     Also, check the date for the presence of declared namespaces required
     to apply the rule.
@@ -52,11 +119,12 @@ def register_ruleset_errors(namespaces=None):
                             'explanation': msg.format(ns, ns),
                             'path': '/iati-activities/@xmlns'
                         }]
-                        raise RuleSetStepException(context, errors)
+                        _register_errors(context, errors)
+                        return
 
             context, errors = func(*args, **kwargs)
             if errors:
-                raise RuleSetStepException(context, errors)
+                _register_errors(context, errors)
 
         return wrapper
     return decorator
@@ -12,7 +12,18 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 env = environ.Env(  # set default values and casting
     DB_NAME=(str, os.path.join(BASE_DIR, 'db.sqlite3')),
     SENTRY_DSN=(str, ''),
-    REQUESTS_CACHE_DIR=(str, os.path.join(BASE_DIR, 'requests_cache_dir'))
+    REQUESTS_CACHE_DIR=(str, os.path.join(BASE_DIR, 'requests_cache_dir')),
+    CODELIST_SNAPSHOT_DIR=(str, os.path.join(BASE_DIR, 'codelist_snapshots')),
+    RESULT_CACHE_DIR=(str, os.path.join(BASE_DIR, 'result_cache')),
+    RESULT_CACHE_MAX_BYTES=(int, 1024 * 1024 * 1024),
+    INCREMENTAL_CHECKS=(bool, False),
+    ACTIVITY_RESULT_STORE_PATH=(str, os.path.join(BASE_DIR, 'activity_results', 'activity_results.sqlite3')),
+    ACTIVITY_RESULT_STORE_MAX_ENTRIES=(int, 1000000),
+    PARALLEL_CHECKS_PROCESSES=(int, 0),
+    EXPLORE_JOB_WORKERS=(int, 0),
+    TIMING_METRICS=(bool, False),
+    IATI_SCHEMA_VERSIONS=(list, ['2.01', '2.02', '2.03']),
+    ERROR_EXAMPLES_LIMIT=(int, 1000),
 )
 
 # We use the setting to choose whether to show the section about Sentry in the
@@ -186,3 +197,58 @@ NON_EMBEDDED_CODELISTS_URLS = {
     'VerificationStatus': 'https://codelists.codeforiati.org/api/xml/VerificationStatus.xml',
     'Version': 'https://codelists.codeforiati.org/api/xml/Version.xml',
 }
+
+# Non-embedded codelists are fetched in parallel and kept in memory by each process,
+# then refreshed in the background once they are older than this
+NON_EMBEDDED_CODELISTS_FETCH_WORKERS = 8
+NON_EMBEDDED_CODELISTS_MAX_AGE = timedelta(days=1)
+
+# Versions of the IATI standard that files are checked against the schema for. Those that
+# aren't in cove_iati/iati_schemas are fetched in the background; files of other versions
+# (and of versions not fetched yet) are checked against COVE_CONFIG['schema_version']
+IATI_SCHEMA_VERSIONS = env('IATI_SCHEMA_VERSIONS')
+
+# The publishers and registration agencies that org refs are checked against are kept in memory
+# by each process, then refreshed in the background once they are older than this
+ORG_REGISTRY_MAX_AGE = timedelta(days=1)
+
+# Parsed codelists are saved here, so new processes don't have to parse the codelist XML again
+CODELIST_SNAPSHOT_DIR = env('CODELIST_SNAPSHOT_DIR')
+
+# The results of checking a file are kept here, shared by every upload of the same file, until
+# the least recently used have to be removed to keep them under RESULT_CACHE_MAX_BYTES (0 to not cache them)
+RESULT_CACHE_DIR = env('RESULT_CACHE_DIR')
+RESULT_CACHE_MAX_BYTES = env('RESULT_CACHE_MAX_BYTES')
+
+# Check XML files one activity at a time, keeping the results for each activity in an SQLite database
+# at ACTIVITY_RESULT_STORE_PATH, so activities that haven't changed since a file was last checked
+# aren't checked again. The least recently used beyond ACTIVITY_RESULT_STORE_MAX_ENTRIES are removed.
+INCREMENTAL_CHECKS = env('INCREMENTAL_CHECKS')
+ACTIVITY_RESULT_STORE_PATH = env('ACTIVITY_RESULT_STORE_PATH')
+ACTIVITY_RESULT_STORE_MAX_ENTRIES = env('ACTIVITY_RESULT_STORE_MAX_ENTRIES')
+
+# XML files at least this many bytes are checked one activity at a time rather than
+# loaded into memory as a whole (None to never stream)
+STREAMING_MIN_FILE_SIZE = 50 * 1024 * 1024
+
+# Streamed files have their activities checked by this many worker processes, in shards
+# of PARALLEL_CHECKS_SHARD_SIZE activities (0 to check them in the request's own process)
+PARALLEL_CHECKS_PROCESSES = env('PARALLEL_CHECKS_PROCESSES')
+PARALLEL_CHECKS_SHARD_SIZE = 200
+
+# The checks for the results page run as jobs in a pool of this many threads in each web worker,
+# while the page shows their progress, refreshing every EXPLORE_JOB_REFRESH_SECONDS
+# (0 to run them in the request, which then waits for the results)
+EXPLORE_JOB_WORKERS = env('EXPLORE_JOB_WORKERS')
+EXPLORE_JOB_REFRESH_SECONDS = 2
+# Checks that failed other than because of the data are run again when the results page is
+# asked for at least this long after they failed
+EXPLORE_JOB_RETRY_SECONDS = 60
+
+# Every error in a file is counted, but only the first ERROR_EXAMPLES_LIMIT of each kind (each
+# validation message, codelist path and ruleset rule) are kept and shown (0 to keep them all)
+ERROR_EXAMPLES_LIMIT = env('ERROR_EXAMPLES_LIMIT')
+
+# Serve the time and memory used by each stage of the checks in this process,
+# in the Prometheus text format, at /metrics (which anyone can see, so it's off by default)
+TIMING_METRICS = env('TIMING_METRICS')
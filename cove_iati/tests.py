@@ -3,16 +3,43 @@ import defusedxml.lxml as etree
 import json
 import lxml.etree
 import os
+import pickle
+import requests
+import shutil
 import uuid
 import tempfile
+import threading
+import time
+from types import SimpleNamespace
 
 from django.core.management import call_command
+from django.utils.safestring import SafeData
+from pytest_localserver.http import WSGIServer
 
 from .lib import iati
 from .lib import api
-from .lib.process_codelists import invalid_embedded_codelist_values
+from .lib.jobs import Job
+from .lib import org_registry
+from .lib import process_codelists
+from .lib.org_registry import OrgidsPrefixes, OrgRegistryStore, PrefixTrie
+from .lib.parallel import ShardedActivityChecks
+from .lib import result_cache
+from .lib.result_cache import ReferenceData, cached_checks, result_cache_key
+from .lib.process_codelists import (
+    CodelistPaths, CodelistStore, ElementPath, check_codelists, embedded_codelists, embedded_codelists_source,
+    invalid_embedded_codelist_values, read_codelist_snapshot, traverse_element
+)
 from .lib.exceptions import RuleSetStepException
-from .rulesets.utils import invalid_date_format, get_child_full_xpath, get_xobjects, register_ruleset_errors
+from .lib.stream import DocumentPaths, iter_root_children
+from .lib.synthetic import write_synthetic_file
+from .lib.schema import (
+    SchemaIATI, SchemaRegistry, compiled_schema, compiled_schema_cache_clear, compiled_schema_cache_info
+)
+from .rulesets.engine import compile_ruleset
+from .rulesets.utils import (
+    invalid_date_format, get_child_full_xpath, get_xobjects, register_ruleset_errors, collect_ruleset_errors,
+    compiled_xpath_cache_clear, compiled_xpath_cache_info
+)
 
 
 XML_SCHEMA = '''
@@ -58,6 +85,22 @@ XML_NS = '''
 '''
 
 
+@pytest.fixture(autouse=True)
+def no_result_cache(settings):
+    # every test checks its data, rather than getting the results of an earlier test
+    settings.RESULT_CACHE_MAX_BYTES = 0
+    # and against the schema in the repository, whatever its version
+    settings.IATI_SCHEMA_VERSIONS = ['2.03']
+
+
+@pytest.fixture()
+def result_cache_dir(settings):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        settings.RESULT_CACHE_DIR = tmpdirname
+        settings.RESULT_CACHE_MAX_BYTES = 1024 * 1024
+        yield tmpdirname
+
+
 @pytest.fixture()
 def validated_data():
     def _validated_data(data):
@@ -69,6 +112,37 @@ def validated_data():
     return _validated_data
 
 
+def test_compiled_schema_cache():
+    compiled_schema_cache_clear()
+    schema_iati = SchemaIATI()
+
+    schema = compiled_schema(schema_iati.activity_schema, schema_iati.version)
+    assert compiled_schema_cache_info() == (0, 1, 1)
+
+    assert compiled_schema(schema_iati.activity_schema, schema_iati.version) is schema
+    assert compiled_schema_cache_info() == (1, 1, 1)
+
+    file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_unordered_valid.xml')
+    iati.validate_against_schema(schema_iati.activity_schema, iati.get_tree(file_path), schema_iati.version)
+    assert compiled_schema_cache_info() == (2, 1, 1)
+
+
+def test_compiled_schema_cache_includes(tmp_path):
+    compiled_schema_cache_clear()
+    schema_directory = str(tmp_path / 'schemas')
+    shutil.copytree(SchemaIATI().schema_directory, schema_directory)
+    schema_path = os.path.join(schema_directory, 'iati-activities-schema.xsd')
+    schema = compiled_schema(schema_path, '2.03')
+
+    # a change to a file the schema includes or imports compiles it again
+    for name in ['iati-common.xsd', 'xml.xsd']:
+        mtime = os.path.getmtime(os.path.join(schema_directory, name)) + 10
+        os.utime(os.path.join(schema_directory, name), (mtime, mtime))
+        assert compiled_schema(schema_path, '2.03') is not schema
+        schema = compiled_schema(schema_path, '2.03')
+    assert compiled_schema_cache_info() == (2, 3, 1)
+
+
 def test_lxml_errors_generator(validated_data):
     validated_data = validated_data(INVALID_DATA)
     expected_error_paths = ['/test-element/a',
@@ -114,6 +188,45 @@ def test_format_lxml_errors(validated_data):
         assert error_dict['message'] in expected_error_messages
 
 
+def test_get_xml_validation_errors_deeply_nested_cell_source():
+    # 24 single item arrays: the error path misses all their indexes
+    elements = ['element-{}'.format(i) for i in range(24)]
+    cell_path = 'iati-activity/0/' + '/0/'.join(elements) + '/0/@attr'
+    cell_source_map = {
+        cell_path: [['Sheet1', 'B', 3, 'header']],
+        cell_path.replace('iati-activity/0/', 'iati-activity/1/'): [['Sheet1', 'B', 4, 'header']],
+    }
+    errors = [{
+        'path': 'iati-activity/1/' + '/'.join(elements) + '/@attr',
+        'message': "'element-23', attribute 'attr' is not a valid value of the atomic type 'xs:integer'.",
+        'value': 'bad',
+        'line': 1,
+    }]
+
+    validation_errors = iati.get_xml_validation_errors(errors, 'xlsx', cell_source_map)
+
+    assert list(validation_errors.values()) == [[{
+        'sheet': 'Sheet1',
+        'col_alpha': 'B',
+        'row_number': 4,
+        'header': 'header',
+        'path': cell_path.replace('iati-activity/0/', 'iati-activity/1/'),
+        'value': 'bad',
+        'line': 1,
+    }]]
+
+
+@pytest.mark.parametrize(('error_path', 'cell_path', 'boolean'), [
+    ('path/to/cell', 'path/0/to/0/cell', True),
+    ('path/0/to/cell', 'path/0/to/0/cell', True),
+    ('path/to/1/cell', 'path/0/to/1/cell', True),
+    ('path/to/cell', 'path/0/to/1/cell', False),
+    ('path/0/to/cell', 'path/to/cell', False),
+])
+def test_is_path_with_zeros_removed(error_path, cell_path, boolean):
+    assert iati.is_path_with_zeros_removed(error_path, cell_path) is boolean
+
+
 @pytest.mark.parametrize(('date_string', 'boolean'), [
     ('2000-01-01', False),
     ('01-01-2000', True),
@@ -131,6 +244,18 @@ def test_get_xobjects():
     assert xobjects[1].attrib.get('id') == 'element2'
 
 
+def test_get_xobjects_compiled_xpath_cache():
+    compiled_xpath_cache_clear()
+    activities_xml = etree.XML(XML_NS)
+    for activity_xml in activities_xml.getchildren():
+        get_xobjects(activity_xml, 'element')
+        get_xobjects(activity_xml, 'element')
+
+    cache_info = compiled_xpath_cache_info()
+    assert cache_info.misses == 1
+    assert cache_info.hits == 1
+
+
 def test_get_full_xpath():
     expected_full_xpath = '/iati-activities/iati-activity/element[1]'
     activities_xml = etree.XML(XML_NS)
@@ -178,6 +303,44 @@ def test_register_ruleset_errors_decorator():
     assert e.value.args == (context, errors_ns)
 
 
+def test_register_ruleset_errors_collected():
+    @register_ruleset_errors()
+    def decorated_func_errors(context):
+        return context, [{'explanation': 'an explanation', 'path': '/iati-activities/iati-activity'}]
+
+    @register_ruleset_errors(['undefined_ns'])
+    def decorated_func_no_ns(context):
+        return context, []
+
+    class Feature():
+        name = 'feature name'
+
+    class Scenario():
+        name = 'element.@attribute must be present'
+
+    class Context():
+        xml = etree.XML(XML_NS).getchildren()[0]
+        feature = Feature()
+        scenario = Scenario()
+
+    context = Context()
+
+    with collect_ruleset_errors() as ruleset_errors:
+        decorated_func_errors(context)
+        decorated_func_no_ns(context)
+
+    assert ruleset_errors == [
+        {'id': '', 'path': '/iati-activities/iati-activity', 'rule': 'element/@attribute must be present',
+         'explanation': 'an explanation', 'ruleset': 'feature name'},
+        {'id': '', 'path': '/iati-activities/@xmlns', 'rule': 'element/@attribute must be present',
+         'explanation': 'rule not applied: the data does not define "undefined_ns" namespace (@xmlns:undefined_ns)',
+         'ruleset': 'feature name'},
+    ]
+
+    with pytest.raises(RuleSetStepException):
+        decorated_func_errors(context)
+
+
 @pytest.mark.parametrize(('file_name', 'bad_xml', 'options', 'output'), [
     ('basic_iati_unordered_invalid_iso_dates.xlsx', False, {}, [
         'basic_iati_unordered_invalid_iso_dates.xlsx',
@@ -223,6 +386,39 @@ def test_cove_iati_cli_delete_option():
         call_command('iati_cli', file_path, output_dir=output_dir)
 
 
+@pytest.mark.parametrize('processes', [1, 2])
+def test_cove_iati_cli_batch(tmp_path, processes):
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    for file_name in ('basic_iati_ruleset_errors.xml', 'basic_iati_unordered_valid.csv'):
+        shutil.copy(os.path.join('cove_iati', 'fixtures', file_name), str(input_dir))
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text('# files not in input\n{}\n'.format(
+        os.path.abspath(os.path.join('cove_iati', 'fixtures', 'bad.xml'))))
+    output_dir = str(tmp_path / 'output')
+
+    with pytest.raises(SystemExit):
+        call_command('iati_cli_batch', str(input_dir), manifest=str(manifest), output_dir=output_dir,
+                     processes=processes, exclude_file=True)
+
+    assert sorted(os.listdir(output_dir)) == [
+        'bad', 'basic_iati_ruleset_errors', 'basic_iati_unordered_valid', 'summary.json']
+    with open(os.path.join(output_dir, 'basic_iati_ruleset_errors', 'results.json')) as fp:
+        results = json.load(fp)
+    file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_ruleset_errors.xml')
+    api_results = api.iati_json_output(str(tmp_path / 'api'), file_path)
+    assert results['validation_errors'] == api_results['validation_errors']
+    assert results['ruleset_errors'] == api_results['ruleset_errors']
+
+    with open(os.path.join(output_dir, 'summary.json')) as fp:
+        batch_summary = json.load(fp)
+    assert [entry['status'] for entry in batch_summary['files']] == ['ok', 'ok', 'error']
+    assert batch_summary['files'][0]['ruleset_errors'] == len(results['ruleset_errors'])
+    assert batch_summary['files'][2]['error'].startswith('Not well formed XML')
+    assert batch_summary['totals']['files'] == 3
+    assert batch_summary['totals']['error'] == 1
+
+
 def test_cove_iati_cli_output():
     exp_validation = [{'description': "'activity-date', attribute 'iso-date' is not a valid value of "
                                       "the atomic type 'xs:date'.",
@@ -531,6 +727,54 @@ def test_ruleset_error_exceptions_handling(validated_data):
         )
 
 
+def test_compile_ruleset():
+    features = compile_ruleset('cove_iati/rulesets/iati_org_regex_ruleset/')
+    assert [feature.name for feature in features] == ['Elements must use a valid format']
+    assert len(features[0].rules) == 4
+
+    rule = features[0].rules[0]
+    assert rule.name == 'reporting-org.@ref should match the regex [^\\:\\&\\|\\?]+'
+    assert [step.step_type for step in rule.steps] == ['given', 'then']
+    assert rule.steps[0].kwargs == {'xpath_expression': 'reporting-org'}
+    assert rule.steps[1].kwargs == {'attribute': 'ref', 'regex_str': '^[^\\/\\&\\|\\?]+$'}
+
+    assert compile_ruleset('cove_iati/rulesets/iati_org_regex_ruleset/') is features
+
+
+def test_ruleset_errors_write_output():
+    file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_ruleset_errors.xml')
+    tree = iati.get_tree(file_path)
+    output_dir = os.path.join('media', str(uuid.uuid4()), 'ruleset_org_regex')
+    ruleset_errors = iati.get_iati_ruleset_errors(
+        tree,
+        output_dir,
+        group_by=None,
+        feature_dir='cove_iati/rulesets/iati_org_regex_ruleset/',
+        write_output=True
+    )
+
+    assert len(ruleset_errors) == 4
+    assert len(os.listdir(output_dir)) == 4
+    formatted_errors = iati.format_ruleset_errors(output_dir)
+    assert sorted(formatted_errors, key=lambda i: i['path']) == sorted(ruleset_errors, key=lambda i: i['path'])
+
+
+def test_ruleset_error_examples(tmp_path):
+    tree = iati.get_tree(os.path.join('cove_iati', 'fixtures', 'basic_iati_ruleset_errors.xml'))
+    ruleset_errors = iati.get_iati_ruleset_errors(tree, str(tmp_path / 'all'), group_by=None)
+    output_dir = str(tmp_path / 'limited')
+    error_examples = iati.get_ruleset_error_examples(tree, output_dir, iati.IATI_RULESET, limit=1, write_output=True)
+
+    first_errors = {}
+    for error in ruleset_errors:
+        first_errors.setdefault((error['ruleset'], error['rule']), error)
+    assert error_examples.examples == list(first_errors.values())
+    assert sum(error_examples.counts.values()) == len(ruleset_errors)
+    # every error is still written out
+    assert (sorted(iati.format_ruleset_errors(output_dir), key=json.dumps) ==
+            sorted(ruleset_errors, key=json.dumps))
+
+
 def test_common_checks_context_iati_ruleset():
     file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_unordered_valid.xml')
     upload_dir = os.path.join('media', str(uuid.uuid4()))
@@ -548,6 +792,241 @@ def test_common_checks_context_iati_ruleset():
     assert len(context['org_ruleset_errors']) == 4
 
 
+@pytest.mark.parametrize('file_name', [
+    'basic_iati_unordered_valid.xml',
+    'basic_iati_ruleset_errors.xml',
+    'example_codelist.xml',
+    'basic_iati_org_valid.xml',
+])
+def test_common_checks_context_iati_streaming(file_name):
+    file_path = os.path.join('cove_iati', 'fixtures', file_name)
+    upload_dir = os.path.join('media', str(uuid.uuid4()))
+    tree = iati.get_tree(file_path)
+    context = iati.common_checks_context_iati({}, upload_dir, file_path, 'xml', tree, api=True,
+                                              openag=True, orgids=True)
+    upload_dir = os.path.join('media', str(uuid.uuid4()))
+    streamed_context = iati.common_checks_context_iati({}, upload_dir, file_path, 'xml', None, api=True,
+                                                       openag=True, orgids=True)
+
+    assert streamed_context == context
+
+
+def test_common_checks_context_iati_parallel(settings):
+    settings.PARALLEL_CHECKS_PROCESSES = 2
+    settings.PARALLEL_CHECKS_SHARD_SIZE = 1
+    file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_ruleset_errors.xml')
+    upload_dir = os.path.join('media', str(uuid.uuid4()))
+    tree = iati.get_tree(file_path)
+    context = iati.common_checks_context_iati({}, upload_dir, file_path, 'xml', tree, api=True, openag=True)
+    upload_dir = os.path.join('media', str(uuid.uuid4()))
+    streamed_context = iati.common_checks_context_iati({}, upload_dir, file_path, 'xml', None, api=True,
+                                                       openag=True)
+
+    assert streamed_context == context
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_common_checks_context_iati_error_examples_limit(settings, tmp_path, streaming):
+    file_path = str(tmp_path / 'activities.xml')
+    with open(file_path, 'w') as fp:
+        fp.write('<iati-activities version="2.03">\n' + ''.join(
+            '<iati-activity><iati-identifier>AA-AAA-123456789-{}</iati-identifier>'
+            '<activity-status code="99"/></iati-activity>\n'.format(i) for i in range(5)
+        ) + '</iati-activities>\n')
+
+    def check(upload_dir):
+        tree = None if streaming else iati.get_tree(file_path)
+        return iati.common_checks_context_iati({}, str(tmp_path / upload_dir), file_path, 'xml', tree)
+
+    settings.ERROR_EXAMPLES_LIMIT = 0
+    context = check('all')
+    settings.ERROR_EXAMPLES_LIMIT = 2
+    limited_context = check('limited')
+
+    error_counts = limited_context['error_counts']
+    assert error_counts == context['error_counts']
+    assert set(error_counts['validation_errors'].values()) == {5}
+    assert list(error_counts['invalid_embedded_codelist_values'].values()) == [5]
+    assert limited_context['validation_errors_count'] == context['validation_errors_count']
+    assert limited_context['ruleset_errors_count'] == context['ruleset_errors_count']
+    assert limited_context['error_examples_truncated'] and not context['error_examples_truncated']
+
+    assert all(len(values) == 2 for error_json, values in limited_context['validation_errors'])
+    assert len(limited_context['invalid_embedded_codelist_values']) == 2
+    errors_by_rule = limited_context['ruleset_errors'][0]
+    assert all(len(errors) <= 2 for rules in errors_by_rule.values() for errors in rules.values())
+
+
+def test_common_checks_context_iati_incremental(settings, tmp_path, monkeypatch):
+    settings.INCREMENTAL_CHECKS = True
+    settings.ACTIVITY_RESULT_STORE_PATH = str(tmp_path / 'activity_results.sqlite3')
+    file_path = str(tmp_path / 'activities.xml')
+    with open(os.path.join('cove_iati', 'fixtures', 'basic_iati_ruleset_errors.xml')) as fp:
+        data = fp.read()
+    with open(file_path, 'w') as fp:
+        fp.write(data)
+    iati.common_checks_context_iati({}, str(tmp_path / 'upload'), file_path, 'xml', None, api=True, openag=True)
+
+    # a new activity moves the others, whose results are reused with their new paths and lines
+    new_activity = ('<iati-activity><iati-identifier>AA-AAA-123456789-NEW</iati-identifier>\n'
+                    '<activity-status code="99"/></iati-activity>\n  ')
+    with open(file_path, 'w') as fp:
+        fp.write(data.replace('<iati-activity>', new_activity + '<iati-activity>', 1))
+    checked = []
+    check = iati.ActivityChecks._check
+    monkeypatch.setattr(iati.ActivityChecks, '_check', lambda self, child, *args: (
+        checked.append(child.findtext('iati-identifier')) or check(self, child, *args)))
+    context = iati.common_checks_context_iati({}, str(tmp_path / 'upload'), file_path, 'xml', None, api=True,
+                                              openag=True)
+
+    assert checked == ['AA-AAA-123456789-NEW']
+    settings.INCREMENTAL_CHECKS = False
+    tree = iati.get_tree(file_path)
+    assert context == iati.common_checks_context_iati({}, str(tmp_path / 'upload'), file_path, 'xml', tree,
+                                                      api=True, openag=True)
+
+
+def test_sharded_activity_checks():
+    file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_ruleset_errors.xml')
+    schema_iati = SchemaIATI()
+    activity_check_args = (
+        'iati-activities',
+        schema_iati.activity_schema,
+        schema_iati.version,
+        [embedded_codelists(schema_iati.schema_directory)],
+        None,
+        {'ruleset_errors': iati.IATI_RULESET},
+    )
+
+    results = []
+    sharded_results = []
+    for root, child in iter_root_children(file_path):
+        if child is None:
+            document_paths = DocumentPaths(root)
+            root_path = ElementPath.root(root)
+            activity_checks = iati.ActivityChecks(*activity_check_args)
+            sharded_activity_checks = ShardedActivityChecks(2, 3, activity_check_args, root)
+            continue
+        document_paths.start_child(child)
+        codelist_path = root_path.child(child.tag, len(results))
+        results.append(activity_checks.check(child, document_paths, codelist_path))
+        sharded_results += sharded_activity_checks.add(child, document_paths.document_xpath, codelist_path)
+    sharded_results += sharded_activity_checks.finish()
+    sharded_activity_checks.close()
+
+    assert sharded_results == results
+    assert len(results) == 5
+    assert results[0]['schema_errors'][0]['path'] == '/iati-activities/iati-activity[1]/activity-date'
+    assert results[0]['rulesets']['ruleset_errors']
+
+
+def test_iter_root_children_document_paths(tmp_path):
+    file_path = str(tmp_path / 'activities.xml')
+    with open(file_path, 'w') as fp:
+        fp.write('<iati-activities><iati-activity><title/><title/></iati-activity><!-- comment -->'
+                 '<other/><iati-activity><title/></iati-activity></iati-activities>')
+
+    xpaths = []
+    for root, child in iter_root_children(file_path):
+        if child is None:
+            document_paths = DocumentPaths(root)
+            continue
+        # earlier elements have been cleared and removed
+        assert next(root.iterchildren(lxml.etree.Element)) is child
+        document_paths.start_child(child)
+        xpaths += [document_paths.getpath(element) for element in child.iter()]
+
+    assert [document_paths.finalize(xpath) for xpath in xpaths] == [
+        '/iati-activities/iati-activity[1]',
+        '/iati-activities/iati-activity[1]/title[1]',
+        '/iati-activities/iati-activity[1]/title[2]',
+        '/iati-activities/other',
+        '/iati-activities/iati-activity[2]',
+        '/iati-activities/iati-activity[2]/title',
+    ]
+
+
+CHUNKED_VALIDATION_XML = '''<iati-activities version="2.03" xmlns:x="http://example.com/x">
+  <iati-activity><iati-identifier>AA-1</iati-identifier><bogus/></iati-activity>
+  <!-- comment --> text
+  <x:other><x:child/></x:other>
+  <iati-activity last-updated-datetime="yesterday"><iati-identifier>AA-2</iati-identifier></iati-activity>
+  more text
+  <unexpected/>
+  <iati-activity><bogus/></iati-activity>
+</iati-activities>'''
+
+
+@pytest.mark.parametrize('file_name', [
+    'basic_iati_unordered_valid.xml',
+    'basic_iati_ruleset_errors.xml',
+    'example_codelist.xml',
+    'basic_iati_org_valid.xml',
+    'iati_openag_tag.xml',
+    None,
+])
+def test_validate_against_schema_chunked(file_name, tmp_path):
+    if file_name:
+        file_path = os.path.join('cove_iati', 'fixtures', file_name)
+    else:
+        file_path = str(tmp_path / 'activities.xml')
+        with open(file_path, 'w') as fp:
+            fp.write(CHUNKED_VALIDATION_XML)
+    tree = iati.get_tree(file_path)
+    schema_iati = SchemaIATI()
+    if tree.getroot().tag == 'iati-organisations':
+        schema_path = schema_iati.organisation_schema
+    else:
+        schema_path = schema_iati.activity_schema
+
+    errors_all, invalid_data = iati.validate_against_schema(schema_path, tree, schema_iati.version)
+    errors_all = list(errors_all)
+    chunked_errors_all, chunked_invalid_data = iati.validate_against_schema(
+        schema_path, tree, schema_iati.version, chunked=True)
+
+    assert list(chunked_errors_all) == errors_all
+    assert chunked_invalid_data == invalid_data
+    if not file_name:
+        # nothing after the unexpected element is validated
+        assert [(error['path'], error['line']) for error in errors_all] == [
+            ('iati-activity/0/bogus', 2),
+            ('/iati-activities', 1),
+            ('iati-activity/1/@last-updated-datetime', 5),
+            ('iati-activity/1', 5),
+            ('/iati-activities', 1),
+            ('unexpected', 7),
+        ]
+
+
+def test_group_ruleset_errors():
+    flat_errors = [
+        {'id': 'AA-1', 'path': '/iati-activities/iati-activity[1]', 'rule': 'rule a',
+         'explanation': 'explanation a', 'ruleset': 'ruleset 1'},
+        {'id': 'AA-2', 'path': '/iati-activities/iati-activity[2]', 'rule': 'rule a',
+         'explanation': 'explanation b', 'ruleset': 'ruleset 1'},
+        {'id': 'AA-2', 'path': '/iati-activities/iati-activity[2]/sector', 'rule': 'rule b',
+         'explanation': 'explanation c', 'ruleset': 'ruleset 2'},
+    ]
+    by_rule, by_activity = iati._group_ruleset_errors(flat_errors)
+
+    assert by_rule == {
+        'ruleset 1': {'rule a': [['AA-1', 'explanation a', '/iati-activities/iati-activity[1]'],
+                                 ['AA-2', 'explanation b', '/iati-activities/iati-activity[2]']]},
+        'ruleset 2': {'rule b': [['AA-2', 'explanation c', '/iati-activities/iati-activity[2]/sector']]},
+    }
+    assert by_activity == {
+        'AA-1': {'ruleset 1': [['rule a', 'explanation a', '/iati-activities/iati-activity[1]']]},
+        'AA-2': {'ruleset 1': [['rule a', 'explanation b', '/iati-activities/iati-activity[2]']],
+                 'ruleset 2': [['rule b', 'explanation c', '/iati-activities/iati-activity[2]/sector']]},
+    }
+    assert iati._count_ruleset_errors(flat_errors) == 3
+
+    return_on_error = [{'message': 'There was a problem running ruleset checks', 'exception': True}]
+    assert iati._group_ruleset_errors(return_on_error) == return_on_error
+    assert iati._count_ruleset_errors(return_on_error) == 0
+    assert iati._group_ruleset_errors([]) == []
+
+
 def test_common_checks_context_iati_org_validation():
     file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_org_valid.xml')
     upload_dir = os.path.join('media', str(uuid.uuid4()))
@@ -556,6 +1035,79 @@ def test_common_checks_context_iati_org_validation():
     assert len(context['validation_errors']) == 0
 
 
+def test_job(settings):
+    settings.EXPLORE_JOB_WORKERS = 1
+    seen_states = []
+
+    def check(progress):
+        progress('checking')
+        seen_states.append(Job(upload_dir).state)
+        return {'file_type': 'xml'}
+
+    def bad_xml(progress):
+        progress('checking')
+        iati.get_tree(os.path.join('cove_iati', 'fixtures', 'basic_iati_unordered_valid.xlsx'))
+
+    def wait(job):
+        while job.is_active():
+            time.sleep(0.01)
+            job.state = job.load()
+
+    with tempfile.TemporaryDirectory() as upload_dir:
+        job = Job(upload_dir)
+        assert job.state is None
+        job.enqueue(check, ['checking'])
+        wait(job)
+        assert seen_states[0]['status'] == 'running'
+        assert [stage['status'] for stage in Job(upload_dir).stage_progress()] == ['done', 'done']
+        assert job.state['status'] == 'done'
+        with open(job.cached_context_path) as fp:
+            assert json.load(fp) == {'file_type': 'xml'}
+
+        # a job that's done is replaced when it's queued again
+        job.enqueue(bad_xml, ['checking'])
+        wait(job)
+        assert job.state['status'] == 'failed'
+        assert job.state['stages'] == ['queued', 'checking']
+        error_context = job.error_context()
+        assert error_context['sub_title'] == "Sorry, we can't process that data"
+        assert 'not well formed XML' in error_context['msg']
+        assert isinstance(error_context['msg'], SafeData)
+        # failures caused by the data aren't retried
+        settings.EXPLORE_JOB_RETRY_SECONDS = 0
+        assert not job.can_retry()
+
+        # checks asked for while a job is active aren't queued
+        release = threading.Event()
+        assert job.enqueue(lambda progress: release.wait() and {'file_type': 'xml'}, ['checking'])
+        assert not job.enqueue(check, ['checking', 'flattening'])
+        release.set()
+        wait(job)
+        assert job.state['stages'] == ['queued', 'checking']
+
+
+def test_job_retry(settings):
+    settings.EXPLORE_JOB_WORKERS = 0
+    settings.EXPLORE_JOB_RETRY_SECONDS = 60
+
+    def broken(progress):
+        raise requests.ConnectionError('codelists unavailable')
+
+    with tempfile.TemporaryDirectory() as upload_dir:
+        job = Job(upload_dir)
+        # without a pool of workers, the exception goes on to be reported
+        with pytest.raises(requests.ConnectionError):
+            job.enqueue(broken, ['checking'])
+        assert Job(upload_dir).state['status'] == 'failed'
+        assert Job(upload_dir).error_context() is None
+
+        assert not job.can_retry()
+        settings.EXPLORE_JOB_RETRY_SECONDS = 0
+        assert job.can_retry()
+        job.enqueue(lambda progress: {'file_type': 'xml'}, ['checking'])
+        assert job.state['status'] == 'done'
+
+
 def test_post_api(client):
     file_path = os.path.join('cove_iati', 'fixtures', 'example.xml')
     resp = client.post('/api_test', {'file': open(file_path, 'rb'), 'name': 'example.xml'})
@@ -577,6 +1129,144 @@ def test_post_api(client):
     assert resp.json() == {'name': ['This field is required.']}
 
 
+def test_api_timings():
+    file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_unordered_valid.xlsx')
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        context = api.iati_json_output(tmpdirname, file_path)
+    assert 'timings' not in context
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        context = api.iati_json_output(tmpdirname, file_path, timings=True)
+    timings = context['timings']
+    for stage in ['convert_spreadsheet', 'get_tree', 'validate_against_schema', 'ruleset iati_standard_v2_ruleset',
+                  'check_activity_org_refs', 'codelists']:
+        assert timings[stage]['count'] == 1
+        assert timings[stage]['wall_time'] >= 0
+    feature_timings = [timing for stage, timing in timings.items() if stage.startswith('ruleset feature ')]
+    assert feature_timings
+    assert all(timing['count'] == 2 for timing in feature_timings)
+
+
+@pytest.fixture()
+def reference_data(monkeypatch):
+    '''Make the result cache use fixed codelists and org registry, without fetching them'''
+    data = ReferenceData(
+        (1, {'ActivityStatus': {'name': 'Activity Status', 'values': ['1', '2']}}),
+        SimpleNamespace(version='registry-1'),
+        OrgidsPrefixes('prefixes-1', PrefixTrie(['XM-DAC'])),
+    )
+    monkeypatch.setattr(result_cache, 'loaded_reference_data', lambda orgids=False: data)
+    return data
+
+
+def test_api_result_cache(result_cache_dir):
+    file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_ruleset_errors.xml')
+    # results are only cached once the codelists and org registry have been loaded
+    process_codelists.codelist_store.get()
+    org_registry.org_registry_store.get()
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        context = api.iati_json_output(tmpdirname, file_path, timings=True)
+    assert 'get_tree' in context['timings']
+    assert len(os.listdir(result_cache_dir)) == 1
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cached_context = api.iati_json_output(tmpdirname, file_path, timings=True)
+    assert 'get_tree' not in cached_context['timings']
+    del context['timings'], cached_context['timings']
+    assert json.loads(json.dumps(context)) == cached_context
+
+    # other rulesets are cached separately
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        context = api.iati_json_output(tmpdirname, file_path, openag=True, timings=True)
+    assert 'get_tree' in context['timings']
+    assert len(os.listdir(result_cache_dir)) == 2
+
+
+def test_result_cache_key(result_cache_dir, reference_data):
+    file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_unordered_valid.xml')
+    key = result_cache_key(file_path, 'xml', reference_data)
+    assert result_cache_key(file_path, 'xml', reference_data) == key
+    assert result_cache_key(file_path, 'xml', reference_data, api=True) != key
+    assert result_cache_key(file_path, 'xml', reference_data, orgids=True) != key
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        copy_path = os.path.join(tmpdirname, 'copy.xml')
+        with open(file_path, 'rb') as fp, open(copy_path, 'wb') as copy_fp:
+            copy_fp.write(fp.read())
+        assert result_cache_key(copy_path, 'xml', reference_data) == key
+        with open(copy_path, 'ab') as copy_fp:
+            copy_fp.write(b'\n')
+        assert result_cache_key(copy_path, 'xml', reference_data) != key
+
+    # results depend on the org registry
+    registry_2 = reference_data._replace(org_registry=SimpleNamespace(version='registry-2'))
+    assert result_cache_key(file_path, 'xml', registry_2) != key
+
+
+def test_cached_checks_reference_data(result_cache_dir, reference_data, monkeypatch):
+    file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_unordered_valid.xml')
+
+    def check():
+        # the checks get the data the results are cached under
+        return {
+            'codelists': process_codelists.codelist_store.get()[1],
+            'org_registry': org_registry.org_registry_store.get().version,
+            'orgids_prefixes': sorted(org_registry.orgids_prefix_trie()),
+        }
+
+    assert cached_checks(file_path, 'xml', check, orgids=True) == {
+        'codelists': reference_data.codelists[1],
+        'org_registry': 'registry-1',
+        'orgids_prefixes': ['XM-DAC'],
+    }
+    assert len(os.listdir(result_cache_dir)) == 1
+
+    # until they are loaded, files are checked without the cache
+    monkeypatch.setattr(result_cache, 'loaded_reference_data', lambda orgids=False: None)
+    assert cached_checks(file_path, 'xml', lambda: {'checked': True}) == {'checked': True}
+    assert len(os.listdir(result_cache_dir)) == 1
+
+
+def test_result_cache_eviction(result_cache_dir, reference_data, settings):
+    settings.RESULT_CACHE_MAX_BYTES = 2500
+    file_paths = []
+    for index in range(4):
+        file_path = os.path.join(result_cache_dir, '{}.tmpxml'.format(index))
+        with open(file_path, 'w') as fp:
+            fp.write(str(index))
+        file_paths.append(file_path)
+
+    def check(index):
+        return lambda: {'index': index, 'padding': 'x' * 1000}
+
+    for index, file_path in enumerate(file_paths[:2]):
+        assert cached_checks(file_path, 'xml', check(index)) == check(index)()
+    # using the first makes the second the least recently used
+    time.sleep(0.01)
+    assert cached_checks(file_paths[0], 'xml', check(None))['index'] == 0
+    time.sleep(0.01)
+    cached_checks(file_paths[2], 'xml', check(2))
+
+    assert cached_checks(file_paths[0], 'xml', check(None))['index'] == 0
+    assert cached_checks(file_paths[1], 'xml', check(None))['index'] is None
+    # org ref results from a failed fetch aren't cached
+    cached_checks(file_paths[3], 'xml', lambda: {'org_refs': {'error': 'Unable to fetch data'}})
+    assert cached_checks(file_paths[3], 'xml', check(3))['index'] == 3
+
+
+def test_metrics(client, settings):
+    settings.TIMING_METRICS = True
+    file_path = os.path.join('cove_iati', 'fixtures', 'example.xml')
+    resp = client.post('/api_test', {'file': open(file_path, 'rb'), 'name': 'example.xml', 'timings': True})
+    assert 'get_tree' in resp.json()['timings']
+
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    content = resp.content.decode()
+    assert '# TYPE cove_iati_stage_wall_seconds_total counter' in content
+    assert 'cove_iati_stage_runs_total{stage="get_tree"}' in content
+
+
 def test_process_codelist():
     file_path = os.path.join('cove_iati', 'fixtures', 'unflattened_bad_codelist_xlsx.xml')
     source_map_path = os.path.join('cove_iati', 'fixtures', 'cell_source_map_bad_codelist_xlsx.json')
@@ -586,6 +1276,253 @@ def test_process_codelist():
     assert set(item['value'] for item in result) == set(["what", "is", "100"])
 
 
+def test_check_codelists_single_traversal():
+    file_path = os.path.join('cove_iati', 'fixtures', 'unflattened_bad_codelist_xlsx.xml')
+    source_map_path = os.path.join('cove_iati', 'fixtures', 'cell_source_map_bad_codelist_xlsx.json')
+    schema_directory = os.path.join('cove_iati', 'iati_schemas', '2.03')
+    with open(source_map_path) as fp:
+        cell_source_map = json.load(fp)
+    cell_source_map_copy = dict(cell_source_map)
+    codelists = embedded_codelists(schema_directory)
+
+    first, second = check_codelists([codelists, {}], iati.get_tree(file_path), cell_source_map)
+
+    assert first == invalid_embedded_codelist_values(schema_directory, file_path, source_map_path)
+    assert second == []
+    assert cell_source_map == cell_source_map_copy
+
+
+@pytest.mark.parametrize(('non_number_path', 'codelist_path'), [
+    ('iati-activity/sector/@code', 'iati-activity/sector/@code'),
+    ('iati-activity/transaction/sector/@code', 'sector/@code'),
+    ('iati-activity/sector/@vocabulary', None),
+    ('iati-activity/title/narrative/@lang', '@lang'),
+    ('iati-activity/sector', None),
+])
+def test_codelist_paths_match(non_number_path, codelist_path):
+    codelist_values = {
+        'iati-activity/sector/@code': {'name': 'Sector'},
+        'sector/@code': {'name': 'Any sector'},
+        '@lang': {'name': 'Language'},
+    }
+    codelist_paths = CodelistPaths(codelist_values)
+
+    for i in range(2):
+        assert codelist_paths.match(non_number_path) == (codelist_path, codelist_values.get(codelist_path))
+
+
+def test_traverse_element():
+    root = etree.fromstring(
+        '<iati-activities version="2.03">'
+        '<iati-activity><iati-identifier>A1</iati-identifier>'
+        '<sector code="1"/><!-- comment --><sector code="2"/><title/><sector code="3">'
+        '<narrative xml:lang="en"/></sector></iati-activity>'
+        '<iati-activity><iati-identifier>A2</iati-identifier><sector code="4"/></iati-activity>'
+        '</iati-activities>'
+    )
+
+    attributes = [
+        (element_path.attribute_path(attr_name), element_path.non_index_path, current_identifier)
+        for element, element_path, current_identifier in traverse_element(root)
+        for attr_name in element.attrib
+    ]
+
+    assert attributes == [
+        ('@version', '', None),
+        ('iati-activity/0/sector/0/@code', 'iati-activity/sector/', 'A1'),
+        ('iati-activity/0/sector/1/@code', 'iati-activity/sector/', 'A1'),
+        ('iati-activity/0/sector/0/@code', 'iati-activity/sector/', 'A1'),
+        ('iati-activity/0/sector/0/narrative/0/@{http://www.w3.org/XML/1998/namespace}lang',
+         'iati-activity/sector/narrative/', 'A1'),
+        ('iati-activity/1/sector/0/@code', 'iati-activity/sector/', 'A2'),
+    ]
+
+
+def test_codelist_store_fetch(httpserver, settings):
+    with open(os.path.join('cove_iati', 'iati_schemas', '2.03', 'codelists', 'ActivityStatus.xml'), 'rb') as fp:
+        httpserver.serve_content(fp.read())
+    settings.REQUESTS_SESSION_WITH_CACHING = requests.Session()
+    settings.NON_EMBEDDED_CODELISTS_URLS = {
+        'ActivityStatus': httpserver.url + '/ActivityStatus.xml',
+        'OtherStatus': httpserver.url + '/OtherStatus.xml',
+    }
+
+    store = CodelistStore()
+    generation, codelists = store.get()
+    assert generation == 1
+    assert set(codelists) == {'ActivityStatus', 'OtherStatus'}
+    assert codelists['ActivityStatus']['name'] == 'Activity Status'
+    assert '2' in codelists['ActivityStatus']['values']
+
+    # Codelists that fail to fetch in the background are logged rather than raised,
+    # and don't leave the store looking fresh
+    httpserver.serve_content('Not found', code=404)
+    store = CodelistStore()
+    store.fetch_in_background().join()
+    assert store.fetched_at is None
+    # so they are fetched again, raising if they still can't be
+    with pytest.raises(requests.HTTPError):
+        store.get()
+
+
+def test_codelist_snapshots(httpserver, settings, tmp_path):
+    settings.CODELIST_SNAPSHOT_DIR = str(tmp_path)
+    schema_directory = os.path.join('cove_iati', 'iati_schemas', '2.03')
+
+    embedded_codelists.cache_clear()
+    parsed = embedded_codelists(schema_directory)
+    saved_at, snapshot = read_codelist_snapshot(
+        str(tmp_path / 'embedded-2.03.json'), embedded_codelists_source(schema_directory)
+    )
+    assert snapshot == parsed
+    assert '2' in parsed['iati-activity/activity-status/@code']['values']
+
+    embedded_codelists.cache_clear()
+    assert embedded_codelists(schema_directory) == parsed
+    embedded_codelists.cache_clear()
+
+    # A snapshot from different codelist files is not used
+    assert read_codelist_snapshot(str(tmp_path / 'embedded-2.03.json'), 'other source') == (None, None)
+
+    with open(os.path.join(schema_directory, 'codelists', 'ActivityStatus.xml'), 'rb') as fp:
+        httpserver.serve_content(fp.read())
+    settings.REQUESTS_SESSION_WITH_CACHING = requests.Session()
+    settings.NON_EMBEDDED_CODELISTS_URLS = {'ActivityStatus': httpserver.url + '/ActivityStatus.xml'}
+    generation, codelists = CodelistStore(snapshot_name='non-embedded').get()
+
+    # A new process starts from the snapshot, without fetching
+    httpserver.serve_content('Not found', code=404)
+    assert CodelistStore(snapshot_name='non-embedded').get() == (1, codelists)
+
+
+def test_non_embedded_codelists_generation(monkeypatch):
+    schema_directory = os.path.join('cove_iati', 'iati_schemas', '2.03')
+    store = CodelistStore()
+    store.fetched_at = time.time()
+    store.generation = 1
+    store.codelists = {'ActivityStatus': {'name': 'Activity Status', 'values': ['1', '2']}}
+    monkeypatch.setattr(process_codelists, 'codelist_store', store)
+    monkeypatch.setattr(process_codelists, '_non_embedded_codelists', {})
+
+    path_codelists = process_codelists.non_embedded_codelists(schema_directory)
+    assert path_codelists['iati-activity/activity-status/@code']['values'] == ['1', '2']
+    assert process_codelists.non_embedded_codelists(schema_directory) is path_codelists
+
+    # the codelists of a new generation are used as soon as the store has them
+    store.generation = 2
+    store.codelists = {'ActivityStatus': {'name': 'Activity Status', 'values': ['3']}}
+    assert process_codelists.non_embedded_codelists(schema_directory)['iati-activity/activity-status/@code']['values'] == ['3']
+
+
+def test_prefix_trie():
+    trie = PrefixTrie(['GB', 'GB-COH', 'GB-CHC', 'XM-DAC', 'XM-DAC-41'])
+
+    assert trie.longest_prefix('GB-COH-123456') == 'GB-COH'
+    assert trie.longest_prefix('XM-DAC-41-1') == 'XM-DAC-41'
+    assert trie.longest_prefix('XM-DAC-4') == 'XM-DAC'
+    assert trie.longest_prefix('GB-SC-123') == 'GB'
+    assert trie.longest_prefix('GB-SC-123', min_length=4) is None
+    assert trie.longest_prefix('US-EIN-1') is None
+
+    # tries are sent to worker processes by `ShardedActivityChecks`
+    unpickled = pickle.loads(pickle.dumps(trie))
+    assert sorted(unpickled) == sorted(trie)
+    assert unpickled.longest_prefix('XM-DAC-41-1') == 'XM-DAC-41'
+
+
+def test_org_registry_store(httpserver, settings, monkeypatch):
+    httpserver.serve_content(json.dumps({'data': [{'code': 'GB-COH', 'name': 'Companies House'}]}))
+    settings.REQUESTS_SESSION_WITH_CACHING = requests.Session()
+    monkeypatch.setattr('cove_iati.lib.org_registry.PUBLISHERS_URL', httpserver.url + '/publishers.json')
+    monkeypatch.setattr('cove_iati.lib.org_registry.REGISTRATION_AGENCIES_URL', httpserver.url + '/agencies.json')
+
+    store = OrgRegistryStore()
+    registry = store.get()
+    assert registry.org_prefix('GB-COH-123') == 'GB-COH'
+    assert registry.publisher_codes['GB-COH']['name'] == 'Companies House'
+    # the registry is shared by every request, so can't be changed
+    with pytest.raises(TypeError):
+        registry.publisher_codes['GB-COH']['count'] = 1
+
+    # a registry that fails to refresh is kept
+    httpserver.serve_content('Not found', code=404)
+    store.fetched_at = 0
+    store.get()
+    store._fetch_thread.join()
+    assert store.get() is registry
+
+
+def test_orgids_prefixes(httpserver, settings, tmp_path, monkeypatch):
+    httpserver.serve_content(json.dumps({'lists': [{'code': 'GB-COH'}, {'code': 'XM-DAC'}]}))
+    settings.REQUESTS_SESSION_WITH_CACHING = requests.Session()
+    settings.CODELIST_SNAPSHOT_DIR = str(tmp_path)
+    monkeypatch.setattr(org_registry, 'ORGIDS_URL', httpserver.url + '/download.json')
+    monkeypatch.setattr(org_registry, '_orgids_prefixes', None)
+
+    call_command('refresh_orgids_prefixes')
+    assert org_registry.read_orgids_snapshot() == ['GB-COH', 'XM-DAC']
+
+    # a new process reads the snapshot, without fetching
+    httpserver.serve_content('Not found', code=404)
+    monkeypatch.setattr(org_registry, '_orgids_prefixes', None)
+    prefix_trie = org_registry.orgids_prefix_trie()
+    assert prefix_trie.longest_prefix('XM-DAC-41') == 'XM-DAC'
+    assert prefix_trie.longest_prefix('GB-CHC-1') is None
+    assert org_registry.orgids_prefix_trie() is prefix_trie
+
+
+@pytest.fixture()
+def schema_server():
+    '''Serve the files of the default version of the schemas, by name, for any version'''
+    schema_directory = SchemaIATI().schema_directory
+
+    def schema_files(environ, start_response):
+        path = os.path.join(schema_directory, os.path.basename(environ['PATH_INFO']))
+        if not os.path.isfile(path):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not found']
+        start_response('200 OK', [('Content-Type', 'application/xml')])
+        with open(path, 'rb') as fp:
+            return [fp.read()]
+
+    server = WSGIServer(application=schema_files)
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_schema_registry(schema_server, settings, tmp_path, monkeypatch):
+    schema_iati = SchemaIATI()
+    shutil.copytree(schema_iati.schema_directory, str(tmp_path / schema_iati.version))
+    settings.REQUESTS_SESSION_WITH_CACHING = requests.Session()
+    monkeypatch.setattr(SchemaIATI, 'default_schema_host', schema_server.url)
+    settings.IATI_SCHEMA_VERSIONS = ['2.02', '2.03']
+
+    registry = SchemaRegistry(str(tmp_path))
+    assert registry.versions() == ['2.03']
+    assert registry.get('2.03') is registry.get(None)
+    assert registry.get('2.03').schema_directory == str(tmp_path / '2.03')
+
+    # a version that isn't in the store is fetched in the background, and the default used until then
+    assert registry.get('2.02').version == '2.03'
+    registry._fetch_threads['2.02'].join()
+    assert registry.versions() == ['2.02', '2.03']
+    schema_iati = registry.get('2.02')
+    assert schema_iati.version == '2.02'
+    assert sorted(os.listdir(schema_iati.schema_directory)) == sorted(SchemaIATI.schema_names)
+    assert schema_iati.codelist_directory == str(tmp_path / '2.03')
+    assert schema_iati.codelist_version == '2.03'
+
+    # unsupported versions aren't fetched, and checking them doesn't list the store again
+    listed = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda path: listed.append(path) or listdir(path))
+    assert registry.get('2.01').version == '2.03'
+    assert registry.get('../2.03').version == '2.03'
+    assert list(registry._fetch_threads) == ['2.02']
+    assert listed == []
+
+
 def test_embedded_codelist_full():
     file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_unordered_bad_codelist.xlsx')
     with tempfile.TemporaryDirectory() as tmpdirname:
@@ -813,6 +1750,38 @@ def test_iati_identifier_count_when_none():
     assert iati.iati_identifier_count(tree) == 0
 
 
+@pytest.mark.parametrize('file_name', [
+    'example-org-analysis.xml',
+    'basic_iati_ruleset_errors.xml',
+    'iati_openag_tag_repeat_identifiers.xml',
+])
+def test_collect_activity_refs(file_name):
+    tree = iati.get_tree(os.path.join('cove_iati', 'fixtures', file_name))
+    activity_refs = iati.tree_activity_refs(tree)
+
+    activities = tree.getroot().xpath('/iati-activities/iati-activity')
+    assert len(activity_refs) == len(activities)
+    for activity, refs in zip(activities, activity_refs):
+        assert refs == (
+            activity.xpath('iati-identifier/text()'),
+            activity.xpath('reporting-org/@ref'),
+            activity.xpath('participating-org/@ref'),
+            activity.xpath('transaction/provider-org/@ref'),
+            activity.xpath('transaction/receiver-org/@ref'),
+        )
+
+
+@pytest.mark.parametrize('fromstring', [lxml.etree.fromstring, iati.etree.fromstring])
+def test_collect_activity_refs_text_nodes(fromstring):
+    # defusedxml's elements are checked too, as the trees of uploaded files use them
+    activity = fromstring(
+        '<iati-activity><iati-identifier>AA-1<!-- comment -->23</iati-identifier>'
+        '<reporting-org/><transaction><receiver-org ref=""/><provider-org ref="AA"/></transaction>'
+        '</iati-activity>')
+
+    assert iati.collect_activity_refs(activity) == (['AA-1', '23'], [], [], ['AA'], [''])
+
+
 def test_organisation_identifier_count():
     file_path = os.path.join('cove_iati', 'fixtures', 'basic_iati_org_valid.xml')
     tree = iati.get_tree(file_path)
@@ -832,3 +1801,63 @@ def test_organisation_identifier_count_when_none():
     tree = iati.get_tree(file_path)
 
     assert iati.organisation_identifier_count(tree) == 0
+
+
+@pytest.mark.parametrize('root', ['activities', 'organisations'])
+def test_synthetic_file_errors(root):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        file_path = os.path.join(tmpdirname, 'synthetic.xml')
+        write_synthetic_file(file_path, 'xml', 100, root)
+        context = api.iati_json_output(tmpdirname, file_path)
+        assert context['validation_errors'] == []
+        assert context['invalid_embedded_codelist_values'] == []
+        assert not context['ruleset_errors']
+
+        write_synthetic_file(file_path, 'xml', 100, root, schema_error_rate=0.5, ruleset_error_rate=0.5,
+                             codelist_error_rate=0.5, seed=1)
+        context = api.iati_json_output(tmpdirname, file_path)
+        assert 0 < len(context['validation_errors']) < 100
+        assert 0 < len(context['invalid_embedded_codelist_values']) < 100
+        if root == 'activities':
+            assert 0 < len(context['ruleset_errors']) < 100
+
+
+def test_synthetic_csv():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        file_path = os.path.join(tmpdirname, 'synthetic.csv')
+        write_synthetic_file(file_path, 'csv', 10, codelist_error_rate=1)
+        context = api.iati_json_output(tmpdirname, file_path)
+    assert context['validation_errors'] == []
+    assert len(context['invalid_embedded_codelist_values']) == 10
+
+    with pytest.raises(ValueError):
+        write_synthetic_file(file_path, 'csv', 10, 'organisations')
+
+
+def test_benchmark_command():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        output_path = os.path.join(tmpdirname, 'results.json')
+        call_command('benchmark', activities=[10], file_types=['xml', 'csv'], repeat=1, output=output_path)
+        with open(output_path) as fp:
+            results = json.load(fp)
+        call_command('benchmark', activities=[10], file_types=['xml'], roots=['activities'], repeat=1,
+                     output=os.path.join(tmpdirname, 'compared.json'), compare=output_path)
+
+    entry_points = set((benchmark['entry_point'], benchmark['root'], benchmark['file_type'])
+                       for benchmark in results['benchmarks'])
+    assert entry_points == {
+        ('iati_json_output', 'activities', 'xml'),
+        ('common_checks_context_iati', 'activities', 'xml'),
+        ('invalid_codelist_values', 'activities', 'xml'),
+        ('get_xml_validation_errors', 'activities', 'xml'),
+        ('check_activity_org_refs', 'activities', 'xml'),
+        ('iati_json_output', 'activities', 'csv'),
+        ('iati_json_output', 'organisations', 'xml'),
+        ('common_checks_context_iati', 'organisations', 'xml'),
+        ('invalid_codelist_values', 'organisations', 'xml'),
+        ('get_xml_validation_errors', 'organisations', 'xml'),
+    }
+    for benchmark in results['benchmarks']:
+        assert benchmark['activities'] == 10
+        assert benchmark['wall_time']['min'] <= benchmark['wall_time']['median'] <= benchmark['wall_time']['max']
+    assert 'get_tree' in results['benchmarks'][0]['timings']
@@ -11,6 +11,7 @@ urlpatterns = [
     url(r'^data/(.+)/(.+)$', cove_iati.views.explore_iati, name='explore_suffix'),
     url(r'^data/(.+)$', cove_iati.views.explore_iati, name='explore'),
     url(r'^api_test', cove_iati.views.api_test, name='api_test'),
+    url(r'^metrics$', cove_iati.views.metrics, name='metrics'),
 ] + urlpatterns
 
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
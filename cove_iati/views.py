@@ -2,28 +2,30 @@ import json
 import logging
 import os
 import tempfile
+from functools import partial
 
 from cove.input.models import SuppliedData
 from cove.input.views import data_input
 from cove.views import cove_web_input_error, explore_data_context
 from django import forms
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseBadRequest
-from django.shortcuts import render
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.shortcuts import redirect, render
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
 import iatiutils.merge_indicator
 from libcove.config import LibCoveConfig
 from libcove.lib.converters import convert_spreadsheet, convert_json
 
 from .lib.api import iati_json_output
-from .lib.iati import (
-    get_tree, common_checks_context_iati, get_file_type, iati_identifier_count,
-    organisation_identifier_count
-)
+from .lib.iati import get_tree, common_checks_context_iati, get_file_type
+from .lib.jobs import Job
 from .lib.process_codelists import aggregate_results
+from .lib.result_cache import cached_checks
 from .lib.schema import SchemaIATI
+from .lib.stream import use_streaming
+from .lib.timing import prometheus_metrics, timed
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +57,7 @@ class UploadApi(forms.Form):
     file = forms.FileField()
     openag = forms.BooleanField(required=False)
     orgids = forms.BooleanField(required=False)
+    timings = forms.BooleanField(required=False)
 
 
 iati_form_classes = {
@@ -68,34 +71,49 @@ def data_input_iati(request):
     return data_input(request, form_classes=iati_form_classes, text_file_name='text.xml')
 
 
-def explore_data_context_iati(request, context, db_data, error):
+def explore_data_context_iati(context, db_data, flatten=False, progress=None):
+    '''Run the checks for db_data and return the context for the results page.
+
+    progress, if given, is called with the name of each stage (see `check_stages`) as it starts.
+    '''
+    if progress is None:
+        def progress(stage):
+            pass
+
     lib_cove_config = LibCoveConfig()
     lib_cove_config.config.update(settings.COVE_CONFIG)
 
     file_type = context['file_type']
     if file_type != 'xml':
+        progress('converting')
         schema_iati = SchemaIATI()
-        context.update(convert_spreadsheet(
-            db_data.upload_dir(), db_data.upload_url(), db_data.original_file.file.name,
-            file_type, lib_cove_config, xml=True,
-            xml_schemas=[
-                schema_iati.activity_schema,
-                schema_iati.organisation_schema,
-                schema_iati.common_schema,
-            ]))
+        with timed('convert_spreadsheet'):
+            context.update(convert_spreadsheet(
+                db_data.upload_dir(), db_data.upload_url(), db_data.original_file.file.name,
+                file_type, lib_cove_config, xml=True,
+                xml_schemas=[
+                    schema_iati.activity_schema,
+                    schema_iati.organisation_schema,
+                    schema_iati.common_schema,
+                ]))
         data_file = context['converted_path']
     else:
         data_file = db_data.original_file.file.name
 
     context['data_file'] = data_file
 
-    tree = get_tree(data_file)
-    context = common_checks_context_iati(context, db_data.upload_dir(), data_file, file_type, tree)
+    progress('checking')
+
+    def check():
+        tree = None if use_streaming(data_file) else get_tree(data_file)
+        return common_checks_context_iati({}, db_data.upload_dir(), data_file, file_type, tree)
+
+    context.update(cached_checks(db_data.original_file.file.name, file_type, check))
     context['first_render'] = not db_data.rendered
-    context['invalid_embedded_codelist_values'] = aggregate_results(context['invalid_embedded_codelist_values'])
-    context['invalid_non_embedded_codelist_values'] = aggregate_results(context['invalid_non_embedded_codelist_values'])
-    context['iati_identifiers_count'] = iati_identifier_count(tree)
-    context['organisation_identifier_count'] = organisation_identifier_count(tree)
+    context['invalid_embedded_codelist_values'] = aggregate_results(
+        context['invalid_embedded_codelist_values'], context['error_counts']['invalid_embedded_codelist_values'])
+    context['invalid_non_embedded_codelist_values'] = aggregate_results(
+        context['invalid_non_embedded_codelist_values'], context['error_counts']['invalid_non_embedded_codelist_values'])
 
     if file_type == 'xml':
         if context['organisation_identifier_count']:
@@ -104,14 +122,33 @@ def explore_data_context_iati(request, context, db_data, error):
         else:
             root_list_path = 'iati-activity'
             root_id = None
-            
-        context.update(convert_json(db_data.upload_dir(), db_data.upload_url(), db_data.original_file.file.name, root_list_path=root_list_path,
-                       root_id=root_id, request=request, flatten=request.POST.get('flatten'), xml=True, lib_cove_config=lib_cove_config))
+
+        if flatten:
+            progress('flattening')
+        with timed('convert_json'):
+            context.update(convert_json(db_data.upload_dir(), db_data.upload_url(), db_data.original_file.file.name,
+                           root_list_path=root_list_path, root_id=root_id, flatten=flatten, xml=True,
+                           lib_cove_config=lib_cove_config))
 
     if not db_data.rendered:
         db_data.rendered = True
 
-    return context, db_data, error
+    return context
+
+
+def check_stages(file_type, flatten=False):
+    '''Return the stages that `explore_data_context_iati` goes through'''
+    if file_type != 'xml':
+        return ['converting', 'checking']
+    return ['checking', 'flattening'] if flatten else ['checking']
+
+
+def load_cached_context(cached_context_path):
+    try:
+        with open(cached_context_path) as fp:
+            return json.load(fp)
+    except (json.decoder.JSONDecodeError, FileNotFoundError):
+        return None
 
 
 @cove_web_input_error
@@ -119,27 +156,51 @@ def explore_iati(request, pk, suffix=None):
     context, db_data, error = explore_data_context(request, pk, get_file_type)
     if error:
         return error
-    # The cached path is inside the media directory for this data, so will be
-    # removed along with that after the expiry
-    cached_context_path = os.path.join(db_data.upload_dir(), "cached_context.json")
-    if cached_context_path == db_data.original_file.file.name:
+    # The cached path and job state are inside the media directory for this data,
+    # so will be removed along with that after the expiry
+    job = Job(db_data.upload_dir())
+    cached_context_path = job.cached_context_path
+    if db_data.original_file.file.name in (cached_context_path, job.path):
         raise PermissionError('You are not allowed to upload a file with this name.')
+
+    # The checks run as a job (see lib/jobs.py), while this page shows their progress
     if request.POST:
-        cached = False
-    else:
-        try:
-            with open(cached_context_path) as fp:
-                context = json.load(fp)
-            cached = True
-        except (json.decoder.JSONDecodeError, FileNotFoundError):
-            cached = False
-    if not cached:
-        context, db_data, error = explore_data_context_iati(request, context, db_data, error)
-        if error:
-            return error
-        else:
-            with open(cached_context_path, 'w') as fp:
-                json.dump(context, fp)
+        flatten = request.POST.get('flatten')
+        if job.enqueue(partial(explore_data_context_iati, context, db_data, flatten=flatten),
+                       check_stages(context['file_type'], flatten)):
+            return redirect(request.path)
+        # the data is still being checked, and only one job runs at a time
+        return render(request, 'cove_iati/explore_progress.html', {
+            'file_name': context['file_name'],
+            'stages': job.stage_progress(),
+            'refresh_seconds': settings.EXPLORE_JOB_REFRESH_SECONDS,
+            'still_running': True,
+        }, status=409)
+
+    cached_context = None
+    if not job.is_active():
+        cached_context = load_cached_context(cached_context_path)
+        if cached_context is None and (job.state is None or job.state['status'] != 'failed' or job.can_retry()):
+            job.enqueue(partial(explore_data_context_iati, context, db_data),
+                        check_stages(context['file_type']))
+            cached_context = load_cached_context(cached_context_path)
+    if cached_context is None:
+        if job.state['status'] == 'failed':
+            error_context = job.error_context()
+            if error_context is None:
+                return render(request, 'error.html', {
+                    'sub_title': _('Sorry, there was a problem checking your data'),
+                    'link': 'index',
+                    'link_text': _('Try Again'),
+                    'msg': _('Something went wrong while checking your data. Please try again later.'),
+                }, status=500)
+            return render(request, 'error.html', error_context)
+        return render(request, 'cove_iati/explore_progress.html', {
+            'file_name': context['file_name'],
+            'stages': job.stage_progress(),
+            'refresh_seconds': settings.EXPLORE_JOB_REFRESH_SECONDS,
+        })
+    context = cached_context
 
     merge_indicator_output_file_path = os.path.join(db_data.upload_dir(), "merged.xml")
     if suffix == 'merge_indicator':
@@ -166,7 +227,15 @@ def api_test(request):
             with open(file_path, 'wb+') as destination:
                 for chunk in request.FILES['file'].chunks():
                     destination.write(chunk)
-            result = iati_json_output(tmpdirname, file_path, form.cleaned_data['openag'], form.cleaned_data['orgids'])
+            result = iati_json_output(tmpdirname, file_path, form.cleaned_data['openag'], form.cleaned_data['orgids'],
+                                      timings=form.cleaned_data['timings'])
             return HttpResponse(json.dumps(result), content_type='application/json')
     else:
         return HttpResponseBadRequest(json.dumps(form.errors), content_type='application/json')
+
+
+@require_GET
+def metrics(request):
+    if not settings.TIMING_METRICS:
+        raise Http404
+    return HttpResponse(prometheus_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
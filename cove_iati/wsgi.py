@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cove_iati.settings")
 
 application = get_wsgi_application()
+
+from cove_iati.lib.org_registry import org_registry_store  # noqa: E402
+from cove_iati.lib.process_codelists import prefetch_non_embedded_codelists  # noqa: E402
+from cove_iati.lib.schema import warm_schema_cache  # noqa: E402
+
+warm_schema_cache()
+prefetch_non_embedded_codelists()
+org_registry_store.fetch_in_background()